@@ -19,7 +19,64 @@ Fastest response incl. Time to convert to mV: 443 µs (bit => mV take 98 µs)
 
 import sys
 import time
-from machine import Pin, SoftSPI, SPI
+from machine import Pin, SoftSPI, SPI, disable_irq, enable_irq
+import micropython
+
+import codec
+import instrument
+
+# STATUS register bits (Table 31)
+LOCK, CRCERR, PGAL_ALM, PGAH_ALM, REFL_ALM, DRDY, CLOCK, RESET = 0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01
+ALARMS = PGAL_ALM | PGAH_ALM | REFL_ALM  # a conversion taken under these is not valid
+BAD_CRC = 0x100  # check(): the frame's CRC did not match
+
+
+def _crc_table():
+    # CRC-8 ATM, x^8 + x^2 + x + 1, MSB first (section 9.5.2.2)
+    table = bytearray(256)
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = ((c << 1) ^ 0x07) & 0xFF if c & 0x80 else (c << 1) & 0xFF
+        table[i] = c
+    return bytes(table)
+
+
+CRC_TABLE = _crc_table()
+
+
+@micropython.viper
+def crc8(buf, start: int, n: int) -> int:
+    """CRC-8 of buf[start:start + n], one table lookup per byte."""
+    table = ptr8(CRC_TABLE)
+    src = ptr8(buf)
+    crc = 0xFF
+    k = start
+    end = start + n
+    while k < end:
+        crc = table[crc ^ src[k]]
+        k += 1
+    return crc
+
+
+@micropython.viper
+def check(frame, at: int, n: int, mask: int) -> int:
+    """Check an RDATA frame in place: the CRC of frame[at:at + n] against
+    frame[at + n] (skipped if n is 0), then the STATUS byte at frame[at]
+    against mask (0 without STATUS). Returns 0 for a good frame, BAD_CRC,
+    or the STATUS bits in mask that are set."""
+    buf = ptr8(frame)
+    if n:
+        table = ptr8(CRC_TABLE)
+        crc = 0xFF
+        k = at
+        end = at + n
+        while k < end:
+            crc = table[crc ^ buf[k]]
+            k += 1
+        if crc != buf[end]:
+            return 0x100
+    return buf[at] & mask
 
 
 class ADC1261:
@@ -175,6 +232,57 @@ class ADC1261:
         }
     )
 
+    # Register values after reset (Table 29). ID depends on the part and is
+    # read from the chip when asked for.
+    reset_values = bytes(
+        [0x80, 0x01, 0x24, 0x01, 0x00, 0x00, 0x05, 0x00, 0x00, 0x00,
+         0x00, 0x00, 0x40, 0xFF, 0x00, 0x00, 0x00, 0xFF, 0x00]
+    )
+
+    # Registers the ADS1261 changes by itself; never served from the shadow.
+    volatile_registers = (0x0, 0x1)
+
+    # Register fields as (register address, mask, shift), Tables 30 to 49.
+    fields = dict(
+        [
+            ("LOCK", (0x1, 0x80, 7)),
+            ("CRCERR", (0x1, 0x40, 6)),
+            ("PGAL_ALM", (0x1, 0x20, 5)),
+            ("PGAH_ALM", (0x1, 0x10, 4)),
+            ("REFL_ALM", (0x1, 0x08, 3)),
+            ("DRDY", (0x1, 0x04, 2)),
+            ("CLOCK", (0x1, 0x02, 1)),
+            ("RESET", (0x1, 0x01, 0)),
+            ("DR", (0x2, 0xF8, 3)),
+            ("FILTER", (0x2, 0x07, 0)),
+            ("CHOP", (0x3, 0x60, 5)),
+            ("CONVRT", (0x3, 0x10, 4)),
+            ("DELAY", (0x3, 0x0F, 0)),
+            ("PWDN", (0x5, 0x80, 7)),
+            ("STATENB", (0x5, 0x40, 6)),
+            ("CRCENB", (0x5, 0x20, 5)),
+            ("SPITIM", (0x5, 0x10, 4)),
+            ("GPIO3", (0x5, 0x08, 3)),
+            ("GPIO2", (0x5, 0x04, 2)),
+            ("GPIO1", (0x5, 0x02, 1)),
+            ("GPIO0", (0x5, 0x01, 0)),
+            ("REFENB", (0x6, 0x10, 4)),
+            ("RMUXP", (0x6, 0x0C, 2)),
+            ("RMUXN", (0x6, 0x03, 0)),
+            ("IMUX2", (0xD, 0xF0, 4)),
+            ("IMUX1", (0xD, 0x0F, 0)),
+            ("IMAG2", (0xE, 0xF0, 4)),
+            ("IMAG1", (0xE, 0x0F, 0)),
+            ("BYPASS", (0x10, 0x80, 7)),
+            ("GAIN", (0x10, 0x07, 0)),
+            ("MUXP", (0x11, 0xF0, 4)),
+            ("MUXN", (0x11, 0x0F, 0)),
+        ]
+    )
+
+    RMUXP_names = ("Internal Positive", "AVDD", "AIN0", "AIN2")
+    RMUXN_names = ("Internal Negative", "AVSS", "AIN1", "AIN3")
+
     inv_registerAddress = {v: k for k, v in registerAddress.items()}
     inv_INPMUXregister = {v: k for k, v in INPMUXregister.items()}
     inv_available_data_rates = {v: k for k, v in available_data_rates.items()}
@@ -205,7 +313,7 @@ class ADC1261:
 
         self.rst = Pin(rst, Pin.OUT)
         self.pwdn = Pin(pwdn, Pin.OUT)
-        self.drdy = Pin(drdy, Pin.OUT)
+        self.drdy = Pin(drdy, Pin.IN)  # driven by the ADS1261 (active low)
         self.start = Pin(start, Pin.OUT)
 
         # 9.5.1 of ADS1261 datasheet (pg 50): CPOL = 0, CPHA = 1
@@ -219,6 +327,18 @@ class ADC1261:
         self.CRC2 = 1  # Change this to 0 to tell the register if Cyclic Redundancy Checks are disabled (and 1 to enable) per Table 35: MODE3 Register Field Description.
         self.zero = 0  # This is command byte 4 per Table 16.
 
+        # Register shadow: the last value written to (or read from) each of
+        # the 19 registers. Until a register has been written, read or reset
+        # its bit in self.unknown is set and the shadow holds the reset value.
+        # set_register/set_field only mark registers dirty; commit() sends one
+        # WREG frame per register that actually changed.
+        self.shadow = bytearray(self.reset_values)
+        self.dirty = 0
+        self.unknown = (1 << len(self.reset_values)) - 1
+        self.crc_errors = 0  # register reads that failed their CRC
+        self.frame_errors = 0  # collect_measurement frames that failed check()
+        self._layout(False, False)
+
         # Required for the ADS1261
         self.rst.on()
         self.pwdn.on()
@@ -239,102 +359,190 @@ class ADC1261:
             print(wbuf, rbuf)
             print("Attempted byte message:", wbuf)
 
-    def read_register(self, register_location, CRC=None):
-        """Takes the register location. Requires CRC to be None or any other value.
-        If the CRC bit is unknown, function will assume it is off, then on.
-        Returns the value in the read register."""
-        register_location = register_location.upper()
-        hex_message = [
-            self.commandByte1["RREG"][0] + self.registerAddress[register_location],
-            self.arbitrary,
-        ]
-        if CRC is None:
-            read_message = hex_message + [199] + [self.zero] * 8
-            returnedMessage = self.send(hex_message=read_message)
-            returnedMessage = self.send(hex_message=read_message)  # sometimes the first one fails
-            return returnedMessage[2]
-            if returnedMessage[1] != int(hex_message[0], 2):
-                print("Failed readback. CRC may be on.")
-            else:
-                return returnedMessage[4]
-        elif CRC.lower() == "off":
-            read_message = hex_message + [self.zero] * 1
-            returnedMessage = self.send(hex_message=read_message)
-            return returnedMessage[2]
-        else:
-            pass
+    def _layout(self, status, crc):
+        """Frame format for MODE3's STATENB and CRCENB. The command header
+        is 2 bytes, or 4 with CRC (command, argument, CRC, pad). RDATA data
+        follows the header and the STATUS byte, and is followed by its CRC."""
+        self.status_enabled = bool(status)
+        self.crc_enabled = bool(crc)
+        self.header = 4 if crc else 2
+        self.data_at = self.header + (1 if status else 0)
+        self.rdata_size = self.data_at + 3 + (1 if crc else 0)
+        self.rreg_frame = bytearray(self.header + (2 if crc else 1))
+        self.wreg_frame = bytearray(4 if crc else 5)
+        self.reg_rbuf = bytearray(6 if crc else 5)
+        self.rreg_r = memoryview(self.reg_rbuf)[:len(self.rreg_frame)]
+        self.wreg_r = memoryview(self.reg_rbuf)[:len(self.wreg_frame)]
+
+    def _rreg(self, address, retries=3):
+        """One RREG frame; returns the register value. With CRC on, a value
+        that fails its CRC is counted and read again."""
+        frame = self.rreg_frame
+        frame[0] = 0x20 | address
+        if self.crc_enabled:
+            frame[2] = crc8(frame, 0, 2)
+        r = self.reg_rbuf
+        at = self.header
+        for _ in range(retries):
+            self.spi.write_readinto(frame, self.rreg_r)
+            if not self.crc_enabled or crc8(r, at, 1) == r[at + 1]:
+                return r[at]
+            self.crc_errors += 1
+        raise OSError("CRC error reading register 0x%02x" % address)
+
+    def _wreg(self, address, value):
+        """One WREG frame. A write to MODE3 switches the frame format for
+        the frames after it."""
+        frame = self.wreg_frame
+        frame[0] = 0x40 | address
+        frame[1] = value
+        if self.crc_enabled:
+            frame[2] = crc8(frame, 0, 2)
+        self.spi.write_readinto(frame, self.wreg_r)
+        if address == 0x5:
+            self._layout(value & 0x40, value & 0x20)
+
+    def _address(self, register):
+        return self.registerAddress[register.upper()] if isinstance(register, str) else register
+
+    def read_register(self, register_location):
+        """Takes the register location. Reads the register from the ADS1261
+        (one RREG frame) and refreshes the shadow with it, unless a write to it
+        is pending. Returns the value in the read register. The frame carries
+        a CRC when integrity() turned CRCs on."""
+        address = self._address(register_location)
+        value = self._rreg(address)
+        if not self.dirty & (1 << address):
+            self.shadow[address] = value
+            self.unknown &= ~(1 << address)
+        return value
 
     def write_register(self, register_location, register_data):
-        # expects to see register_location as a human readable string
-        register_location = register_location.upper()
-        # expects to see register_data as a binary string
-        if not isinstance(register_data, str):
-            register_data = self.d2b(register_data)
-        read_message = [self.commandByte1["WREG"][0] + self.registerAddress[register_location], int(register_data, 2), 0, 0, 0]
-        self.send(read_message)
-        # write_check = self.send(read_message)
-        # if write_check[1] == read_message[0]:
-        #     self.read_register(register_location)  # Seems to read the old value?
-        #     _read = self.read_register(
-        #         register_location
-        #     )  # Seems to read the new (correct) value. Delay?
-        #     if _read == -1:
-        #         print("Read back failed. Requires write_register review.")
-        #         print(_read, read_message)
-        #     elif _read == int(register_data, 2):
-        #         return 0
-        #     elif register_location.upper() == "STATUS":
-        #         pass
-        #     else:
-        #         print(
-        #             "Unexplained fail regarding writing to a register. Read back was unexpected."
-        #         )
-        #         print(
-        #             "Register Location:",
-        #             register_location,
-        #             "- Read back:",
-        #             self.read_register(register_location),
-        #             "- Written/sent back:",
-        #             write_check,
-        #             "- Data sent:",
-        #             int(register_data, 2),
-        #         )
-        #         print("Error:", _read, register_data)
-        #         pass
-        # else:
-        #     print("Error writing register - failed WREG command")
-        #     print("DIN [0]:", read_message, "- DOUT [1]:", write_check)
-        #     print(
-        #         "Have you enabled setup_measurements() before running this WREG command?"
-        #     )
+        """Write a register straight away, whether or not it changed.
+        register_location is a name or address, register_data an int or a
+        binary string."""
+        address = self._address(register_location)
+        if isinstance(register_data, str):
+            register_data = int(register_data, 2)
+        self.shadow[address] = register_data
+        self.dirty &= ~(1 << address)
+        self.unknown &= ~(1 << address)
+        self._wreg(address, register_data)
+
+    def register(self, register_location, verify=False):
+        """Register value from the shadow. STATUS and ID, registers never
+        read or written, and verify=True go to the ADS1261."""
+        address = self._address(register_location)
+        if verify or address in self.volatile_registers or self.unknown & (1 << address):
+            return self.read_register(address)
+        return self.shadow[address]
+
+    def set_register(self, register_location, value):
+        """Change the shadow only; commit() sends it if it changed."""
+        address = self._address(register_location)
+        bit = 1 << address
+        if value != self.shadow[address] or self.unknown & bit:
+            self.shadow[address] = value
+            self.dirty |= bit
+
+    def field(self, name, verify=False):
+        address, mask, shift = self.fields[name]
+        return (self.register(address, verify) & mask) >> shift
+
+    def set_field(self, name, value):
+        address, mask, shift = self.fields[name]
+        self.set_register(address, (self.shadow[address] & ~mask) | ((value << shift) & mask))
+
+    def commit(self):
+        """Write all dirty registers, one WREG frame each. Returns the number
+        of frames sent."""
+        dirty = self.dirty
+        address = frames = 0
+        while dirty:
+            if dirty & 1:
+                self._wreg(address, self.shadow[address])
+                self.unknown &= ~(1 << address)
+                frames += 1
+            dirty >>= 1
+            address += 1
+        self.dirty = 0
+        return frames
+
+    def sync(self):
+        """Read every register into the shadow (drops pending changes), in
+        one chained transfer. Returns the addresses whose known shadow value
+        was wrong."""
+        batch = self.batch([self.rreg_bytes(a) for a in range(len(self.shadow))])
+        views = batch.run()
+        stale = []
+        at = self.header
+        for address in range(len(self.shadow)):
+            if self.crc_enabled and crc8(views[address], at, 1) != views[address][at + 1]:
+                self.crc_errors += 1
+                raise OSError("CRC error reading register 0x%02x" % address)
+            value = views[address][at]
+            known = not self.unknown & (1 << address)
+            if known and address not in self.volatile_registers and value != self.shadow[address]:
+                stale.append(address)
+            self.shadow[address] = value
+        self.dirty = 0
+        self.unknown = 0
+        return stale
+
+    # Whole command frames, in the current format, for chaining with batch().
+    # DOUT echoes the command one byte late: a frame's result is at
+    # [self.header:] (RDATA data at [self.data_at:]).
+
+    def _command(self, command, argument=0, payload=0):
+        frame = bytearray(self.header + payload)
+        frame[0] = command
+        frame[1] = argument
+        if self.crc_enabled:
+            frame[2] = crc8(frame, 0, 2)
+        return bytes(frame)
+
+    def rdata_bytes(self):
+        return self._command(self.commandByte1["RDATA"][0], 0, self.rdata_size - self.header)
+
+    def rreg_bytes(self, register_location):
+        return self._command(self.commandByte1["RREG"][0] | self._address(register_location), 0,
+                             2 if self.crc_enabled else 1)
+
+    def wreg_bytes(self, register_location, value):
+        return self._command(self.commandByte1["WREG"][0] | self._address(register_location), value)
+
+    def batch(self, frames):
+        """Chain frames into one buffer sent as a single SPI transfer; see
+        Batch. WREGs sent this way bypass the register shadow."""
+        return Batch(self.spi, frames)
 
     def choose_inputs(self, positive, negative="VCOM"):
-        input_pins = (
-            int(self.INPMUXregister[positive] << 4) + self.INPMUXregister[negative]
-        )
-        return self.write_register("INPMUX", self.d2b(input_pins))
+        self.set_field("MUXP", self.INPMUXregister[positive])
+        self.set_field("MUXN", self.INPMUXregister[negative])
+        self.commit()
         # self.check_inputs()
 
-    def check_inputs(self):
-        read = self.read_register("INPMUX")
+    def check_inputs(self, verify=False):
+        read = self.register("INPMUX", verify)
         print(
             "Input polarity check --- Positive side:",
-            self.inv_INPMUXregister[int(self.d2b(read)[:4], 2)],
+            self.inv_INPMUXregister[read >> 4],
             "- Negative side:",
-            self.inv_INPMUXregister[int(self.d2b(read)[4:], 2)],
+            self.inv_INPMUXregister[read & 0x0F],
         )
 
     def set_frequency(self, data_rate=20, digital_filter="FIR", print_freq=True):
         data_rate = float(data_rate)  # just to ensure we remove any other data types (e.g. strings)
         digital_filter = digital_filter.lower()  # to ensure dictionary matching
-        rate_filter = int(self.available_data_rates[data_rate] << 3) + int(self.available_digital_filters[digital_filter])
-        self.write_register("MODE0", self.d2b(rate_filter))
+        self.set_field("DR", self.available_data_rates[data_rate])
+        self.set_field("FILTER", self.available_digital_filters[digital_filter])
+        self.commit()
         # return self.check_frequency(print_freq=print_freq)
 
-    def check_frequency(self, print_freq=True):
-        read = self.read_register("MODE0")
-        data_rate = self.inv_available_data_rates[int(self.d2b(read)[:5], 2)]
-        digital_filter = self.inv_available_digital_filters[int(self.d2b(read)[5:], 2)]
+    def check_frequency(self, print_freq=True, verify=False):
+        read = self.register("MODE0", verify)
+        data_rate = self.inv_available_data_rates[read >> 3]
+        digital_filter = self.inv_available_digital_filters[read & 0x07]
         if print_freq is True:
             print(
                 "Data rate and digital filter --- Data rate:",
@@ -370,144 +578,103 @@ class ADC1261:
             print("Register sent:", ID, "\nRegister received:", hex_checkID)
 
     def clear_status(self, CRCERR=0, RESET=0):
-        send_status = 0
-        CRCERR = CRCERR << 6
-        send_status = send_status + CRCERR + RESET
-        self.write_register("STATUS", self.d2b(send_status))
+        self.write_register("STATUS", (CRCERR << 6) | RESET)
         return self.check_status()
 
     def check_status(self):
+        """STATUS bits, MSB first: LOCK, CRCERR, PGAL_ALM, PGAH_ALM,
+        REFL_ALM, DRDY, CLOCK, RESET. Always read from the ADS1261."""
         read = self.read_register("STATUS")
-        byte_string = list(map(int, self.d2b(read)))
-        print("Status byte string:", byte_string)
-        (
-            LOCK_status,
-            CRCERR_status,
-            PGAL_ALM_status,
-            PGAH_ALM_status,
-            REFL_ALM_status,
-            DRDY_status,
-            CLOCK_status,
-            RESET_status,
-        ) = byte_string
         return (
-            LOCK_status,
-            CRCERR_status,
-            PGAL_ALM_status,
-            PGAH_ALM_status,
-            REFL_ALM_status,
-            DRDY_status,
-            CLOCK_status,
-            RESET_status,
+            read >> 7,
+            (read >> 6) & 1,
+            (read >> 5) & 1,
+            (read >> 4) & 1,
+            (read >> 3) & 1,
+            (read >> 2) & 1,
+            (read >> 1) & 1,
+            read & 1,
         )
 
     def mode1(self, CHOP="normal", CONVRT="continuous", DELAY="50us"):
         # CHOP = 'normal', 'chop', '2-wire ac-excitation', or '4-wire ac-excitation'
         # CONVRT = 'continuous' or 'pulse'
         # DELAY = '0us', '50us', '59us', '67us', '85us', '119us','189us', '328us','605us','1.16ms','2.27ms','4.49ms','8.93ms', or '17.8ms'
-        [CHOP, CONVRT, DELAY] = [
-            CHOP.lower(),
-            CONVRT.lower(),
-            DELAY.lower(),
-        ]  # formatting
-        send_mode1 = (
-            self.mode1register[CHOP]
-            + self.mode1register[CONVRT]
-            + self.mode1register[DELAY]
+        self.set_register(
+            "MODE1",
+            self.mode1register[CHOP.lower()]
+            + self.mode1register[CONVRT.lower()]
+            + self.mode1register[DELAY.lower()],
         )
-        send_mode1 = self.d2b(send_mode1)
-        self.write_register("MODE1", send_mode1)
+        self.commit()
         # return self.check_mode1()
 
-    def check_mode1(self):
-        read = self.read_register("MODE1")
-        byte_string = list(map(int, self.d2b(read)))
-        chop_bits = int("".join(map(str, byte_string[1:3])), 2) << 5
-        convrt_bits = int(str(byte_string[3]), 2) << 4
+    def check_mode1(self, verify=False):
+        read = self.register("MODE1", verify)
+        chop_bits = read & 0x60
+        convrt_bits = read & 0x10
         CHOP = "normal" if chop_bits == 0 else self.inv_mode1register[chop_bits]
-        CONVRT = (
-            "continuous"
-            if convrt_bits == 0
-            else self.inv_mode1register[int(str(byte_string[3]), 2) << 4]
-        )
-        DELAY = self.inv_mode1register[int("".join(map(str, byte_string[4:])), 2)]
+        CONVRT = "continuous" if convrt_bits == 0 else self.inv_mode1register[convrt_bits]
+        DELAY = self.inv_mode1register[read & 0x0F]
         return CHOP, CONVRT, DELAY
 
     def mode3(
         self, PWDN=0, STATENB=0, CRCENB=0, SPITIM=0, GPIO3=0, GPIO2=0, GPIO1=0, GPIO0=0
     ):
-        send_mode3 = [PWDN, STATENB, CRCENB, SPITIM, GPIO3, GPIO2, GPIO1, GPIO0]
-        send_mode3 = "".join(map(str, send_mode3))
-        self.write_register("MODE3", send_mode3)
+        self.set_register(
+            "MODE3",
+            PWDN << 7 | STATENB << 6 | CRCENB << 5 | SPITIM << 4
+            | GPIO3 << 3 | GPIO2 << 2 | GPIO1 << 1 | GPIO0,
+        )
+        self.commit()
         self.check_mode3()
 
-    def check_mode3(self):
-        read = self.read_register("MODE3")
-        try:
-            byte_string = list(map(int, self.d2b(read)))
-            (
-                PWDN_status,
-                STATENB_status,
-                CRCENB_status,
-                SPITIM_status,
-                GPIO3_status,
-                GPIO2_status,
-                GPIO1_status,
-                GPIO0_status,
-            ) = byte_string
-            return (
-                PWDN_status,
-                STATENB_status,
-                CRCENB_status,
-                SPITIM_status,
-                GPIO3_status,
-                GPIO2_status,
-                GPIO1_status,
-                GPIO0_status,
-            )
-        except Exception as e:
-            print(e)
-            print(type(read), read)
+    def integrity(self, status=True, crc=True):
+        """Turn the STATUS byte and the CRC on RDATA and on every command
+        (MODE3 STATENB and CRCENB) on or off, keeping the other MODE3 bits.
+        The frames after this one use the new format (see _layout). Raises
+        OSError if MODE3 does not read back as written."""
+        self.set_field("STATENB", int(bool(status)))
+        self.set_field("CRCENB", int(bool(crc)))
+        self.commit()
+        expected = self.shadow[0x5]
+        value = self.read_register("MODE3")
+        if value != expected:
+            raise OSError("MODE3 reads back 0x%02x, not 0x%02x" % (value, expected))
+        return self.check_mode3()
+
+    def check_mode3(self, verify=False):
+        """MODE3 bits, MSB first: PWDN, STATENB, CRCENB, SPITIM, GPIO3..GPIO0."""
+        read = self.register("MODE3", verify)
+        return tuple((read >> bit) & 1 for bit in range(7, -1, -1))
 
     def PGA(self, BYPASS=0, GAIN=1):
         # BYPASS can be 0 (PGA mode (default)) or 1 (PGA  bypass).
-        send_PGA = int(BYPASS << 7) + int(self.available_gain[GAIN])
-        send_PGA = self.d2b(send_PGA)
-        self.write_register("PGA", send_PGA)
+        self.set_register("PGA", (BYPASS << 7) | self.available_gain[GAIN])
+        self.commit()
         return self.check_PGA()
 
-    def check_PGA(self):
-        read = self.read_register("PGA")
-        byte_string = list(map(int, self.d2b(read)))
-        BYPASS_status = 0 if byte_string[0] == 0 else 1
-        gain = self.inv_available_gain[int("".join(map(str, byte_string[5:])), 2)]
-        return BYPASS_status, gain
+    def check_PGA(self, verify=False):
+        read = self.register("PGA", verify)
+        return read >> 7, self.inv_available_gain[read & 0x07]
 
     def reference_config(self, reference_enable=0, RMUXP="AVDD", RMUXN="AVSS"):
         # Note: Bit shifting not required when referencing dictionary (already happens at the dictionary level).
         # reference_enable must be 0 (disabled) or 1 (enabled)
         # RMUXP is the reference positive side, can be "Internal Positive", "AVDD", "AIN0", or "AIN2"
         # RMUXN is the reference negative side, can be "Internal Negative", "AVSS", "AIN1", or "AIN3"
-        send_ref_config = (
-            int(reference_enable << 4)
+        self.set_register(
+            "REF",
+            (reference_enable << 4)
             + self.available_reference[RMUXP]
-            + self.available_reference[RMUXN]
+            + self.available_reference[RMUXN],
         )
-        send_ref_config = self.d2b(send_ref_config)
-        self.write_register("REF", send_ref_config)
+        self.commit()
         return self.check_reference_config()
 
-    def check_reference_config(self):
-        read = self.read_register("REF")
-        byte_string = list(map(int, self.d2b(read)))
-        ref_enable_status = 0 if byte_string[3] == 0 else 1
-        RMUXP_status = self.inv_available_reference[
-            int("".join(map(str, byte_string[4:6])), 2) << 2
-        ]
-        RMUXN_status = self.inv_available_reference[
-            int("".join(map(str, byte_string[6:])), 2)
-        ]
-        return ref_enable_status, RMUXP_status, RMUXN_status
+    def check_reference_config(self, verify=False):
+        read = self.register("REF", verify)
+        return (read >> 4) & 1, self.RMUXP_names[(read >> 2) & 0x03], self.RMUXN_names[read & 0x03]
 
     def calibration(self, calibration="SFOCAL"):
         # User offset calibration not implemented.
@@ -526,6 +693,10 @@ class ADC1261:
         self.rst.off()
         time.sleep(0.1)
         self.rst.on()
+        self.shadow[:] = self.reset_values
+        self.dirty = 0
+        self.unknown = 0x1  # ID
+        self._layout(False, False)
         return 0
 
     def syocal(self):
@@ -552,11 +723,14 @@ class ADC1261:
         self.send(start_message)
         return 0
 
-    def median(_list):
-        if len(_list) % 2 == 0:
-            return (_list[int(len(_list)/2 - 1)] + _list[int(len(_list)/2)]) / 2
-        else:
-            return _list[int(len(_list) / 2)]
+    @staticmethod
+    def median(values):
+        """ Median of a list of samples (for streams see decimate). """
+        s = sorted(values)
+        half = len(s) // 2
+        if len(s) % 2 == 0:
+            return (s[half - 1] + s[half]) / 2
+        return s[half]
 
     def status(self, status_byte):
         (
@@ -582,9 +756,13 @@ class ADC1261:
     ):
         # ~ Choose to use hardware or software polling (pg 51 & 79 of ADS1261 datasheet)
         # ~ Based on Figure 101 in ADS1261 data sheet
+        # The frame format follows integrity(); status and crc are kept for
+        # old callers. A frame that fails its CRC or carries an alarm
+        # (ALARMS) is counted in self.frame_errors and an error returned.
         i = 0
-        # rdata = [0x12, 0, 0, 0, 0, 0, 0, 0, 0]
-        read  = bytearray(5)
+        rdata = self.rdata_bytes()
+        read = bytearray(len(rdata))
+        at = self.data_at
         # self.start1() # remove this if necessary.
         if method.lower() == "hardware":
             response = -1
@@ -593,27 +771,15 @@ class ADC1261:
                     print("Have you run start1()?")
                 try:
                     if not self.drdy.value():
-                        self.spi.write_readinto(b'\x12\x00\x00\x00\x00', read)
-                        if status != "disabled" and crc == "disabled":
-                            status_byte = self.d2b(read[2])
-                            if (
-                                status_byte[2] == 1
-                                or status_byte[3] == 1
-                                or read[3:6] == [127, 255, 255]
-                                or read[3:6] == [128, 0, 0]
-                            ):
-                                print("Error. PGA Alarm.", self.check_status())
-                                return "Error. PGA alarm."
-                            else:
-                                response = self.convert_to_mV(
-                                    read[3:6], reference=reference, gain=gain
-                                )
-                        elif status == "disabled" and crc == "disabled":
-                            response = self.convert_to_mV(
-                                read[2:5], reference=reference, gain=gain
-                            )
-                        else:
-                            pass
+                        self.spi.write_readinto(rdata, read)
+                        error = self.frame_error(read)
+                        if error == BAD_CRC:
+                            return "Error. CRC mismatch."
+                        elif error:
+                            return "Error. Alarm 0x%02x." % error
+                        response = self.convert_to_mV(
+                            read[at:at + 3], reference=reference, gain=gain
+                        )
                         if response not in [None, "None"]:
                             response = float(response)
                             return response
@@ -646,8 +812,10 @@ class ADC1261:
                     ) = self.check_status()
                     if DRDY_status == 1:
                         read = self.send(rdata)
+                        if self.frame_error(read):
+                            return "Error. Bad frame."
                         response = self.convert_to_mV(
-                            read[2:5], reference=reference, gain=gain
+                            read[at:at + 3], reference=reference, gain=gain
                         )
                         return response
                     else:
@@ -663,15 +831,287 @@ class ADC1261:
                 "Missing method to collect measurement. Please select either 'hardware' or 'software'."
             )
 
+    def frame_error(self, frame, alarms=ALARMS):
+        """check() an RDATA frame in the current format: 0 if good, else
+        BAD_CRC or the alarm bits, counted in self.frame_errors."""
+        n = self.data_at + 3 - self.header if self.crc_enabled else 0
+        error = check(frame, self.header, n, alarms if self.status_enabled else 0)
+        if error:
+            self.frame_errors += 1
+        return error
+
     def convert_to_mV(self, array, reference=5000, gain=1):
-        MSB, MID, LSB = array
-        bit24 = (MSB << 16) + (MID << 8) + LSB
-        if MSB > 127:  # i.e. signed negative
-            bits_from_fullscale = 2 ** 24 - bit24
-            mV = -bits_from_fullscale * reference / (gain * 2 ** 23)
+        """One conversion (MSB, MID, LSB) in mV. See codec for decoding
+        many samples and scaling once per window."""
+        return codec.to_mV(array, reference, gain)
+
+
+class Batch:
+    """Several command frames chained into one buffer and clocked out in a
+    single write_readinto. That saves the per-call driver overhead, which
+    is most of the cost of a short frame. After run(), views[i] holds the
+    DOUT bytes of frame i (result from [2], as for a lone frame).
+
+    The ADS1261 decodes frames back to back, but a command only takes
+    effect when its frame ends. Put RDATA before a WREG that restarts the
+    conversion, not after it.
+    """
+
+    def __init__(self, spi, frames):
+        size = 0
+        for frame in frames:
+            size += len(frame)
+        self.wbuf = bytearray(size)
+        self.rbuf = bytearray(size)
+        self.wri = spi.write_readinto
+        wmv, rmv = memoryview(self.wbuf), memoryview(self.rbuf)
+        self.frames = []
+        self.views = []
+        offset = 0
+        for frame in frames:
+            n = len(frame)
+            self.wbuf[offset:offset + n] = frame
+            self.frames.append(wmv[offset:offset + n])
+            self.views.append(rmv[offset:offset + n])
+            offset += n
+
+    def run(self):
+        self.wri(self.wbuf, self.rbuf)
+        return self.views
+
+
+class DrdyCapture:
+    """Reads exactly one conversion per DRDY falling edge.
+
+    The IRQ handler issues a single RDATA into a preallocated frame, so no
+    SPI time is spent on blind reads and nothing is allocated per sample.
+    The latest frame is left in self.rmv in the same layout as a plain RDATA
+    (FFh, 12h, MSB, MID, LSB) so codec.code(rmv, 2) can be used on it
+    (codec.code(rmv, data_at) in verified mode, below).
+    If a ringbuffer.SampleRing is given, every conversion is also pushed to
+    it with a ticks_us timestamp and the channel ID passed to switch().
+
+    Counters:
+    conversions - conversions read by the IRQ handler.
+    missed      - conversions overwritten before the consumer took them.
+    duplicates  - takes that got no new conversion (timeout), i.e. the
+                  previous frame was handed out again.
+    discarded   - conversions dropped because the input was switched.
+    chained     - conversions read in the same transfer as the next switch.
+
+    arm() chains the next input switch onto the RDATA of the coming
+    conversion: the IRQ sends [RDATA][WREG...] as one transfer, tags the
+    sample with the old channel and then moves to the new one. This saves
+    a whole SPI call per channel visit (see scanplan.Scanner).
+
+    Verified mode: with STATUS or CRC on (ADC1261.integrity(), set before
+    the capture and the scan plan are made) the frame is the adc's RDATA
+    frame, and the IRQ check()s every frame in place before it goes to
+    the ring. A frame that fails is not pushed; it only counts:
+    crc_errors     - frames whose CRC did not match (corrupted on the bus).
+    alarms         - conversions taken under a STATUS bit in alarm_mask
+                     (default ALARMS: PGA over- or under-range, low
+                     reference); alarm_bits ORs together the bits seen.
+    command_errors - frames read while STATUS CRCERR was set, i.e. after
+                     the ADS1261 rejected a command (a switch may not have
+                     happened) and until clear_status(CRCERR=0).
+    valid tells whether the last frame passed. The checks cost one viper
+    call per conversion, and nothing is printed or allocated.
+
+    With profile set to an instrument.Histograms before start(), the IRQ
+    goes through a timed handler that counts its own run time (the
+    transfer and ring push, stage 'spi') and the DRDY to DRDY interval
+    ('conversion'). Without one the plain handler runs untouched.
+    """
+
+    def __init__(self, adc, frame=None, ring=None, alarm_mask=ALARMS):
+        self.adc = adc
+        self.shadow = adc.shadow
+        self.ring = ring
+        self.channel = 0
+        self.wri = adc.spi.write_readinto
+        if frame is None:
+            frame = adc.rdata_bytes()
+        self.wmv = memoryview(bytes(frame))
+        self.rbuf = bytearray(len(frame))
+        self.rmv = memoryview(self.rbuf)
+        self.reserved = False  # a reserve() view is out, rbuf stays put
+        self.imv = memoryview(bytearray(5))
+        self.ready = False
+        self.conversions = 0
+        self.missed = 0
+        self.duplicates = 0
+        self.discarded = 0
+        self.chained = 0
+        self.chain = None  # armed [RDATA][switch] frame, its read view, next channel
+        self.chain_r = None
+        self.chain_channel = 0
+        self.chain_level = -1
+        self.current_pin = None
+        # verified mode: STATUS at check_at (or the data, without it), the
+        # CRC over the check_n bytes from there, and the STATUS bits to test
+        self.data_at = adc.data_at
+        self.verified = adc.status_enabled or adc.crc_enabled
+        self.check_at = adc.header
+        self.check_n = adc.data_at + 3 - adc.header if adc.crc_enabled else 0
+        self.alarm_mask = alarm_mask
+        self.check_mask = (alarm_mask | CRCERR) if adc.status_enabled else 0
+        self.valid = True
+        self.crc_errors = 0
+        self.alarms = 0
+        self.alarm_bits = 0
+        self.command_errors = 0
+        # bind once; binding in the IRQ allocates
+        self._handler = self._on_drdy_verified if self.verified else self._on_drdy
+        self._timed = self._on_drdy_timed
+        self.profile = None
+        self.last_drdy = 0
+
+    def start(self):
+        self.ready = False
+        self.last_drdy = time.ticks_us()
+        handler = self._handler if self.profile is None else self._timed
+        self.adc.drdy.irq(handler=handler, trigger=Pin.IRQ_FALLING)
+
+    def stop(self):
+        self.adc.drdy.irq(handler=None)
+
+    def _on_drdy(self, pin):
+        chain = self.chain
+        if chain is None:
+            self.wri(self.wmv, self.rmv)
+        else:
+            if self.chain_level >= 0:
+                self.current_pin(self.chain_level)
+            self.wri(chain, self.chain_r)
+            self.chain = None
+            self.chained += 1
+        if self.ring is not None:
+            self.ring.put_frame(self.rbuf, time.ticks_us(), self.channel)
+        if chain is not None:
+            self.channel = self.chain_channel
+        if self.ready:
+            self.missed += 1
+        self.ready = True
+        self.conversions += 1
+
+    def _on_drdy_verified(self, pin):
+        chain = self.chain
+        if chain is None:
+            self.wri(self.wmv, self.rmv)
         else:
-            mV = bit24 * reference / (gain * 2 ** 23)
-        return mV
+            if self.chain_level >= 0:
+                self.current_pin(self.chain_level)
+            self.wri(chain, self.chain_r)
+            self.chain = None
+            self.chained += 1
+        error = check(self.rbuf, self.check_at, self.check_n, self.check_mask)
+        self.valid = not error or self._fault(error)
+        if self.valid and self.ring is not None:
+            self.ring.put_frame(self.rbuf, time.ticks_us(), self.channel, self.data_at)
+        if chain is not None:
+            self.channel = self.chain_channel
+        if self.ready:
+            self.missed += 1
+        self.ready = True
+        self.conversions += 1
+
+    def _on_drdy_timed(self, pin):
+        start = time.ticks_us()
+        prof = self.profile
+        prof.add(instrument.CONVERSION, time.ticks_diff(start, self.last_drdy))
+        self.last_drdy = start
+        self._handler(pin)
+        prof.add(instrument.SPI, time.ticks_diff(time.ticks_us(), start))
+
+    def _fault(self, error):
+        """Count a failed check(). Returns True if the frame is still good
+        (CRCERR alone only flags the commands)."""
+        if error == BAD_CRC:
+            self.crc_errors += 1
+            return False
+        if error & CRCERR:
+            self.command_errors += 1
+        error &= self.alarm_mask
+        if error:
+            self.alarms += 1
+            self.alarm_bits |= error
+            return False
+        return True
+
+    def errors(self):
+        """(crc_errors, alarms, alarm_bits, command_errors)"""
+        return self.crc_errors, self.alarms, self.alarm_bits, self.command_errors
+
+    def reserve(self, size):
+        """A read view of `size` bytes over rbuf, for chained frames that
+        start with RDATA, so the data still lands at rbuf[data_at:]. rbuf
+        only grows before the first view is handed out: views already
+        issued would keep reading into the old buffer, so reserve the
+        longest chain first."""
+        if size > len(self.rbuf):
+            if self.reserved:
+                raise ValueError('chain of %d bytes after views of %d were issued'
+                                 % (size, len(self.rbuf)))
+            rbuf = bytearray(size)
+            rbuf[:len(self.rbuf)] = self.rbuf
+            self.rbuf = rbuf
+            self.rmv = memoryview(rbuf)[:len(self.wmv)]
+        self.reserved = True
+        return memoryview(self.rbuf)[:size]
+
+    def arm(self, chain, rview, channel, level=-1):
+        """Send `chain` (RDATA then switch frames, with a reserve()d read
+        view) on the next DRDY and move on to `channel`, setting the
+        excitation pin to `level` first if it is not negative."""
+        self.chain_r = rview
+        self.chain_channel = channel
+        self.chain_level = level
+        self.chain = chain
+
+    def disarm(self):
+        """Cancel an armed chain. Returns True if it had not fired yet."""
+        state = disable_irq()
+        armed = self.chain is not None
+        self.chain = None
+        enable_irq(state)
+        return armed
+
+    def switch(self, inpmux, channel=0, rbuf=None):
+        """Write an INPMUX frame (see datalogger.input_bytes), or any chain
+        of WREG frames with a same-sized rbuf (see scanplan). The ADS1261
+        restarts the conversion, and anything read before this returns
+        belongs to the old input."""
+        if len(inpmux):
+            self.wri(inpmux, self.imv if rbuf is None else rbuf)
+            if inpmux[0] == 0x51:
+                self.shadow[0x11] = inpmux[1]  # keep the ADC1261 register shadow current
+        self.channel = channel
+        if self.ready:
+            self.discarded += 1
+        self.ready = False
+
+    def wait(self, timeout_us=500000):
+        """Wait for a new conversion and return the frame view."""
+        start = time.ticks_us()
+        while not self.ready:
+            if time.ticks_diff(time.ticks_us(), start) > timeout_us:
+                self.duplicates += 1
+                return self.rmv
+        self.ready = False
+        return self.rmv
+
+    def measure(self, inpmux, channel=0, timeout_us=500000):
+        """Switch input and return the first settled conversion on it."""
+        self.switch(inpmux, channel)
+        return self.wait(timeout_us)
+
+    def code(self):
+        """The last frame as a signed 24-bit integer."""
+        r = self.rbuf
+        at = self.data_at
+        code = (r[at] << 16) | (r[at + 1] << 8) | r[at + 2]
+        return code - 0x1000000 if code & 0x800000 else code
 
 
 def main():
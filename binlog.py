@@ -0,0 +1,502 @@
+""" Compact binary log format for the datalogger, plus a host-side decoder.
+
+A file is one header followed by fixed-size little-endian records of a
+single type. Nothing is formatted as text on the ESP32: raw codes and
+integer sums are packed with struct and scaled to mV by the decoder.
+
+Header (version 2):
+    '<4sBBHHBBBxfI' magic b'ADSL', version, record type, header size,
+                    record size, channels, MODE0, MODE1, pad,
+                    reference (mV), start time (s, device clock)
+    then per channel '<BBB' INPMUX positive, INPMUX negative, PGA gain
+    then, for SPECTRUM logs, per bin '<Bf' channel, nominal frequency (Hz)
+
+MODE0 holds the data rate and digital filter codes and MODE1 the chop,
+conversion mode and delay codes, exactly as written to the ADS1261.
+
+Record types:
+    RAW    '<II'  ticks_us, channel << 24 | 24-bit two's complement code
+    WINDOW '<Q' + per channel '<Iq'
+                  µs since start, then sample count and sum of raw codes
+    MOMENTS '<Q' + per channel '<IqQ'
+                  as WINDOW plus the sum of squared raw codes, so the
+                  noise is exact too (see moments); good for 2**18
+                  full-scale samples per channel and window
+    STATS  '<Q' + per channel '<IqQiii'
+                  as MOMENTS plus the minimum, maximum and last raw code
+    SPECTRUM '<Q' + per bin '<Ifff'
+                  µs since start, then sample count, frequency analysed
+                  (Hz), peak amplitude (codes) and phase (rad), see spectrum
+    LOCKIN '<Q' + per channel '<IqQIqQ'
+                  µs since start, then count, sum and sum of squares of the
+                  raw codes in the forward and then the reverse excitation
+                  phase, see lockin
+    TIMING '<Q' + per stage '<III20I'
+                  µs since start, then count, total and longest duration
+                  (µs) and the 20 log2 bucket counts of each of
+                  TIMING_STAGES over the window, see instrument
+
+Windowed records are stamped when the window closes, in µs since the start
+of the run (scheduler.Clock), so the stamp survives the ticks_us wrap.
+Version 1 logs stamped them '<I' in ms; the decoder reads both and gives
+the stamp in ms either way.
+
+Decoding on a PC (numpy is optional):
+    python binlog.py data.bin > data.csv
+    header, columns = binlog.to_numpy('data.bin')
+"""
+
+import math
+import struct
+
+import codec
+from codec import signed24
+
+MAGIC = b'ADSL'
+VERSION = 2
+
+RAW = 1
+WINDOW = 2
+MOMENTS = 3
+STATS = 4
+SPECTRUM = 5
+LOCKIN = 6
+TIMING = 7
+
+HEADER = '<4sBBHHBBBxfI'
+HEADER_SIZE = struct.calcsize(HEADER)
+CHANNEL = '<BBB'
+CHANNEL_SIZE = struct.calcsize(CHANNEL)
+BIN = '<Bf'
+BIN_SIZE = struct.calcsize(BIN)
+RAW_RECORD = '<II'
+RAW_SIZE = struct.calcsize(RAW_RECORD)
+WINDOW_STAMP = '<Q'  # µs since start
+WINDOW_STAMP_SIZE = struct.calcsize(WINDOW_STAMP)
+WINDOW_STAMPS = {1: '<I', 2: WINDOW_STAMP}  # per log version; version 1 in ms
+WINDOW_CHANNEL = '<Iq'
+WINDOW_CHANNEL_SIZE = struct.calcsize(WINDOW_CHANNEL)
+MOMENTS_CHANNEL = '<IqQ'
+MOMENTS_CHANNEL_SIZE = struct.calcsize(MOMENTS_CHANNEL)
+STATS_CHANNEL = '<IqQiii'
+STATS_CHANNEL_SIZE = struct.calcsize(STATS_CHANNEL)
+SPECTRUM_BIN = '<Ifff'
+SPECTRUM_BIN_SIZE = struct.calcsize(SPECTRUM_BIN)
+LOCKIN_CHANNEL = '<IqQIqQ'
+LOCKIN_CHANNEL_SIZE = struct.calcsize(LOCKIN_CHANNEL)
+TIMING_STAGES = ('spi', 'conversion', 'aggregate', 'flush', 'loop')
+TIMING_BUCKETS = 20
+TIMING_STAGE = '<III%dI' % TIMING_BUCKETS
+TIMING_STAGE_SIZE = struct.calcsize(TIMING_STAGE)
+# per-channel (per-bin for SPECTRUM) layout of the windowed record types
+WINDOW_CHANNELS = {WINDOW: WINDOW_CHANNEL, MOMENTS: MOMENTS_CHANNEL, STATS: STATS_CHANNEL,
+                   SPECTRUM: SPECTRUM_BIN, LOCKIN: LOCKIN_CHANNEL, TIMING: TIMING_STAGE}
+
+
+def window_size(n_channels, record_type=WINDOW):
+    return WINDOW_STAMP_SIZE + n_channels * struct.calcsize(WINDOW_CHANNELS[record_type])
+
+
+def moments_size(n_channels):
+    return window_size(n_channels, MOMENTS)
+
+
+def stats_size(n_channels):
+    return window_size(n_channels, STATS)
+
+
+def spectrum_size(n_bins):
+    return window_size(n_bins, SPECTRUM)
+
+
+def window_type(acc):
+    """ The windowed record type an accumulator packs into: its own
+    record_type (LOCKIN for a lockin.LockIn), else STATS (moments.Moments). """
+    return getattr(acc, 'record_type', STATS)
+
+
+def timing_size():
+    return window_size(len(TIMING_STAGES), TIMING)
+
+
+def record_size(record_type, n_channels):
+    """ A TIMING record has TIMING_STAGES whatever the channels. """
+    if record_type == TIMING:
+        return timing_size()
+    return RAW_SIZE if record_type == RAW else window_size(n_channels, record_type)
+
+
+def header(channels, record_type, reference_mV, mode0, mode1, started=0, bins=()):
+    """ channels is a list of (positive, negative, gain) where positive and
+    negative are INPMUX codes (ADC1261.INPMUXregister values). A SPECTRUM
+    log also takes its bins, a list of (channel, Hz). """
+    n = len(channels)
+    size = HEADER_SIZE + n * CHANNEL_SIZE + len(bins) * BIN_SIZE
+    out = bytearray(size)
+    struct.pack_into(HEADER, out, 0, MAGIC, VERSION, record_type, size,
+                     record_size(record_type, len(bins) if record_type == SPECTRUM else n),
+                     n, mode0, mode1, reference_mV, started)
+    offset = HEADER_SIZE
+    for positive, negative, gain in channels:
+        struct.pack_into(CHANNEL, out, offset, positive, negative, gain)
+        offset += CHANNEL_SIZE
+    for channel, hz in bins:
+        struct.pack_into(BIN, out, offset, channel, hz)
+        offset += BIN_SIZE
+    return bytes(out)
+
+
+def pack_raw(buf, offset, stamp, channel, code):
+    struct.pack_into(RAW_RECORD, buf, offset, stamp, (channel << 24) | (code & 0xFFFFFF))
+
+
+def pack_raws(buf, codes, stamps, channels, n):
+    """ Pack n samples (as drained from a ringbuffer.SampleRing) into buf.
+    Returns the number of bytes used. """
+    offset = 0
+    for k in range(n):
+        struct.pack_into(RAW_RECORD, buf, offset, stamps[k],
+                         (channels[k] << 24) | (codes[k] & 0xFFFFFF))
+        offset += RAW_SIZE
+    return offset
+
+
+def pack_window(buf, stamp_us, counts, sums):
+    struct.pack_into(WINDOW_STAMP, buf, 0, stamp_us)
+    offset = WINDOW_STAMP_SIZE
+    for c in range(len(counts)):
+        struct.pack_into(WINDOW_CHANNEL, buf, offset, counts[c], sums[c])
+        offset += WINDOW_CHANNEL_SIZE
+    return offset
+
+
+def pack_moments(buf, stamp_us, acc):
+    """ One MOMENTS record from a moments.Moments. """
+    struct.pack_into(WINDOW_STAMP, buf, 0, stamp_us)
+    offset = WINDOW_STAMP_SIZE
+    for c in range(acc.n):
+        struct.pack_into(MOMENTS_CHANNEL, buf, offset, acc.count(c), acc.total(c), acc.squares(c))
+        offset += MOMENTS_CHANNEL_SIZE
+    return offset
+
+
+def pack_stats(buf, stamp_us, acc):
+    """ One STATS record from a moments.Moments. """
+    struct.pack_into(WINDOW_STAMP, buf, 0, stamp_us)
+    offset = WINDOW_STAMP_SIZE
+    for c in range(acc.n):
+        struct.pack_into(STATS_CHANNEL, buf, offset, acc.count(c), acc.total(c), acc.squares(c),
+                         acc.minimum(c), acc.maximum(c), acc.last(c))
+        offset += STATS_CHANNEL_SIZE
+    return offset
+
+
+def pack_lockin(buf, stamp_us, lock):
+    """ One LOCKIN record from a lockin.LockIn. """
+    struct.pack_into(WINDOW_STAMP, buf, 0, stamp_us)
+    offset = WINDOW_STAMP_SIZE
+    for c in range(lock.n):
+        struct.pack_into(LOCKIN_CHANNEL, buf, offset, *(lock.phase(c, 1) + lock.phase(c, 0)))  # forward, reverse
+        offset += LOCKIN_CHANNEL_SIZE
+    return offset
+
+
+def pack_window_record(buf, stamp_us, acc):
+    """ The window's record for acc, of type window_type(acc). """
+    if window_type(acc) == LOCKIN:
+        return pack_lockin(buf, stamp_us, acc)
+    return pack_stats(buf, stamp_us, acc)
+
+
+def pack_spectrum(buf, stamp_us, spec):
+    """ One SPECTRUM record from a spectrum.Spectrum. """
+    struct.pack_into(WINDOW_STAMP, buf, 0, stamp_us)
+    offset = WINDOW_STAMP_SIZE
+    for j in range(spec.nbins):
+        struct.pack_into(SPECTRUM_BIN, buf, offset, spec.count(j), spec.frequency(j),
+                         spec.amplitude(j), spec.phase(j))
+        offset += SPECTRUM_BIN_SIZE
+    return offset
+
+
+def pack_timing(buf, stamp_us, hist):
+    """ One TIMING record from an instrument.Histograms. """
+    struct.pack_into(WINDOW_STAMP, buf, 0, stamp_us)
+    offset = WINDOW_STAMP_SIZE
+    for k in range(len(TIMING_STAGES)):
+        struct.pack_into(TIMING_STAGE, buf, offset, *(hist.stats(k) + tuple(hist.histogram(k))))
+        offset += TIMING_STAGE_SIZE
+    return offset
+
+
+def percentile_us(buckets, q):
+    """ Upper edge (µs) of the log2 bucket that holds the q quantile of a
+    TIMING histogram, 0 if it is empty. """
+    total = sum(buckets)
+    seen = 0
+    for k, count in enumerate(buckets):
+        seen += count
+        if count and seen >= q * total:
+            return 1 << k
+    return 0
+
+
+# ---- decoding (host side, but only needs struct)
+
+def read_header(f):
+    fixed = f.read(HEADER_SIZE)
+    if len(fixed) < HEADER_SIZE:
+        raise ValueError('file too short for a header')
+    (magic, version, record_type, size, rsize, n, mode0, mode1,
+     reference_mV, started) = struct.unpack(HEADER, fixed)
+    if magic != MAGIC:
+        raise ValueError('not a datalogger binary log')
+    if version > VERSION:
+        raise ValueError('log version %d is newer than this decoder' % version)
+    rest = f.read(size - HEADER_SIZE)
+    channels = [struct.unpack_from(CHANNEL, rest, k * CHANNEL_SIZE) for k in range(n)]
+    offset = n * CHANNEL_SIZE
+    bins = [struct.unpack_from(BIN, rest, offset + k * BIN_SIZE)
+            for k in range((len(rest) - offset) // BIN_SIZE)]
+    return {
+        'version': version,
+        'record_type': record_type,
+        'record_size': rsize,
+        'channels': channels,
+        'bins': bins,
+        'mode0': mode0,
+        'mode1': mode1,
+        'data_rate_code': mode0 >> 3,
+        'filter_code': mode0 & 0x07,
+        'reference_mV': reference_mV,
+        'started': started,
+    }
+
+
+def scale(header, channel):
+    """ mV per code for a channel. """
+    return codec.scale(header['reference_mV'], header['channels'][channel][2])
+
+
+def records(f, header):
+    """ Yield decoded records until the end of the file. A torn record at the
+    end (card pulled mid-write) is ignored. Window stamps are in ms, to
+    the µs from version 2 on.
+    RAW     -> (ticks_us, channel, code)
+    WINDOW  -> (ms, [(count, sum), ...])
+    MOMENTS -> (ms, [(count, sum, sum of squares), ...])
+    STATS   -> (ms, [(count, sum, sum of squares, min, max, last), ...])
+    LOCKIN  -> (ms, [(forward count, sum, squares, reverse count, sum, squares), ...])
+    SPECTRUM -> (ms, [(count, Hz, amplitude, phase), ...]) per bin
+    TIMING  -> (ms, [(count, total µs, max µs, bucket 0, ...), ...]) per stage """
+    size = header['record_size']
+    if header['record_type'] == TIMING:
+        n = len(TIMING_STAGES)
+    else:
+        n = len(header['bins'] if header['record_type'] == SPECTRUM else header['channels'])
+    layout = WINDOW_CHANNELS.get(header['record_type'])
+    step = struct.calcsize(layout) if layout else 0
+    stamp_layout = WINDOW_STAMPS[header['version']]
+    skip = struct.calcsize(stamp_layout)
+    per_ms = 1 if header['version'] < 2 else 1000
+    while True:
+        chunk = f.read(size)
+        if len(chunk) < size:
+            return
+        if header['record_type'] == RAW:
+            stamp, word = struct.unpack(RAW_RECORD, chunk)
+            yield stamp, word >> 24, signed24(word)
+        else:
+            stamp = struct.unpack_from(stamp_layout, chunk)[0]
+            yield (stamp / per_ms if per_ms > 1 else stamp,
+                   [struct.unpack_from(layout, chunk, skip + step * c) for c in range(n)])
+
+
+# per-channel CSV columns of the windowed record types
+COLUMNS = {WINDOW: ('mean',), MOMENTS: ('mean', 'noise'),
+           STATS: ('mean', 'noise', 'min', 'max', 'last'),
+           SPECTRUM: ('Hz', 'amplitude', 'phase'),
+           LOCKIN: ('difference', 'common', 'noise'),
+           TIMING: ('count', 'mean', 'p50', 'p99', 'max')}
+
+
+def channel_mV(values, mv_per_code):
+    """ One channel of a windowed record in mV: mean, then noise (standard
+    deviation) if the record has squares, then min, max and last if it has
+    those. NaN where the window has too few samples. """
+    nan = float('nan')
+    count, total = values[0], values[1]
+    out = [codec.mean_mV(total, count, mv_per_code) if count else nan]
+    if len(values) > 2:
+        out.append(codec.noise_mV(count, total, values[2], mv_per_code) if count > 1 else nan)
+    for code in values[3:]:
+        out.append(code * mv_per_code if count else nan)
+    return out
+
+
+def rows(path):
+    """ Header plus CSV-ready rows in mV.
+    RAW      -> ticks_us, channel, mV
+    SPECTRUM -> ms, then per bin Hz, peak amplitude mV and phase in degrees
+    LOCKIN   -> ms, then per channel the demodulated difference and common
+                mode and the pooled noise (codec.demodulate)
+    TIMING   -> ms, then per stage count, mean µs and the bucket edges (µs)
+                of the median and 99th percentile, then max µs
+    windowed -> ms, then COLUMNS[record type] per channel """
+    with open(path, 'rb') as f:
+        h = read_header(f)
+        scales = [scale(h, c) for c in range(len(h['channels']))]
+        for record in records(f, h):
+            if h['record_type'] == RAW:
+                stamp, channel, code = record
+                yield stamp, channel, code * scales[channel]
+            elif h['record_type'] == SPECTRUM:
+                stamp, bins = record
+                out = [stamp]
+                for (channel, _), (count, hz, amplitude, phase) in zip(h['bins'], bins):
+                    if count:
+                        out.extend((hz, amplitude * scales[channel], math.degrees(phase)))
+                    else:
+                        out.extend((float('nan'),) * 3)
+                yield tuple(out)
+            elif h['record_type'] == TIMING:
+                stamp, stages = record
+                out = [stamp]
+                for values in stages:
+                    count, total, longest = values[:3]
+                    out.extend((count, total / count if count else float('nan'),
+                                percentile_us(values[3:], 0.5), percentile_us(values[3:], 0.99),
+                                longest))
+                yield tuple(out)
+            elif h['record_type'] == LOCKIN:
+                stamp, channels = record
+                out = [stamp]
+                for c, values in enumerate(channels):
+                    if values[0] and values[3]:
+                        out.extend(codec.demodulate(values[:3], values[3:], scales[c]))
+                    else:
+                        out.extend((float('nan'),) * 3)
+                yield tuple(out)
+            else:
+                stamp, channels = record
+                out = [stamp]
+                for c, values in enumerate(channels):
+                    out.extend(channel_mV(values, scales[c]))
+                yield tuple(out)
+
+
+def _stamp_field(header):
+    return ('ms', '<u4') if header['version'] < 2 else ('us', '<u8')
+
+
+def _stamp_columns(header, data):
+    if header['version'] < 2:
+        return {'ms': data['ms']}
+    return {'us': data['us'], 'ms': data['us'] / 1000.0}
+
+
+def to_numpy(path):
+    """ Read a whole log into numpy arrays. Returns (header, columns) where
+    columns is a dict of arrays keyed by column name. Windowed logs have the
+    stamp in 'ms', and from version 2 also in 'us'. """
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        h = read_header(f)
+        body = f.read()
+    n = len(h['channels'])
+    usable = len(body) - len(body) % h['record_size']
+    scales = np.array([scale(h, c) for c in range(n)])
+    if h['record_type'] == RAW:
+        data = np.frombuffer(body[:usable], dtype='<u4').reshape(-1, 2)
+        channel = (data[:, 1] >> 24).astype(np.uint8)
+        code = codec.signed24_numpy(data[:, 1])
+        return h, {'ticks_us': data[:, 0], 'channel': channel, 'code': code,
+                   'mV': code * scales[channel]}
+    if h['record_type'] == SPECTRUM:
+        nb = len(h['bins'])
+        dtype = np.dtype([_stamp_field(h)] + [(f + str(j), t) for j in range(nb) for f, t in
+                                            (('count', '<u4'), ('Hz', '<f4'), ('amplitude', '<f4'), ('phase', '<f4'))])
+        data = np.frombuffer(body[:usable], dtype=dtype)
+        columns = _stamp_columns(h, data)
+        for j, (channel, _) in enumerate(h['bins']):
+            valid = data['count%d' % j] > 0
+            columns['count%d' % j] = data['count%d' % j]
+            columns['Hz%d' % j] = np.where(valid, data['Hz%d' % j], np.nan)
+            columns['amplitude_mV%d' % j] = np.where(valid, data['amplitude%d' % j] * scales[channel], np.nan)
+            columns['phase%d' % j] = np.where(valid, data['phase%d' % j], np.nan)
+        return h, columns
+    if h['record_type'] == TIMING:
+        fields = ('_count', '_total_us', '_max_us', '_buckets')
+        dtype = np.dtype([_stamp_field(h)] + [(name + f, '<u4', (TIMING_BUCKETS,) if f == '_buckets' else ())
+                                              for name in TIMING_STAGES for f in fields])
+        data = np.frombuffer(body[:usable], dtype=dtype)
+        columns = _stamp_columns(h, data)
+        for name in TIMING_STAGES:
+            for f in fields:
+                columns[name + f] = data[name + f]
+        return h, columns
+    if h['record_type'] == LOCKIN:
+        fields = [(p + f, t) for p in ('f', 'r') for f, t in
+                  (('count', '<u4'), ('sum', '<i8'), ('squares', '<u8'))]
+        dtype = np.dtype([_stamp_field(h)] + [(f + str(c), t) for c in range(n) for f, t in fields])
+        data = np.frombuffer(body[:usable], dtype=dtype)
+        columns = _stamp_columns(h, data)
+        for c in range(n):
+            for f, _ in fields:
+                columns[f + str(c)] = data[f + str(c)]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                forward = data['fsum%d' % c] / data['fcount%d' % c]
+                reverse = data['rsum%d' % c] / data['rcount%d' % c]
+            columns['difference_mV%d' % c] = (forward - reverse) / 2 * scales[c]
+            columns['common_mV%d' % c] = (forward + reverse) / 2 * scales[c]
+        return h, columns
+    names = ('count', 'sum', 'squares', 'min', 'max', 'last')
+    layout = WINDOW_CHANNELS[h['record_type']][1:]
+    fields = [(names[k], '<' + {'I': 'u4', 'q': 'i8', 'Q': 'u8', 'i': 'i4'}[t]) for k, t in enumerate(layout)]
+    dtype = np.dtype([_stamp_field(h)] + [(f + str(c), t) for c in range(n) for f, t in fields])
+    data = np.frombuffer(body[:usable], dtype=dtype)
+    columns = _stamp_columns(h, data)
+    for c in range(n):
+        count = data['count%d' % c]
+        for f, _ in fields:
+            columns[f + str(c)] = data[f + str(c)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = data['sum%d' % c] / count
+            columns['mV%d' % c] = mean * scales[c]
+            if len(fields) > 2:
+                var = (data['squares%d' % c] - data['sum%d' % c] * mean) / (count - 1.0)
+                columns['noise_mV%d' % c] = np.sqrt(np.maximum(var, 0)) * scales[c]
+            for f, _ in fields[3:]:
+                columns['%s_mV%d' % (f, c)] = np.where(count > 0, data[f + str(c)] * scales[c], np.nan)
+    return h, columns
+
+
+def main(argv=None):
+    import sys
+
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) != 1:
+        print('usage: python binlog.py data.bin > data.csv')
+        return 2
+    with open(args[0], 'rb') as f:
+        h = read_header(f)
+    n = len(h['channels'])
+    if h['record_type'] == RAW:
+        print('ticks_us,channel,mV')
+    elif h['record_type'] == TIMING:
+        print(','.join(['ms'] + ['%s %s' % (name, q) for name in TIMING_STAGES
+                                 for q in ('count', 'mean (us)', 'p50 (us)', 'p99 (us)', 'max (us)')]))
+    elif h['record_type'] == SPECTRUM:
+        print(','.join(['ms'] + ['ch%d %g Hz %s' % (c, hz, q) for c, hz in h['bins']
+                                 for q in ('(Hz)', 'amplitude (mV)', 'phase (deg)')]))
+    else:
+        print(','.join(['ms'] + ['ch%d %s (mV)' % (c, q) for c in range(n)
+                                 for q in COLUMNS[h['record_type']]]))
+    for row in rows(args[0]):
+        print(','.join(str(v) for v in row))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+""" ADS1261 conversion codes: decoding and scaling to mV.
+
+The ADS1261 sends each conversion as a 24-bit two's complement code, MSB
+first. Decoding and scaling are kept apart here. decode() unpacks a whole
+buffer of packed 3-byte samples into an array('i') of signed codes in one
+viper loop. Codes are then summed as integers and scaled once per window:
+mean_mV(total, count, scale(reference, gain)), and likewise noise_mV()
+from the sum of squares. The per-sample code * reference / (gain * 2**23)
+is not needed.
+
+decode_numpy() and signed24_numpy() are the host-side twins for binlog and
+offline analysis. VECTORS and MV_VECTORS are shared by every path, and
+selftest() checks all of them on whatever it runs on, including
+decode_numpy() if numpy is importable:
+
+    >>> import codec; codec.selftest()
+    16
+
+    out = array('i', bytes(4 * n))
+    codec.decode(packed, out, 0, n)       # n samples from packed[0:3 * n]
+    mV = codec.mean_mV(sum(out), n, codec.scale(5000, 1))
+"""
+
+from array import array
+import math
+
+try:
+    from micropython import native, viper
+except ImportError:  # plain CPython, e.g. binlog on a PC
+    def native(f):
+        return f
+    viper = native
+
+try:
+    ptr8
+except NameError:  # outside the viper emitter the casts are plain indexing
+    def ptr8(buf):
+        return buf
+    ptr32 = ptr8
+
+FULL_SCALE = 8388608  # 2**23
+
+# (3 data bytes as sent, signed code)
+VECTORS = (
+    (b'\x00\x00\x00', 0),
+    (b'\x00\x00\x01', 1),
+    (b'\xff\xff\xff', -1),
+    (b'\x7f\xff\xff', 8388607),
+    (b'\x80\x00\x00', -8388608),
+    (b'\x80\x00\x01', -8388607),
+    (b'\x40\x00\x00', 4194304),
+    (b'\xc0\x00\x00', -4194304),
+    (b'\x00\x80\x00', 32768),
+    (b'\xff\x7f\xff', -32769),
+    (b'\x00\x00\x80', 128),
+    (b'\xff\xff\x80', -128),
+    (b'\x12\x34\x56', 1193046),
+    (b'\xed\xcb\xaa', -1193046),
+    (b'\x01\x00\x00', 65536),
+    (b'\xfe\xff\xff', -65537),
+)
+
+# (code, reference mV, gain, mV)
+MV_VECTORS = (
+    (0, 5000, 1, 0.0),
+    (4194304, 5000, 1, 2500.0),
+    (-8388608, 5000, 1, -5000.0),
+    (4194304, 5000, 2, 1250.0),
+    (-4194304, 2500, 128, -9.765625),
+    (8388607, 5000, 1, 4999.999403953552),
+    (1, 5000, 1, 0.0005960464477539062),
+    (-1193046, 5000, 4, -177.77779698371887),
+)
+
+
+def scale(reference=5000, gain=1):
+    """ mV per code for a reference voltage (mV) and PGA gain. """
+    return reference / (gain * FULL_SCALE)
+
+
+def mean_mV(total, count, mv_per_code):
+    """ Mean in mV of count codes that sum to total. """
+    return total / count * mv_per_code
+
+
+def noise_mV(count, total, squares, mv_per_code):
+    """ Sample standard deviation in mV of count codes, given their sum and
+    sum of squares. The numerator count * squares - total**2 is exact. """
+    if count < 2:
+        return 0
+    return math.sqrt((count * squares - total * total) / (count * (count - 1))) * mv_per_code
+
+
+def demodulate(forward, reverse, mv_per_code):
+    """ Lock-in terms (difference, common, noise) in mV from the (count,
+    sum, sum of squares) of the forward and reverse phases (see lockin):
+    half the difference and the mean of the two means, and the sample
+    standard deviation pooled over both phases. Zeros if a phase is empty. """
+    nf, sf, qf = forward
+    nr, sr, qr = reverse
+    if not nf or not nr:
+        return 0, 0, 0
+    scale = mv_per_code / (2 * nf * nr)
+    difference = (sf * nr - sr * nf) * scale  # exact integers up to here
+    common = (sf * nr + sr * nf) * scale
+    noise = 0
+    if nf + nr > 2:
+        spread = (nf * qf - sf * sf) / nf + (nr * qr - sr * sr) / nr
+        noise = math.sqrt(max(spread, 0) / (nf + nr - 2)) * mv_per_code
+    return difference, common, noise
+
+
+def signed24(value):
+    """ The low 24 bits of value as a signed code. """
+    value &= 0xFFFFFF
+    return value - 0x1000000 if value & 0x800000 else value
+
+
+@native
+def code(buf, offset=0):
+    """ The signed code in buf[offset:offset + 3]. """
+    value = (buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]
+    if value & 0x800000:
+        value -= 0x1000000
+    return value
+
+
+def to_mV(buf, reference=5000, gain=1, offset=0):
+    """ One sample in mV. For streams, decode() and scale per window. """
+    return code(buf, offset) * reference / (gain * FULL_SCALE)
+
+
+@viper
+def decode(buf, out, offset: int, n: int) -> int:
+    """ Unpack n packed 3-byte samples from buf, starting at byte offset,
+    into out[0:n] (an array('i')). Returns n. """
+    src = ptr8(buf)
+    dst = ptr32(out)
+    p = offset
+    k = 0
+    while k < n:
+        value = (src[p] << 16) | (src[p + 1] << 8) | src[p + 2]
+        if value & 0x800000:
+            value -= 0x1000000
+        dst[k] = value
+        p += 3
+        k += 1
+    return n
+
+
+def decode_numpy(buf, offset=0, n=None):
+    """ Host twin of decode(): an int32 array of the codes in buf. """
+    import numpy as np
+
+    if n is None:
+        n = (len(buf) - offset) // 3
+    raw = np.frombuffer(buf, dtype=np.uint8, count=3 * n, offset=offset)
+    raw = raw.reshape(n, 3).astype(np.int32)
+    return signed24_numpy((raw[:, 0] << 16) | (raw[:, 1] << 8) | raw[:, 2])
+
+
+def signed24_numpy(values):
+    """ Host twin of signed24() for an array of words. """
+    import numpy as np
+
+    return ((np.asarray(values) & 0xFFFFFF) ^ 0x800000).astype(np.int32) - 0x800000
+
+
+def selftest():
+    """ Check code(), decode(), signed24() and to_mV() against the shared
+    vectors, and decode_numpy() too if numpy is importable. Returns the
+    number of vectors; raises AssertionError on the first mismatch. """
+    n = len(VECTORS)
+    packed = bytearray(3 * n)
+    for k in range(n):
+        packed[3 * k:3 * k + 3] = VECTORS[k][0]
+    out = array('i', bytes(4 * n))
+    decode(packed, out, 0, n)
+    for k in range(n):
+        raw, expected = VECTORS[k]
+        word = (raw[0] << 16) | (raw[1] << 8) | raw[2]
+        for name, got in (('code', code(raw)), ('decode', out[k]),
+                          ('signed24', signed24(word | 0x5A000000))):
+            if got != expected:
+                raise AssertionError('%s(%s) = %d, expected %d' % (name, raw.hex(), got, expected))
+    for value, reference, gain, expected in MV_VECTORS:
+        raw = bytes(((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF))
+        got = to_mV(raw, reference, gain)
+        if abs(got - expected) > 1e-6 * abs(expected):  # float32 on the ESP32
+            raise AssertionError('to_mV(%d, %d, %d) = %f, expected %f' % (value, reference, gain, got, expected))
+    try:
+        import numpy as np
+    except ImportError:
+        return n
+    host = decode_numpy(bytes(packed))
+    if host.dtype != np.int32 or list(host) != list(out):
+        raise AssertionError('decode_numpy differs from decode')
+    return n
+
+
+if __name__ == '__main__':
+    print(selftest(), 'vectors ok')
@@ -5,7 +5,8 @@ import datalogger; import uasyncio as asyncio; loop = asyncio.get_event_loop();l
 
 Start here:
 
-import datalogger, ads1261evm, utime
+import datalogger, ads1261evm, codec, utime
+import micropython
 from micropython import const
 from machine import Pin, SPI
 adc = ads1261evm.ADC1261()
@@ -25,10 +26,8 @@ wri = adc.spi.write_readinto # bound method
 inpmux1 = datalogger.input_bytes(adc, 'AIN3', 'AIN4')
 inpmux2 = datalogger.input_bytes(adc, 'AIN6', 'AIN7')
 i1, i2 = memoryview(inpmux1), memoryview(inpmux2)
-convert = adc.convert_to_mV
 reference = const(5000)
-max_bits = const(2**23)
-factor = reference/(max_bits * gain)
+factor = codec.scale(reference, gain)
 r, rdata = bytearray(5), bytes(b'\x12\x00\x00\x00\x00') # initalise a bytearray
 rmv, wmv = memoryview(r), memoryview(rdata)
 imv = memoryview(bytearray(5))
@@ -40,13 +39,25 @@ Not yet implemented: WiFi removal of data.
 """
 
 import os, gc, math
+from array import array
 from machine import Pin, SoftSPI, PWM, SPI, freq
 from sdcard import SDCard
 import sys
 import ads1261evm
+import ringbuffer
+import binlog
+import codec
+from codec import code
+import logwriter
+import moments
+import decimate
+import instrument
+import scanplan
+import scheduler
 import time
 import utime
 import uasyncio as asyncio
+import micropython
 from micropython import const
 
 class Logger:
@@ -76,14 +87,23 @@ def init_pwm(pin=33, freq=1000, duty_cycle=512):
         init_pwm(pin, freq, duty_cycle)
 
 
-def init_sd():
+def init_sd(hardware=True):
     # Initialise SD Card
     # https://www.youtube.com/watch?v=qL2g5YIVick
+    # hardware=True uses the VSPI host (through the GPIO matrix) and
+    # negotiates the fastest clock the card and wiring pass at;
+    # hardware=False keeps the bit-banged bus at 1.32 MHz
     sd = None
     while sd is None:
         try:
-            spisd = SoftSPI(miso=Pin(27), mosi=Pin(25), sck=Pin(26))
+            if hardware:
+                spisd = SPI(2, sck=Pin(26), mosi=Pin(25), miso=Pin(27))
+            else:
+                spisd = SoftSPI(miso=Pin(27), mosi=Pin(25), sck=Pin(26))
             sd = SDCard(spisd, Pin(33))
+            if hardware:
+                baudrate, mbps = sd.negotiate()
+                print('SD clock: {} Hz, read {:.2f} MB/s'.format(baudrate, mbps))
             
             vfs = os.VfsFat(sd)
             os.mount(vfs, '/sd')  # can't mount something that's already been mounted - will trigger EPERM error
@@ -92,6 +112,7 @@ def init_sd():
             return sd
         except OSError as e:
             print(e)
+            sd = None  # retry from scratch
             if str(e) == 'no SD card':
                 int_state = led_state(state=str(e))
                 print(int_state)
@@ -128,10 +149,11 @@ def init_adc(rst=19,
     
     return ads
 
-def init_write(column_names, filename = 'data.txt'):
-    """ Initialise the new txt file. Give it appropriate column names. """
+def init_write(column_names, filename = 'data.txt', mode = 'w'):
+    """ Initialise the new txt file. Give it appropriate column names.
+    For binary logs pass the binlog header as column_names and mode='wb'. """
     try:
-        file = open(filename, 'w')
+        file = open(filename, mode)
         led_state(state = 'ok')
         file.write(column_names)
         file.close() 
@@ -148,11 +170,11 @@ def init_write(column_names, filename = 'data.txt'):
             main()
 
 
-def write(data, filename='data.txt'):
-    """ Appends to a file that already exists.
+def write(data, filename='data.txt', mode='a'):
+    """ Appends to a file that already exists (mode='ab' for binary records).
     It also closes after each append to minimise dataloss during sudden removal. """
     try:
-        with open(filename, 'a') as f:
+        with open(filename, mode) as f:
             f.write(data)
         return 0
     except OSError as e:
@@ -226,13 +248,6 @@ def unique_file(basename, ext, folder = '/'):
         actualname = "%s%d.%s" % (basename, i, ext)
     return actualname
 
-@micropython.native
-def convert_mV(rmv):
-    if rmv[2] > 127:
-        return -(2**24 - ((rmv[2] << 16) + (rmv[3] << 8) + rmv[4])) * 5000/(1*2**23)
-    else:
-        return ((rmv[2] << 16) + (rmv[3] << 8) + rmv[4])* 5000/(1*2**23)
-
 @micropython.native
 def get_measurement(_i, wri, wmv, rmv, imv):
     wri(_i, imv)
@@ -244,8 +259,31 @@ def get_measurement(_i, wri, wmv, rmv, imv):
     wri(wmv, rmv) # New conversion data. Keep.
     wri(wmv, rmv) # New conversion data. Keep.
     wri(wmv, rmv) # New conversion data. Keep.
-    # return (rmv[2] << 16) + (rmv[3] << 8) + rmv[4]
-    return convert_mV(rmv)
+    return code(rmv, 2) # raw code; scaled to mV once per window
+
+def capture_measurement(_i, capture, channel=0):
+    """ DRDY-driven alternative to get_measurement: one INPMUX write, then
+    exactly one RDATA for the first conversion that completes on that input.
+    Returns the raw code, like get_measurement. """
+    return code(capture.measure(_i, channel), 2)
+
+def accumulate(ring, codes, stamps, channels, acc, dec = None):
+    """ Drain the ring in bulk, decimate if dec (a decimate.Decimator) is
+    given, and add the codes to acc, a moments.Moments. Returns the number
+    of codes added, which are left at the front of codes. """
+    n = ring.drain(codes, stamps, channels)
+    if n and dec is not None:
+        n = dec.process(codes, stamps, channels, n)
+    acc.add(codes, channels, n)
+    return n
+
+def decimator(plan, block):
+    """ A decimate.Decimator for the plan's per-channel 'decimate' settings,
+    or None if every channel passes its codes through. """
+    specs = [s['decimate'] for s in plan.specs]
+    if all(decimate.parse(s)[0] == decimate.PASS for s in specs):
+        return None
+    return decimate.Decimator(specs, block)
     
 def mV_temp(half, half_det, denom, br0rt, R):
     ''' convert the mV to RTD '''
@@ -259,16 +297,76 @@ def input_bytes(adc, positive, negative):
     Returns a byte array with the corresponding register command for an ADS1261.
     '''
     register_data = int(adc.INPMUXregister[positive] << 4) + adc.INPMUXregister[negative]
-    command = adc.commandByte1["WREG"][0] + adc.registerAddress["INPMUX"]
-    return bytes([command, register_data, 0, 0, 0])
-
-def measure(filename, adc = init_adc()):
+    frame = adc.wreg_bytes("INPMUX", register_data)
+    return frame + bytes(5 - len(frame))
+
+def open_log(filename, header, policy = 'balanced', sd = None, extent_mb = 0):
+    """ A binary log with header written: an extentlog.ExtentLog of
+    extent_mb MB if sd and extent_mb are given and it can be preallocated,
+    else a logwriter.LogWriter with the given policy. """
+    if extent_mb and sd is not None:
+        import extentlog
+        try:
+            log = extentlog.ExtentLog(sd, filename, extent_mb * 1024 * 1024)
+            log.write(header)
+            return log
+        except (OSError, ValueError) as e:
+            print('No extent, falling back to buffered writes:', e)
+    init_write(header, filename = filename, mode = 'wb')
+    return logwriter.LogWriter(filename, **(logwriter.POLICIES[policy] if isinstance(policy, str) else policy))
+
+# Channels scanned in capture mode (see scanplan for the spec keys). The
+# excitation current is forward for the sensor and reversed for the RTD.
+# Two conversions per visit: the second comes one data period after the
+# settled first, so it nearly doubles the samples per channel.
+CHANNELS = [
+    {'positive': 'AIN3', 'negative': 'AIN4', 'current': 1, 'dwell': 2},  # AlGaN/GaN sensor
+    {'positive': 'AIN6', 'negative': 'AIN7', 'current': 0, 'dwell': 2},  # temperature (RTD)
+]
+
+# Frequencies watched by the pipeline's spectrum log (see spectrum): the
+# 1 kHz PWM excitation (init_pwm), mains at 50 or 60 Hz and harmonics.
+BINS = [(0, 1000), (0, 50), (0, 100), (0, 150), (0, 60), (1, 50), (1, 60)]
+
+def spectrum_log(filename, plan, bins, policy = 'balanced', reference = 5000):
+    """ A spectrum.Spectrum for bins, (channel, Hz) pairs over the plan's
+    channels, and its own SPECTRUM log next to filename, with _fft added
+    to the name. Returns (spectrum, log). """
+    import spectrum
+    adc = plan.adc
+    header = binlog.header(plan.channels(), binlog.SPECTRUM, reference, adc.register('MODE0'),
+                           adc.register('MODE1'), time.time(), bins)
+    log = open_log(filename.rsplit('.', 1)[0] + '_fft.bin', header, policy)
+    return spectrum.Spectrum(bins, plan.n), log
+
+def timing_log(filename, plan, policy = 'balanced', reference = 5000):
+    """ An instrument.Histograms and its own TIMING log next to filename,
+    with _timing added to the name. Returns (histograms, log). """
+    adc = plan.adc
+    header = binlog.header(plan.channels(), binlog.TIMING, reference, adc.register('MODE0'),
+                           adc.register('MODE1'), time.time())
+    log = open_log(filename.rsplit('.', 1)[0] + '_timing.bin', header, policy)
+    return instrument.Histograms(), log
+
+def show_timing(record, log = None):
+    """ Print a TIMING record as instrument.line, and write it to log. """
+    if log is not None:
+        log.write(record)
+    print(instrument.line(record))
+
+def measure(filename, adc = init_adc(), capture = True, raw = False, policy = 'balanced',
+            sd = None, extent_mb = 0, channels = CHANNELS, profile = False):
+    """ Sample channels (a scanplan list) on DRDY (capture=True) and log a
+    binlog STATS record per one-second window, or every sample with
+    raw=True; capture=False keeps the old RDATA bursts and CSV lines.
+    policy, sd and extent_mb pick the writer (open_log). profile prints
+    per-stage timing every window (instrument). """
     print('set up measurements')
     adc.reset()
     adc.setup_measurements()
     adc.set_frequency(19200, 'sinc4')
     print("Frequency:", adc.check_frequency(print_freq = False))
-    gain = const(1) # can be adjusted but must update convert_mV
+    gain = const(1) # can be adjusted
     adc.PGA(GAIN=gain)
     adc.PGA(GAIN=gain) 
     print("Gain:", adc.check_PGA()[1])
@@ -285,15 +383,11 @@ def measure(filename, adc = init_adc()):
     i1, i2 = memoryview(inpmux1), memoryview(inpmux2)
 
     # Start taking measurements.
-    v0, v1 = 0,0
     total_cycle_us = 1000 
     on_cycle_us = 500
     
     if on_cycle_us > total_cycle_us: on_cycle_us = total_cycle_us
     
-    global_start = time.time()
-    start_time = time.time() 
-
     i = 0
     start = gc.mem_free()
     start_ticks = utime.ticks_ms()
@@ -308,22 +402,47 @@ def measure(filename, adc = init_adc()):
     starton = adc.start.on
     startoff = adc.start.off
     drdy = adc.drdy
-    convert = adc.convert_to_mV
     reference = const(5000)
-    max_bits = const(2**23)
-    factor = reference/(max_bits * gain)
+    factor = codec.scale(reference, gain) # mV per code, applied once per window
+    # Raw codes are summed as integers (with their squares for the noise)
+    # and only scaled to mV when a window closes.
+    acc = moments.Moments(2)
+    scales = [factor, factor]
     switch_current = Pin(32, Pin.OUT)
     fc = switch_current.on
     rc = switch_current.off
 
-    desired_frequency = 1000  # Hz
-    # delay = (1/desired_frequency*1e6 - 700)/2 # (seconds/period - average iteration time) / 2, 650 = 827/0.93 Hz
-    delay = 50
-    delay = int(delay)
-    print(delay)
+    desired_frequency = 1000  # Hz, one forward and one reverse sample each
+    sched = scheduler.Scheduler(2 * desired_frequency, window_ms = 1000)
+    prof = instrument.Histograms() if profile else None
+    if prof is not None:
+        timing = bytearray(binlog.timing_size())
     flag = True
     wri(i1, imv) # 160 µs? Pass along to something else?
 
+    # In capture mode the DRDY IRQ puts raw codes into a ring that is drained
+    # in bulk; nothing is allocated per sample and the SD write is decoupled.
+    cap = None
+    if capture:
+        ring = ringbuffer.SampleRing(512)
+        codes, ids = array('i', (0 for _ in range(256))), bytearray(256)
+        stamps = array('I', (0 for _ in range(256))) if raw else None
+        plan = scanplan.ScanPlan(adc, channels, rate=19200, filter='sinc4', delay='50us')
+        acc = moments.Moments(plan.n)
+        dec = decimator(plan, 256)
+        scales = plan.scales
+        record_type = binlog.RAW if raw else binlog.STATS
+        plan.apply(0)
+        header = binlog.header(plan.channels(), record_type, reference,
+                               adc.register('MODE0'), adc.register('MODE1'), time.time())
+        record = bytearray(256 * binlog.RAW_SIZE if raw else binlog.stats_size(plan.n))
+        record_mv = memoryview(record)
+        log = open_log(filename, header, policy, sd, extent_mb)
+        cap = ads1261evm.DrdyCapture(adc, plan.rdata, ring=ring)
+        cap.profile = log.profile = prof
+        scanner = scanplan.Scanner(plan, cap, current_pin=switch_current)
+        scanner.start()
+
     # for the temperature calculation
     a, b, R0 = 3.9083e-3, -5.775e-7, 1000
     half, half_det, denom, br0rt = -a*R0/(2*b*R0), (a*R0)**2 - 4*b*R0**2, 2*b*R0, 4*b*R0
@@ -333,26 +452,50 @@ def measure(filename, adc = init_adc()):
     print(adc.check_PGA())
     print(adc.check_frequency())
 
+    sched.start()
     while True: 
         try:
-            while (time.time() - start_time) < 0.93: # takes 60 ms to write to SD card
+            while not sched.window_due(): # the SD write eats into the next window, not its length
                 # Average time per iteration: 601 µs
                 # if in the first half, collect gan measurement
                 fc() # forward current
                 i += 1 # place here to reduce switch noise
-                v0 += get_measurement(_i=i1, wri=wri, wmv=wmv, rmv=r1mv, imv=imv)
+                if prof is not None:
+                    t0 = utime.ticks_us()
+                if cap is not None:
+                    scanner.cycle() # sets the current per channel itself
+                    if len(ring) > 256:
+                        if prof is not None:
+                            t1 = utime.ticks_us()
+                        n = accumulate(ring, codes, stamps, ids, acc, dec)
+                        if raw and n:
+                            log.write(record_mv[:binlog.pack_raws(record, codes, stamps, ids, n)])
+                        if prof is not None:
+                            prof.since(instrument.AGGREGATE, t1)
+                    if prof is not None:
+                        prof.since(instrument.LOOP, t0)
+                    continue
+                acc.add_one(get_measurement(_i=i1, wri=wri, wmv=wmv, rmv=r1mv, imv=imv), 0)
+                if prof is not None:
+                    prof.since(instrument.SPI, t0)
                 wri(i2, imv) # 160 µs? Pass along to something else?
                 wri(i2, imv) # 160 µs? Pass along to something else?
                 # print(adc.check_inputs())
-                utime.sleep_us(delay)
+                sched.wait()
                 
                 rc() # reverse current
                 # if in second half, collect temperature measurement
-                v1 += get_measurement(_i=i2, wri=wri, wmv=wmv, rmv=r2mv, imv=imv)
+                if prof is not None:
+                    t1 = utime.ticks_us()
+                acc.add_one(get_measurement(_i=i2, wri=wri, wmv=wmv, rmv=r2mv, imv=imv), 1)
+                if prof is not None:
+                    prof.since(instrument.SPI, t1)
                 wri(i1, imv) # 160 µs? Pass along to something else?
                 wri(i1, imv) # 160 µs? Pass along to something else?
                 # print(adc.check_inputs())
-                utime.sleep_us(delay)
+                sched.wait()
+                if prof is not None:
+                    prof.since(instrument.LOOP, t0)
 
             if flag:
                 flag = False
@@ -361,32 +504,62 @@ def measure(filename, adc = init_adc()):
                 flag = True
                 rc()
 
-            s = utime.ticks_us()
-            time_since_start = str(time.time() - global_start)
-            
-            average_voltages0 = str(v0 / i) # removed factor
-            # temp = t(half, half_det, denom, br0rt, 10*v1/i) # 10 = mV/100e-6, change to 5 for 200 µA supply.
-            # average_voltages1 = str(temp) # removed factor
-            average_voltages1 = str(v1 / i) # removed factor
+            saving = utime.ticks_us()
+            stamp_us = sched.close_window()
+            time_since_start = str(stamp_us / 1000000)
+            if cap is not None:
+                while len(ring):
+                    n = accumulate(ring, codes, stamps, ids, acc, dec)
+                    if raw and n:
+                        log.write(record_mv[:binlog.pack_raws(record, codes, stamps, ids, n)])
+                if not raw:
+                    binlog.pack_stats(record, stamp_us, acc)
+                    log.write(record_mv)
+                log.poll()
+            i = acc.count(0)
+            averages = [acc.mean_mV(c, scales[c]) for c in range(acc.n)]
+            noise = [acc.noise_mV(c, scales[c]) for c in range(acc.n)]
+            average_voltages0, average_voltages1 = str(averages[0]), str(averages[-1])
+            # temp = t(half, half_det, denom, br0rt, 10*averages[1]) # 10 = mV/100e-6, change to 5 for 200 µA supply.
+            # average_voltages1 = str(temp)
             
-            print('\n', time_since_start, average_voltages0, average_voltages1, i, v0, v1)
-            v0, v1, i = 0, 0, 0
+            print('\n', time_since_start, average_voltages0, average_voltages1, i, noise[0], noise[-1])
+            if cap is not None:
+                print("Conversions:", cap.conversions, "Missed:", cap.missed, "Duplicates:", cap.duplicates)
+                print("Ring (waiting, high water, overflows):", ring.stats())
+                print("Log (flushes, bytes, last/max/mean flush us):", log.stats())
+                print("Averages (mV):", averages)
+                print("Noise (mV):", noise)
+            print("Schedule (slots, overruns, max late us, idle us, windows, window overruns):", sched.stats())
+            if prof is not None:
+                binlog.pack_timing(timing, stamp_us, prof)
+                print("Timing:", instrument.line(timing))
+                prof.clear()
+            acc.clear()
+            i = 0
             
-            data = str(time_since_start + ',' + average_voltages0 + ',' + average_voltages1 + '\n')
-            write(data = data, filename = filename)
+            if cap is None:
+                data = str(time_since_start + ',' + average_voltages0 + ',' + average_voltages1 + '\n')
+                write(data = data, filename = filename)
             
-            # restart
-            start_time = time.time()
-            print("Time to save (us):", utime.ticks_us() - s, '\n')
+            print("Time to save (us):", utime.ticks_diff(utime.ticks_us(), saving), '\n')
 
         except KeyboardInterrupt:
+            sched.stop()
+            if cap is not None:
+                scanner.stop()
+                log.close()
             adc.reset()
             sys.exit(1)
 
+        except OSError as e:
+            print(e)
+            led_state('no sd card')
+
         except MemoryError as e:
             print("Cycles:", i)
             print("Used memory (bytes):", start - gc.mem_free())
-            print("Time to full (us):", utime.ticks_ms() - start_ticks)
+            print("Time to full (ms):", utime.ticks_diff(utime.ticks_ms(), start_ticks))
             led_state('adc')
             print(e)
 
@@ -394,33 +567,202 @@ def measure(filename, adc = init_adc()):
             print(e)
             led_state('adc')
 
+def capture_setup(filename, adc = None, sd = None, extent_mb = 0, channels = CHANNELS,
+                  raw = False, policy = 'balanced', lock = None, chop = 'normal',
+                  verified = False, pulsed = False):
+    """ The capture-mode setup shared by measure_pipeline and
+    measure_threaded: ADC reset, scan plan, log with header, sample ring and
+    scanner. With lock, a lockin.LockIn, the plan scans lock.specs and the
+    log takes LOCKIN records. chop picks the ADS1261's chop or
+    AC-excitation mode (ADC1261.mode1register). verified turns on the
+    STATUS byte and CRCs, and the capture drops and counts frames that fail
+    them (see ads1261evm.DrdyCapture). pulsed starts every conversion with
+    a START pulse instead of converting continuously, so each one read is
+    settled (see pulse). Returns (plan, log, ring, scanner). """
+    if adc is None:
+        adc = init_adc()
+    reference = 5000
+    adc.reset()
+    adc.setup_measurements()
+    if verified:
+        adc.integrity(status = True, crc = True)
+    adc.reference_config(reference_enable=1, RMUXP="AVDD", RMUXN="AVSS")
+    specs = lock.specs if lock is not None else channels
+    if pulsed:
+        import pulse
+        plan = pulse.plan(adc, specs, rate=19200, chop=chop, reference=reference)
+    else:
+        plan = scanplan.ScanPlan(adc, specs, rate=19200, filter='sinc4', delay='50us',
+                                 chop=chop, reference=reference)
+    plan.apply(0)
+    if raw:
+        record_type, logged = binlog.RAW, plan.channels()
+    elif lock is not None:
+        record_type, logged = binlog.LOCKIN, plan.channels()[:lock.n]  # A+ B+ ... come first
+    else:
+        record_type, logged = binlog.STATS, plan.channels()
+    header = binlog.header(logged, record_type, reference,
+                           adc.register('MODE0'), adc.register('MODE1'), time.time())
+    log = open_log(filename, header, policy, sd, extent_mb)
+    ring = ringbuffer.SampleRing(512)
+    cap = ads1261evm.DrdyCapture(adc, plan.rdata, ring=ring)
+    scanner = (pulse.Sequencer if pulsed else scanplan.Scanner)(plan, cap, current_pin=Pin(32, Pin.OUT))
+    return plan, log, ring, scanner
+
+def show_window(record, plan, report = None, lock = None):
+    """ Print a STATS record's means, noise and extremes (or with lock, a
+    LOCKIN record's demodulated terms), and a stage report. """
+    import pipeline
+    if lock is not None:
+        ms, terms = pipeline.window_lockin(record, lock.n, lock.scales)
+        print(ms, "Difference, common, noise (mV):", terms)
+    else:
+        ms, stats = pipeline.window_stats(record, plan.n, plan.scales)
+        print(ms, "Averages, noise, min, max (mV):", stats)
+    if report is not None:
+        print(report())
+
+async def measure_pipeline(filename, adc = None, sd = None, extent_mb = 0, channels = CHANNELS,
+                           raw = False, policy = 'balanced', window_ms = 1000, duration_ms = 0,
+                           bins = None, lock_in = False, chop = 'normal', verified = False,
+                           pulsed = False, profile = False):
+    """ measure() in capture mode as uasyncio stages (pipeline), so a slow
+    card only holds up the SD sink. bins logs amplitude and phase at
+    (channel, Hz) pairs such as BINS (spectrum_log), lock_in the
+    demodulated terms (lockin), profile a TIMING record per window
+    (timing_log); chop, verified and pulsed go to capture_setup. Runs
+    until interrupted, or for duration_ms; returns the final report. """
+    import lockin, pipeline
+    lock = lockin.LockIn(channels) if lock_in else None
+    plan, log, ring, scanner = capture_setup(filename, adc, sd, extent_mb, channels, raw, policy,
+                                             lock, chop, verified, pulsed)
+    spec, spec_log = spectrum_log(filename, plan, bins, policy) if bins else (None, None)
+    prof, prof_log = timing_log(filename, plan, policy) if profile else (None, None)
+    log.profile = prof
+    acc = lock if lock is not None else moments.Moments(plan.n)
+    pipe = pipeline.Pipeline(scanner, ring, acc, plan.scales,
+                             window_ms=window_ms, raw=raw, decimator=decimator(plan, 128),
+                             spectrum=spec, profile=prof)
+    if hasattr(log, 'write_async'):
+        pipe.add_sink('sd', log.write_async, awaitable=True)
+    else:
+        pipe.add_sink('sd', log.write)
+    if not raw:
+        pipe.add_sink('serial', lambda record: show_window(record, plan, pipe.report, lock), depth = 1)
+    if spec_log is not None:
+        pipe.add_sink('spectrum', spec_log.write, spectrum = True)
+    if prof_log is not None:
+        pipe.add_sink('timing', lambda record: show_timing(record, prof_log), timing = True)
+    try:
+        return await pipe.run(duration_ms)
+    finally:
+        # the extent log remounts the card on close: the others go first
+        if spec_log is not None:
+            spec_log.close()
+        if prof_log is not None:
+            prof_log.close()
+        log.close()
+
+def measure_threaded(filename, adc = None, sd = None, extent_mb = 0, channels = CHANNELS,
+                     raw = False, policy = 'balanced', window_ms = 1000, duration_ms = 0,
+                     threaded = True, lock_in = False, chop = 'normal', verified = False,
+                     pulsed = False, profile = False):
+    """ measure() in capture mode with aggregation and SD writes on a
+    second thread (see dualcore); this thread only cycles the scanner.
+    threaded=False runs the same work on one thread for comparison.
+    lock_in, chop, verified, pulsed and profile as for measure_pipeline.
+    Returns the per-thread utilisation report. """
+    import lockin, dualcore
+    lock = lockin.LockIn(channels) if lock_in else None
+    plan, log, ring, scanner = capture_setup(filename, adc, sd, extent_mb, channels, raw, policy,
+                                             lock, chop, verified, pulsed)
+    prof, prof_log = timing_log(filename, plan, policy) if profile else (None, None)
+    log.profile = prof
+    acc = lock if lock is not None else moments.Moments(plan.n)
+    worker = dualcore.Worker(ring, acc, log, acc.n, raw=raw, window_ms=window_ms,
+                             show=lambda record: show_window(record, plan, lock = lock),
+                             decimator=decimator(plan, 256), profile=prof,
+                             timing=lambda record: show_timing(record, prof_log))
+    try:
+        report = dualcore.run(scanner, worker, duration_ms, threaded)
+    finally:
+        if prof_log is not None:  # before the extent log remounts the card
+            prof_log.close()
+        log.close()
+    print("Threads:", report)
+    return report
+
+def autotune(adc = None, channels = None, noise_uV = None, filename = None, **sweep):
+    """ Sweep data rate, filter and delay on channels (tune.SHORTED by
+    default), print and save the Pareto-optimal settings to filename
+    (tune.FILENAME by default), and print the settings tune.sweep skipped.
+    Other keyword arguments go to tune.sweep. With noise_uV, returns the
+    fastest setting within it, else the saved front. """
+    import tune
+    if channels is None:
+        channels = tune.SHORTED
+    if filename is None:
+        filename = tune.FILENAME
+    if adc is None:
+        adc = init_adc()
+    adc.reset()
+    adc.setup_measurements()
+    adc.reference_config(reference_enable=1, RMUXP="AVDD", RMUXN="AVSS")
+    skipped = []
+    front = tune.pareto(tune.sweep(adc, channels, skipped=skipped, **sweep))
+    tune.save(front, filename)
+    if skipped:
+        print("Skipped (rate, filter, delay, why):", skipped)
+    print("Rate, filter, delay, samples/s, noise (uV):")
+    for result in front:
+        print(result)
+    return front if noise_uV is None else tune.fastest(noise_uV, front)
+
 def main():
 
     ''' 
     Thread 1: Change inputs, receive bytes from datalogger.
     Thread 2: Take bytes, convert to mV, calculate the average, store in sd card (in under a second?)
-    Thread 3: FFT?
+    Thread 3: amplitude and phase at BINS, e.g. the PWM fundamental and mains (see spectrum).
     '''
     freq(240000000) # up to 240 MHz
     sd = init_sd()
     if sd is None: main()
+    extent_mb = 16 # preallocated log size; 0 for plain buffered writes
+    if extent_mb:
+        import extentlog
+        # fix up the length of any extent left open by a power cut
+        for name in os.listdir('sd'):
+            if name.endswith('.bin'):
+                try:
+                    extentlog.recover(sd, name, '/sd')
+                except (OSError, ValueError) as e:
+                    print(name, e)
     int_state = led_state(state = 'ok', pins = [15, 2, 4])
     # pwm = init_pwm(pin = 33, freq = 1000, duty_cycle=512)
     
     # check if this filename exists. If so, increment by 1 to prevent overwrite.
-    filename = unique_file(basename = 'data', ext = 'txt', folder = 'sd')  
+    # Binary logs (.bin) are written by measure() itself; decode with binlog.py.
+    capture = True
+    filename = unique_file(basename = 'data', ext = 'bin' if capture else 'txt', folder = 'sd')  
     filename = 'sd/' + filename
     
     log_file = 'log.txt' # Not used as yet. TODO: Implement logger output for debugging.
 
     # Initialise new datataking file.
-    column_names = 'Time (s),AlGaN/GaN Sensor (mV),Temperature (mV)\n' # 'A2-A3 (mV)'
-    init_write(column_names = column_names, filename = filename)
+    if not capture:
+        column_names = 'Time (s),AlGaN/GaN Sensor (mV),Temperature (mV)\n' # 'A2-A3 (mV)'
+        init_write(column_names = column_names, filename = filename)
     
-    # create a global coroutine for data acquisition
-    # create a global coroutine for averaging
-    # create coroutine for writing to SD card
-    measure(filename)
+    # Acquisition, averaging and the SD card run as coroutines (see pipeline)
+    # or, with mode = 'threaded', on two threads (see dualcore).
+    mode = 'pipeline' if capture else 'loop'
+    if mode == 'pipeline':
+        asyncio.run(measure_pipeline(filename, sd = sd, extent_mb = extent_mb, bins = BINS))
+    elif mode == 'threaded':
+        measure_threaded(filename, sd = sd, extent_mb = extent_mb)
+    else:
+        measure(filename, capture = capture, sd = sd, extent_mb = extent_mb)
     
     
 
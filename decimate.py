@@ -0,0 +1,367 @@
+""" Per-channel decimation of raw ADS1261 codes between the sample ring and
+aggregation or storage.
+
+Each channel gets its own filter and ratio R, and gives one output code per
+R input codes:
+
+    None or 1            pass every code through
+    ('boxcar', R)        mean of each block of R codes (R up to 128)
+    ('cic', R, N)        N-stage cascaded integrator-comb, a sinc**N
+                         response with nulls at multiples of the output
+                         rate; R a power of two, N up to 4 and R**N up to
+                         2**24. The first N - 1 outputs, while the filter
+                         fills, are dropped.
+    ('median', R, W)     median of the last W codes (default R, up to 64)
+                         every R codes, for spikes a mean would smear
+
+Everything stays in the integer code domain, so a decimated code scales to
+mV like any other (codec.scale). The CIC integrators and combs run modulo
+2**48 in 24-bit limbs, the way moments keeps its sums. Their wraparound
+cancels in the combs, and no value in the loop exceeds 2**26.
+
+process() filters a block in place, in one viper loop over fixed per-channel
+state. Viper has no integer division, so a boxcar output leaves that loop
+as its block sum and is divided by R in a short native pass over the
+outputs only. R is capped at 128 so that a sum of full-scale codes,
+-2**30 to 2**30 - 128, is still a small int there and the pass allocates
+nothing. The outputs are compacted to the front of the codes, ids and
+stamps arrays (a stamp is that of the last input behind the output), so
+what follows (moments.Moments.add, binlog.pack_raws) does not change:
+
+dec = decimate.Decimator([('cic', 16, 3), ('median', 4, 5)])
+n = ring.drain(codes, stamps, ids)
+n = dec.process(codes, stamps, ids, n)
+acc.add(codes, ids, n)
+"""
+
+from array import array
+import micropython
+from micropython import const
+
+PASS, BOXCAR, CIC, MEDIAN = 0, 1, 2, 3
+KINDS = {'boxcar': BOXCAR, 'cic': CIC, 'median': MEDIAN}
+
+_PASS = const(0)
+_BOXCAR = const(1)
+_CIC = const(2)
+_MEDIAN = const(3)
+MAX_BOXCAR = 128  # R * 2**23 within the 31-bit small ints
+MAX_CIC_STAGES = 4
+MAX_CIC_GROWTH = 24  # bits; the integrators are two 24-bit limbs
+MAX_MEDIAN = 64
+
+
+def parse(entry):
+    """ (kind, ratio, taps) from a channel's decimation setting: taps is the
+    CIC stage count or the median window. """
+    if entry is None or entry == 1:
+        return PASS, 1, 0
+    if isinstance(entry, int):
+        entry = ('boxcar', entry)
+    kind = KINDS.get(entry[0].lower())
+    if kind is None:
+        raise ValueError('unknown decimation filter %r' % (entry[0],))
+    ratio = entry[1]
+    if ratio < 1:
+        raise ValueError('decimation ratio must be at least 1')
+    if kind == BOXCAR:
+        if ratio > MAX_BOXCAR:
+            raise ValueError('boxcar ratio above %d' % MAX_BOXCAR)
+        return kind, ratio, 0
+    if kind == CIC:
+        stages = entry[2] if len(entry) > 2 else 3
+        if ratio & (ratio - 1):
+            raise ValueError('CIC ratio must be a power of two')
+        if not 1 <= stages <= MAX_CIC_STAGES or growth(ratio, stages) > MAX_CIC_GROWTH:
+            raise ValueError('CIC needs 1 to %d stages and R**N up to 2**%d'
+                             % (MAX_CIC_STAGES, MAX_CIC_GROWTH))
+        return kind, ratio, stages
+    window = entry[2] if len(entry) > 2 else ratio
+    if not 1 <= window <= MAX_MEDIAN:
+        raise ValueError('median window must be 1 to %d' % MAX_MEDIAN)
+    return kind, ratio, window
+
+
+def growth(ratio, stages):
+    """ Bit growth of an R, N CIC, log2(R**N) for R a power of two. """
+    return stages * (ratio.bit_length() - 1)
+
+
+def state_size(kind, taps):
+    """ State words per channel: a running sum; two limbs for each
+    integrator and comb; or position, fill, history and sorted window. """
+    if kind == BOXCAR:
+        return 1
+    if kind == CIC:
+        return 4 * taps
+    if kind == MEDIAN:
+        return 2 + 2 * taps
+    return 0
+
+
+class Decimator:
+    def __init__(self, specs, block=256):
+        """ specs: one decimation setting per channel (see parse). block is
+        the most samples process() is given at once. """
+        self.n = n = len(specs)
+        self.block = block
+        self.kinds = bytearray(n)
+        self.ratios = array('H', bytes(2 * n))
+        self.taps = bytearray(n)
+        self.shifts = bytearray(n)  # CIC gain, log2(R**N)
+        self.base = array('H', bytes(2 * n))
+        size = 0
+        for c, entry in enumerate(specs):
+            kind, ratio, taps = parse(entry)
+            self.kinds[c], self.ratios[c], self.taps[c] = kind, ratio, taps
+            self.shifts[c] = growth(ratio, taps) if kind == CIC else 0
+            self.base[c] = size
+            size += state_size(kind, taps)
+        self.boxcars = BOXCAR in self.kinds
+        self.state = array('i', bytes(4 * max(size, 1)))
+        self.phase = array('H', bytes(2 * n))
+        self.warm = bytearray(n)  # outputs still to drop while a CIC fills
+        self.picks = array('H', bytes(2 * block))  # input index of each output
+        self.reset()
+
+    def ratio(self, c):
+        return self.ratios[c]
+
+    def output_rate(self, c, rate):
+        """ Output rate of channel c for an input rate (SPS). """
+        return rate / self.ratios[c]
+
+    def reset(self):
+        """ Forget all filter state, e.g. after a gap in the data. """
+        s = self.state
+        for k in range(len(s)):
+            s[k] = 0
+        for c in range(self.n):
+            self.phase[c] = 0
+            self.warm[c] = self.taps[c] - 1 if self.kinds[c] == CIC else 0
+
+    def process(self, codes, stamps, ids, n):
+        """ Filter codes[0:n] of channels ids[0:n] in place and return the
+        number of outputs now at the front of codes, ids and stamps (if
+        not None). """
+        if n > self.block:
+            raise ValueError('block of %d samples, decimator holds %d' % (n, self.block))
+        m = self._run(codes, ids, n)
+        if self.boxcars:
+            self._divide(codes, ids, m)
+        if stamps is not None:
+            self._pick(stamps, m)
+        return m
+
+    @micropython.native
+    def _divide(self, codes, ids, m):
+        """ Boxcar block sums to means, rounding half up. """
+        kinds = self.kinds
+        ratios = self.ratios
+        for j in range(m):
+            c = ids[j]
+            if kinds[c] == _BOXCAR:
+                r = ratios[c]
+                codes[j] = (codes[j] + (r >> 1)) // r
+
+    @micropython.viper
+    def _pick(self, stamps, m: int):
+        dst = ptr32(stamps)
+        picks = ptr16(self.picks)
+        j = 0
+        while j < m:
+            dst[j] = dst[picks[j]]
+            j += 1
+
+    @micropython.viper
+    def _run(self, codes, ids, n: int) -> int:
+        kinds = ptr8(self.kinds)
+        ratios = ptr16(self.ratios)
+        taps = ptr8(self.taps)
+        shifts = ptr8(self.shifts)
+        base = ptr16(self.base)
+        phase = ptr16(self.phase)
+        warm = ptr8(self.warm)
+        picks = ptr16(self.picks)
+        s = ptr32(self.state)
+        src = ptr32(codes)
+        chan = ptr8(ids)
+        m = 0
+        k = 0
+        while k < n:
+            c = chan[k]
+            v = src[k]
+            kind = kinds[c]
+            b = base[c]
+            ready = 0
+            p = phase[c] + 1
+            if p == ratios[c]:
+                ready = 1
+                p = 0
+            phase[c] = p
+            out = v
+            if kind == _BOXCAR:
+                t = s[b] + v
+                if ready:
+                    out = t  # the sum; _divide makes it the mean
+                    t = 0
+                s[b] = t
+            elif kind == _CIC:
+                stages = taps[c]
+                lo = v & 0xFFFFFF
+                hi = (v >> 24) & 0xFFFFFF
+                j = 0
+                while j < stages:  # integrators, at the input rate
+                    i = b + 4 * j
+                    lo += s[i]
+                    hi += s[i + 1] + (lo >> 24)
+                    lo &= 0xFFFFFF
+                    hi &= 0xFFFFFF
+                    s[i] = lo
+                    s[i + 1] = hi
+                    j += 1
+                if ready:
+                    j = 0
+                    while j < stages:  # combs, at the output rate
+                        i = b + 4 * j + 2
+                        dlo = lo - s[i]
+                        dhi = hi - s[i + 1] + (dlo >> 24)
+                        s[i] = lo
+                        s[i + 1] = hi
+                        lo = dlo & 0xFFFFFF
+                        hi = dhi & 0xFFFFFF
+                        j += 1
+                    g = shifts[c]
+                    if g:  # divide by R**N, rounding half up
+                        lo += 1 << (g - 1)
+                        hi = (hi + (lo >> 24)) & 0xFFFFFF
+                        lo &= 0xFFFFFF
+                    if hi & 0x800000:
+                        hi -= 0x1000000
+                    out = (hi << (24 - g)) + (lo >> g)
+            elif kind == _MEDIAN:
+                window = taps[c]
+                pos = s[b]
+                fill = s[b + 1]
+                h = b + 2
+                srt = h + window
+                if fill == window:  # drop the oldest from the sorted copy
+                    old = s[h + pos]
+                    j = 0
+                    while s[srt + j] != old:
+                        j += 1
+                    fill -= 1
+                    while j < fill:
+                        s[srt + j] = s[srt + j + 1]
+                        j += 1
+                s[h + pos] = v
+                pos += 1
+                if pos == window:
+                    pos = 0
+                j = fill
+                while j > 0 and s[srt + j - 1] > v:
+                    s[srt + j] = s[srt + j - 1]
+                    j -= 1
+                s[srt + j] = v
+                fill += 1
+                s[b] = pos
+                s[b + 1] = fill
+                if ready:
+                    mid = srt + (fill >> 1)
+                    if fill & 1:
+                        out = s[mid]
+                    else:
+                        out = (s[mid - 1] + s[mid]) >> 1
+            if ready:
+                if warm[c]:
+                    warm[c] -= 1
+                else:
+                    src[m] = out
+                    chan[m] = c
+                    picks[m] = k
+                    m += 1
+            k += 1
+        return m
+
+
+# (setting, inputs per channel) for selftest(): every filter, odd ratios,
+# and a boxcar at the largest R on full-scale codes
+CASES = ((None, 40), (('boxcar', 7), 700), (('boxcar', MAX_BOXCAR), 1024), (('cic', 16, 3), 800),
+         (('cic', 4, 4), 400), (('median', 4, 5), 400), (('median', 3, 4), 300))
+
+
+def _reference(entry, x):
+    """ What a Decimator should output for one channel's codes x. """
+    kind, r, taps = parse(entry)
+    if kind == PASS:
+        return list(x)
+    out = []
+    for k in range(r - 1, len(x), r):
+        if kind == BOXCAR:
+            out.append((sum(x[k - r + 1:k + 1]) + (r >> 1)) // r)
+        elif kind == CIC:
+            h = [1]
+            for _ in range(taps):  # sinc**N: taps boxes of length r convolved
+                h = [sum(h[i - j] for j in range(r) if 0 <= i - j < len(h))
+                     for i in range(len(h) + r - 1)]
+            g = growth(r, taps)
+            acc = sum(h[i] * x[k - i] for i in range(len(h)) if k - i >= 0)
+            out.append((acc + (1 << (g - 1))) >> g)
+        else:
+            w = sorted(x[max(0, k - taps + 1):k + 1])
+            mid = len(w) >> 1
+            out.append(w[mid] if len(w) & 1 else (w[mid - 1] + w[mid]) >> 1)
+    return out[taps - 1:] if kind == CIC else out
+
+
+def selftest(block=200):
+    """ Run the CASES channels interleaved through a Decimator in blocks
+    of block samples, so filters carry their state across process()
+    calls, and check every channel's outputs and stamps against
+    _reference(). Returns the number of outputs; raises AssertionError on
+    the first mismatch. """
+    n = len(CASES)
+    dec = Decimator([entry for entry, _ in CASES], block)
+    seed = 12345
+    inputs = []
+    for c, (entry, count) in enumerate(CASES):
+        x = []
+        for k in range(count):
+            seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF  # no random module needed
+            if entry is not None and entry[0] == 'boxcar' and entry[1] == MAX_BOXCAR:
+                x.append(0x7FFFFF if k < count // 2 else -0x800000)
+            else:
+                x.append((seed >> 7) - 0x800000)
+        inputs.append(x)
+    stream = []  # (channel, index) in scan order
+    for k in range(max(count for _, count in CASES)):
+        stream.extend((c, k) for c in range(n) if k < CASES[c][1])
+    got = [[] for _ in range(n)]
+    stamps_got = [[] for _ in range(n)]
+    codes, stamps, ids = array('i', bytes(4 * block)), array('I', bytes(4 * block)), bytearray(block)
+    for at in range(0, len(stream), block):
+        part = stream[at:at + block]
+        for j, (c, k) in enumerate(part):
+            codes[j], stamps[j], ids[j] = inputs[c][k], k, c
+        for j in range(dec.process(codes, stamps, ids, len(part))):
+            got[ids[j]].append(codes[j])
+            stamps_got[ids[j]].append(stamps[j])
+    total = 0
+    for c, (entry, _) in enumerate(CASES):
+        expected = _reference(entry, inputs[c])
+        r = parse(entry)[1]
+        last = list(range(len(inputs[c]) - len(expected) * r + r - 1, len(inputs[c]), r))
+        if got[c] != expected:
+            k = 0
+            while k < min(len(got[c]), len(expected)) and got[c][k] == expected[k]:
+                k += 1
+            raise AssertionError('%r output %d of %d: %s, expected %s' % (
+                entry, k, len(expected), got[c][k:k + 1], expected[k:k + 1]))
+        if stamps_got[c] != last:
+            raise AssertionError('%r stamps differ' % (entry,))
+        total += len(expected)
+    return total
+
+
+if __name__ == '__main__':
+    print(selftest(), 'outputs ok')
@@ -0,0 +1,208 @@
+""" Optional two-thread mode: acquisition on the calling thread, aggregation
+and storage on a _thread worker.
+
+The DRDY IRQ pushes every conversion into a ringbuffer.SampleRing, and the
+ring is the lock-free single-producer/single-consumer buffer between the
+two sides: only the producer moves head, only the worker moves tail. The
+calling thread does nothing but cycle the scanplan.Scanner. The worker
+drains the ring, decimates if given a decimate.Decimator, adds to a
+moments.Moments, packs binlog records (one per window, closed on exact
+window_ms boundaries and stamped in µs, see scheduler) and writes
+them to the log (LogWriter or ExtentLog), so a slow card write no longer
+holds up the sampling loop.
+
+The stock ESP32 build runs Python threads under a GIL. They interleave
+rather than run truly side by side, and the worker gains most where the
+other thread waits: its own idle sleeps and blocking I/O. Without _thread,
+or with threaded=False, run() calls the worker's poll() between scan
+cycles, which is the single-core baseline to compare against.
+
+report() gives, per thread, the busy time and utilisation over the run.
+For acquisition it also gives the longest stall between two scan cycles,
+which is what the second thread is meant to keep short.
+
+Given an instrument.Histograms (profile), run() attaches it to the capture
+and times each acquisition loop iteration, the worker times each block it
+aggregates, and a TIMING record goes to timing (default: printed as
+instrument.line) as each window closes.
+
+worker = dualcore.Worker(ring, acc, log, plan.n, raw=False, window_ms=1000)
+report = dualcore.run(scanner, worker, duration_ms=60000)
+"""
+
+from array import array
+import utime
+
+import binlog
+import instrument
+import scheduler
+
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+STACK = 16384  # the worker runs the FAT/SD write path
+
+
+class Worker:
+    def __init__(self, ring, acc, log, n, raw=False, window_ms=1000, block=256,
+                 show=None, idle_ms=1, decimator=None, profile=None, timing=None):
+        self.ring = ring
+        self.acc = acc
+        self.log = log
+        self.raw = raw
+        self.window_ms = window_ms
+        self.schedule = scheduler.Scheduler(window_ms=window_ms)
+        self.show = show  # called with the packed window record
+        self.idle_ms = idle_ms
+        self.decimator = decimator
+        self.codes = array('i', bytes(4 * block))
+        self.stamps = array('I', bytes(4 * block)) if raw else None
+        self.ids = bytearray(block)
+        self.record = bytearray(block * binlog.RAW_SIZE if raw else binlog.record_size(binlog.window_type(acc), n))
+        self.record_mv = memoryview(self.record)
+        self.profile = profile
+        self.timing = timing  # called with each packed TIMING record
+        self.timing_record = bytearray(binlog.timing_size()) if profile is not None else None
+        self.running = False
+        self.finished = True
+        self.threaded = False
+        # utilisation
+        self.busy_us = 0
+        self.polls = 0
+        self.idle_polls = 0
+        self.windows = 0
+
+    def start(self, threaded=True):
+        self.schedule.start()
+        self.running = True
+        self.threaded = threaded and _thread is not None
+        if self.threaded:
+            self.finished = False
+            try:
+                _thread.stack_size(STACK)
+            except ValueError:  # CPython's minimum is larger
+                pass
+            _thread.start_new_thread(self._run, ())
+
+    def stop(self):
+        """ Let the worker drain the ring and close the last window. """
+        self.running = False
+        if self.threaded:
+            while not self.finished:
+                utime.sleep_ms(1)
+        else:
+            while self.poll():
+                pass
+            self._close_window()
+
+    def _run(self):
+        try:
+            while self.running:
+                if not self.poll():
+                    utime.sleep_ms(self.idle_ms)  # gives up the GIL too
+            while self.poll():
+                pass
+            self._close_window()
+        finally:
+            self.finished = True
+
+    def poll(self):
+        """ One bounded unit of work: drain a block, and close the window if
+        it is due. Returns False if there was nothing to do. """
+        start = utime.ticks_us()
+        self.polls += 1
+        n = self.ring.drain(self.codes, self.stamps, self.ids)
+        drained = n
+        if n and self.decimator is not None:
+            n = self.decimator.process(self.codes, self.stamps, self.ids, n)
+        if n:
+            self.acc.add(self.codes, self.ids, n)
+            if self.raw:
+                self.log.write(self.record_mv[:binlog.pack_raws(self.record, self.codes, self.stamps, self.ids, n)])
+        if drained and self.profile is not None:
+            self.profile.since(instrument.AGGREGATE, start)
+        due = self.schedule.window_due()
+        if due:
+            self._close_window()
+        if not drained and not due:
+            self.idle_polls += 1
+            return False
+        self.busy_us += utime.ticks_diff(utime.ticks_us(), start)
+        return True
+
+    def _close_window(self):
+        us = self.schedule.close_window()
+        if not self.raw:
+            size = binlog.pack_window_record(self.record, us, self.acc)
+            self.log.write(self.record_mv[:size])
+            if self.show is not None:
+                self.show(self.record)
+        if self.profile is not None:
+            binlog.pack_timing(self.timing_record, us, self.profile)
+            if self.timing is not None:
+                self.timing(self.timing_record)
+            else:
+                print(instrument.line(self.timing_record))
+            self.profile.clear()
+        self.acc.clear()
+        self.windows += 1
+
+
+def run(scanner, worker, duration_ms=0, threaded=True):
+    """ Cycle the scanner on this thread until interrupted (or for
+    duration_ms) with the worker aggregating and storing. Returns report(). """
+    cycles = 0
+    busy = 0
+    max_stall = 0
+    prof = worker.profile
+    if prof is not None:
+        scanner.cap.profile = prof
+    scanner.start()
+    worker.start(threaded)
+    started = utime.ticks_us()
+    started_ms = utime.ticks_ms()
+    last = started
+    try:
+        while True:
+            start = utime.ticks_us()
+            stall = utime.ticks_diff(start, last)
+            if stall > max_stall:
+                max_stall = stall
+            scanner.cycle()
+            last = utime.ticks_us()
+            busy += utime.ticks_diff(last, start)
+            cycles += 1
+            if not worker.threaded:
+                worker.poll()  # counts towards the next stall
+            if prof is not None:
+                prof.since(instrument.LOOP, start)
+            if duration_ms and utime.ticks_diff(utime.ticks_ms(), started_ms) >= duration_ms:
+                break
+    finally:
+        scanner.stop()
+        worker.stop()
+    return report(worker, cycles, busy, max_stall, utime.ticks_diff(utime.ticks_us(), started),
+                  scanner.cap)
+
+
+def report(worker, cycles, busy_us, max_stall_us, elapsed_us, capture=None):
+    """ {'acquire': (cycles, busy µs, utilisation %, longest stall µs),
+         'worker': (busy polls, busy µs, utilisation %, windows),
+         'threaded': bool, 'elapsed_us': int, 'ring': ring.stats(),
+         'schedule': the worker's window schedule (scheduler.Scheduler.stats)}
+    and with a capture, 'capture': capture.errors(). """
+    elapsed = max(elapsed_us, 1)
+    out = {
+        'acquire': (cycles, busy_us, round(100 * busy_us / elapsed, 1), max_stall_us),
+        'worker': (worker.polls - worker.idle_polls, worker.busy_us,
+                   round(100 * worker.busy_us / elapsed, 1), worker.windows),
+        'threaded': worker.threaded,
+        'elapsed_us': elapsed_us,
+        'ring': worker.ring.stats(),
+        'schedule': worker.schedule.stats(),
+    }
+    if capture is not None:
+        out['capture'] = capture.errors()
+    return out
@@ -0,0 +1,361 @@
+""" Log into a contiguous, preallocated file with raw multi-block SD writes.
+
+Even with buffering (see logwriter), growing a FAT file means extra writes to
+the FAT and directory entry, and those show up as latency spikes. ExtentLog
+instead allocates the whole file when the session starts, checks that its
+clusters are contiguous, and from then on writes records straight into that
+block range. The FAT is not touched again until close().
+
+If the driver has SDCard.begin_stream, the data blocks go out through a
+single open CMD25 session instead of one CMD25/stop-token pair per buffer.
+The session starts with ACMD23 for the whole extent so the card can
+pre-erase it. Writing the progress mark ends the session and the next
+buffer opens a new one, so raise mark_every to keep sessions long.
+Drivers without streaming fall back to writeblocks.
+
+From a uasyncio task use write_async(). It waits for card programming with
+the driver's yielding busy wait, so other tasks run in the meantime.
+
+Layout of the extent: data blocks from the start of the file, and the last
+block is reserved for a progress mark (b'ADSX', bytes used, blocks used).
+The mark is rewritten every `mark_every` buffer writes and at close.
+
+close() unmounts the card, sets the directory entry size to the bytes
+actually used, frees the unused clusters and mounts it again. If power is
+lost first, call recover() on the next boot. It does the same fix-up using
+the last progress mark, so at most mark_every buffers are lost.
+
+Limits: FAT16/FAT32 with 512-byte sectors. The file must be in the root
+directory and have an 8.3 name (e.g. data12.bin). Do not open the file
+through the VFS while the extent is in use.
+
+log = extentlog.ExtentLog(sd, 'sd/data.bin', 8 * 1024 * 1024)
+log.write(record)
+log.close()
+"""
+
+import os
+import struct
+import utime
+
+import instrument
+
+BLOCK = 512
+MARK = b'ADSX'
+_MARK_FORMAT = '<4sII'
+_EOC = 0x0FFFFFFF
+
+
+def short_name(filename):
+    """ 'data12.bin' -> b'DATA12  BIN' (directory entry form). """
+    name = filename.split('/')[-1]
+    base, _, ext = name.partition('.')
+    if not 0 < len(base) <= 8 or len(ext) > 3 or '.' in ext:
+        raise ValueError('extent logs need an 8.3 file name')
+    return (base.upper() + ' ' * (8 - len(base)) + ext.upper() + ' ' * (3 - len(ext))).encode()
+
+
+class Volume:
+    """ Just enough FAT16/FAT32 to find and trim a root-directory file. """
+
+    def __init__(self, sd):
+        self.sd = sd
+        self.buf = bytearray(BLOCK)
+        self.cached = -1
+        self.dirty = False
+        b = self._read(0)
+        self.start = 0
+        if not (b[0] in (0xEB, 0xE9) and b[11] == 0x00 and b[12] == 0x02):
+            if b[510] != 0x55 or b[511] != 0xAA:
+                raise OSError('no FAT volume on card')
+            self.start = struct.unpack_from('<I', b, 0x1C6)[0]  # first partition
+            b = self._read(self.start)
+        if struct.unpack_from('<H', b, 0x0B)[0] != BLOCK:
+            raise OSError('only 512-byte sectors are supported')
+        self.spc = b[0x0D]
+        reserved = struct.unpack_from('<H', b, 0x0E)[0]
+        self.nfats = b[0x10]
+        root_entries = struct.unpack_from('<H', b, 0x11)[0]
+        total = struct.unpack_from('<H', b, 0x13)[0] or struct.unpack_from('<I', b, 0x20)[0]
+        self.fat_size = struct.unpack_from('<H', b, 0x16)[0] or struct.unpack_from('<I', b, 0x24)[0]
+        root_blocks = (root_entries * 32 + BLOCK - 1) // BLOCK
+        self.fat = self.start + reserved
+        self.root = self.fat + self.nfats * self.fat_size
+        self.data = self.root + root_blocks
+        clusters = (total - (reserved + self.nfats * self.fat_size + root_blocks)) // self.spc
+        if clusters < 4085:
+            raise OSError('FAT12 is not supported')
+        self.fat32 = clusters >= 65525
+        self.root_cluster = struct.unpack_from('<I', b, 0x2C)[0] if self.fat32 else 0
+
+    def _read(self, block):
+        if block != self.cached:
+            self.sync()
+            self.sd.readblocks(block, self.buf)
+            self.cached = block
+        return self.buf
+
+    def sync(self):
+        """ Write back the cached block if it was changed. """
+        if self.dirty:
+            self.sd.writeblocks(self.cached, self.buf)
+            self.dirty = False
+
+    def cluster_block(self, cluster):
+        return self.data + (cluster - 2) * self.spc
+
+    def fat_entry(self, cluster):
+        size = 4 if self.fat32 else 2
+        block, offset = divmod(cluster * size, BLOCK)
+        b = self._read(self.fat + block)
+        if self.fat32:
+            return struct.unpack_from('<I', b, offset)[0] & 0x0FFFFFFF
+        value = struct.unpack_from('<H', b, offset)[0]
+        return _EOC if value >= 0xFFF8 else value
+
+    def set_fat_entry(self, cluster, value, copy=0):
+        """ Change one entry in one FAT copy. Changes are cached per block;
+        call sync() when done. """
+        size = 4 if self.fat32 else 2
+        block, offset = divmod(cluster * size, BLOCK)
+        b = self._read(self.fat + copy * self.fat_size + block)
+        if self.fat32:
+            old = struct.unpack_from('<I', b, offset)[0]
+            struct.pack_into('<I', b, offset, (old & 0xF0000000) | (value & 0x0FFFFFFF))
+        else:
+            struct.pack_into('<H', b, offset, 0xFFFF if value == _EOC else value)
+        self.dirty = True
+
+    def _root_blocks(self):
+        if not self.fat32:
+            for block in range(self.root, self.data):
+                yield block
+            return
+        cluster = self.root_cluster
+        while 2 <= cluster < 0x0FFFFFF8:
+            for k in range(self.spc):
+                yield self.cluster_block(cluster) + k
+            cluster = self.fat_entry(cluster)
+
+    def find(self, filename):
+        """ Directory entry of a root-directory file:
+        (block, offset, first cluster, size). Raises OSError if missing. """
+        name = short_name(filename)
+        for block in self._root_blocks():
+            b = self._read(block)
+            for offset in range(0, BLOCK, 32):
+                if b[offset] == 0:
+                    raise OSError('%s not found' % filename)
+                if b[offset] == 0xE5 or b[offset + 11] == 0x0F:
+                    continue
+                if bytes(b[offset:offset + 11]) == name:
+                    hi, lo, size = struct.unpack_from('<H4xHI', b, offset + 20)
+                    return block, offset, (hi << 16 | lo) if self.fat32 else lo, size
+        raise OSError('%s not found' % filename)
+
+    def set_size(self, entry, size):
+        block, offset = entry[0], entry[1]
+        b = self._read(block)
+        struct.pack_into('<I', b, offset + 28, size)
+        self.dirty = True
+        self.sync()
+
+    def extent(self, first):
+        """ Number of clusters in the chain from `first`. Raises OSError if
+        the chain is not one contiguous run. """
+        count, cluster = 1, first
+        while True:
+            nxt = self.fat_entry(cluster)
+            if nxt >= 0x0FFFFFF8:
+                return count
+            if nxt != cluster + 1:
+                raise OSError('file is fragmented')
+            cluster = nxt
+            count += 1
+
+    def trim(self, first, keep):
+        """ Keep the first `keep` clusters of a contiguous chain, free the rest. """
+        total = self.extent(first)
+        keep = max(keep, 1)
+        for copy in range(self.nfats):
+            for k in range(keep, total):
+                self.set_fat_entry(first + k, 0, copy)
+            self.set_fat_entry(first + keep - 1, _EOC, copy)
+        self.sync()
+
+
+def preallocate(path, size):
+    """ Create `path` with `size` bytes allocated. Seeking past the end in
+    write mode makes FatFs allocate the clusters without writing the data,
+    so this only costs the FAT updates. """
+    with open(path, 'wb') as f:
+        f.seek(size - 1)
+        f.write(b'\x00')
+
+
+class ExtentLog:
+    def __init__(self, sd, path, size, mount='/sd', blocks_per_write=8, mark_every=16):
+        self.sd = sd
+        self.path = path
+        self.mount = mount
+        preallocate(path, size)
+        volume = Volume(sd)
+        entry = volume.find(path)
+        clusters = volume.extent(entry[2])
+        self.first_block = volume.cluster_block(entry[2])
+        self.capacity = clusters * volume.spc - 1  # data blocks; the last is the mark
+        self.mark_block = self.first_block + self.capacity
+        self.buf = bytearray(blocks_per_write * BLOCK)
+        self.mv = memoryview(self.buf)
+        self.markbuf = bytearray(BLOCK)
+        self.fill = 0
+        self.next = 0  # next data block, relative to first_block
+        self.mark_every = mark_every
+        self.stream = hasattr(sd, 'begin_stream')
+        self.erase = self.stream  # pre-erase the extent with the first session
+        self.closed = False
+        # write statistics (µs)
+        self.writes = 0
+        self.write_us_last = 0
+        self.write_us_max = 0
+        self.write_us_total = 0
+        self.profile = None  # an instrument.Histograms to count writes in
+        self._mark()
+
+    def used(self):
+        return self.next * BLOCK + self.fill
+
+    def write(self, data):
+        n = len(data)
+        done = 0
+        while done < n:
+            room = len(self.buf) - self.fill
+            take = min(room, n - done)
+            self.mv[self.fill:self.fill + take] = data[done:done + take]
+            self.fill += take
+            done += take
+            if self.fill == len(self.buf):
+                self._out(len(self.buf) // BLOCK)
+                self.fill = 0
+        return n
+
+    async def write_async(self, data):
+        """ write() for uasyncio tasks: while a full buffer programs, the
+        card busy wait yields so acquisition tasks keep running. Write
+        time in stats() then includes time spent in other tasks. """
+        n = len(data)
+        done = 0
+        while done < n:
+            room = len(self.buf) - self.fill
+            take = min(room, n - done)
+            self.mv[self.fill:self.fill + take] = data[done:done + take]
+            self.fill += take
+            done += take
+            if self.fill == len(self.buf):
+                await self._out_async(len(self.buf) // BLOCK)
+                self.fill = 0
+        return n
+
+    def _target(self, blocks):
+        if self.next + blocks > self.capacity:
+            raise OSError('extent full')
+        block = self.first_block + self.next
+        sd = self.sd
+        if self.stream and (not sd.streaming or sd.stream_block != block):
+            sd.begin_stream(block, self.capacity - self.next if self.erase else 0)
+            self.erase = False
+        return block
+
+    def _written(self, blocks, start):
+        us = utime.ticks_diff(utime.ticks_us(), start)
+        self.next += blocks
+        self.writes += 1
+        self.write_us_last = us
+        self.write_us_total += us
+        if us > self.write_us_max:
+            self.write_us_max = us
+        if self.profile is not None:
+            self.profile.add(instrument.FLUSH, us)
+        if self.writes % self.mark_every == 0:
+            self._mark()
+
+    def _out(self, blocks):
+        start = utime.ticks_us()
+        block = self._target(blocks)
+        if self.stream:
+            self.sd.write_stream(self.mv[:blocks * BLOCK])
+        else:
+            self.sd.writeblocks(block, self.mv[:blocks * BLOCK])
+        self._written(blocks, start)
+
+    async def _out_async(self, blocks):
+        start = utime.ticks_us()
+        block = self._target(blocks)
+        if self.stream:
+            await self.sd.write_stream_async(self.mv[:blocks * BLOCK])
+        else:
+            await self.sd.writeblocks_async(block, self.mv[:blocks * BLOCK])
+        self._written(blocks, start)
+
+    def _mark(self, used=None):
+        struct.pack_into(_MARK_FORMAT, self.markbuf, 0, MARK,
+                         self.next * BLOCK if used is None else used, self.next)
+        self.sd.writeblocks(self.mark_block, self.markbuf)
+
+    def poll(self):
+        pass
+
+    def flush(self):
+        """ Push out the buffered part block (zero padded). The padding is
+        overwritten by the next write, so use this sparingly. """
+        if self.fill:
+            used = self.used()
+            blocks = (self.fill + BLOCK - 1) // BLOCK
+            for k in range(self.fill, blocks * BLOCK):
+                self.buf[k] = 0
+            self._out(blocks)
+            self.next -= blocks  # keep filling the same blocks
+            self._mark(used)
+
+    def close(self):
+        if self.closed:
+            return
+        used = self.used()
+        self.flush()
+        self._mark(used)  # writeblocks also ends an open stream
+        self.closed = True
+        fix_length(self.sd, self.path, used, self.mount)
+
+    def stats(self):
+        """(block writes, bytes used, last, max and mean write time in µs)"""
+        mean = self.write_us_total // self.writes if self.writes else 0
+        return self.writes, self.used(), self.write_us_last, self.write_us_max, mean
+
+
+def fix_length(sd, path, used, mount=None):
+    """ Set the file size to `used` bytes and free the clusters after it.
+    With mount given, the card is unmounted around the raw FAT writes. """
+    if mount:
+        os.umount(mount)
+    volume = Volume(sd)
+    entry = volume.find(path)
+    volume.trim(entry[2], (used + volume.spc * BLOCK - 1) // (volume.spc * BLOCK))
+    volume.set_size(entry, used)
+    if mount:
+        os.mount(os.VfsFat(sd), mount)
+
+
+def recover(sd, path, mount=None):
+    """ Fix up an extent that was never closed, from its progress mark.
+    Returns the recovered length, or None if the file is not an unclosed
+    extent. With mount given, the card is unmounted around the fix-up. """
+    volume = Volume(sd)
+    entry = volume.find(path)
+    clusters = volume.extent(entry[2])
+    b = bytearray(BLOCK)
+    sd.readblocks(volume.cluster_block(entry[2]) + clusters * volume.spc - 1, b)
+    magic, used, _ = struct.unpack_from(_MARK_FORMAT, b, 0)
+    if magic != MARK or used == entry[3]:
+        return None
+    fix_length(sd, path, used, mount)
+    return used
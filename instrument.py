@@ -0,0 +1,147 @@
+""" Counters and log2 histograms of where the time goes, per stage.
+
+    spi         the DRDY IRQ's read: RDATA (or the chained switch) transfer
+                and the ring push (see ads1261evm.DrdyCapture)
+    conversion  DRDY to DRDY, the data period the reader actually sees
+    aggregate   decimating and accumulating one drained block
+    flush       one write of buffered blocks to the card (logwriter,
+                extentlog)
+    loop        one iteration of the acquisition loop
+
+Each stage keeps a count, the total and the longest duration in µs, and
+BUCKETS counts by bit length: bucket 0 holds 0 µs, bucket k durations of
+2**(k-1) to 2**k - 1 µs, and the last bucket everything from 2**18 µs
+(262 ms) up. Histograms.add is one viper call with no allocation, so it can
+run in the DRDY IRQ.
+
+Nothing is timed unless a Histograms is attached: the capture, the log
+writers, pipeline.Pipeline and dualcore.Worker keep profile = None, and
+the capture only swaps in its timed IRQ handler when started with one. The
+cost when off is a None test per block or loop iteration.
+
+The histograms are emitted once per window as a binlog TIMING record
+(binlog.pack_timing), to their own log and/or as line() on the serial
+console, and then cleared. Counts and totals are therefore per window.
+
+prof = instrument.Histograms()
+capture.profile = log.profile = prof     # before capture.start()
+...
+binlog.pack_timing(record, stamp_us, prof)
+print(instrument.line(record))
+prof.clear()
+"""
+
+from array import array
+import micropython
+import struct
+import utime
+
+import binlog
+
+STAGES = binlog.TIMING_STAGES
+SPI, CONVERSION, AGGREGATE, FLUSH, LOOP = range(len(STAGES))
+BUCKETS = binlog.TIMING_BUCKETS
+
+
+class Histograms:
+    record_type = binlog.TIMING
+
+    def __init__(self):
+        self.n = n = len(STAGES)
+        self.nbuckets = BUCKETS
+        self.buckets = array('I', bytes(4 * BUCKETS * n))
+        self.counts = array('I', bytes(4 * n))
+        self.totals = array('I', bytes(4 * n))
+        self.maxima = array('I', bytes(4 * n))
+
+    @micropython.viper
+    def add(self, stage: int, us: int):
+        """ Count a duration of us µs in stage. """
+        if us < 0:
+            us = 0
+        nb = int(self.nbuckets)
+        k = 0
+        v = us
+        while v:
+            k += 1
+            v >>= 1
+        if k >= nb:
+            k = nb - 1
+        ptr32(self.buckets)[stage * nb + k] += 1
+        ptr32(self.counts)[stage] += 1
+        ptr32(self.totals)[stage] += us
+        maxima = ptr32(self.maxima)
+        if us > maxima[stage]:
+            maxima[stage] = us
+
+    def since(self, stage, start):
+        """ Count the µs from ticks_us() start until now in stage. """
+        self.add(stage, utime.ticks_diff(utime.ticks_us(), start))
+
+    def stats(self, stage):
+        """(count, total µs, max µs)"""
+        return self.counts[stage], self.totals[stage], self.maxima[stage]
+
+    def histogram(self, stage):
+        return self.buckets[stage * BUCKETS:(stage + 1) * BUCKETS]
+
+    def clear(self):
+        for a in (self.buckets, self.counts, self.totals, self.maxima):
+            for k in range(len(a)):
+                a[k] = 0
+
+
+def line(record):
+    """ A TIMING record as one short line, stages that saw nothing left out:
+    name count, mean, 99th percentile bucket edge and max in µs. """
+    us = struct.unpack_from(binlog.WINDOW_STAMP, record)[0]
+    out = ['%d ms' % (us // 1000)]
+    for k, name in enumerate(STAGES):
+        values = struct.unpack_from(binlog.TIMING_STAGE, record,
+                                    binlog.WINDOW_STAMP_SIZE + binlog.TIMING_STAGE_SIZE * k)
+        count, total, longest = values[:3]
+        if count:
+            out.append('%s n%d avg%d p99<%d max%d' % (name, count, total // count,
+                                                      binlog.percentile_us(values[3:], 0.99),
+                                                      longest))
+    return ' | '.join(out)
+
+
+# (duration µs, bucket): both sides of every bit-length edge that matters
+EDGES = ((-5, 0), (0, 0), (1, 1), (2, 2), (3, 2), (4, 3), (7, 3), (8, 4),
+         (1023, 10), (1024, 11), ((1 << 18) - 1, 18), (1 << 18, 19), (10 ** 7, 19))
+
+
+def selftest():
+    """ Check Histograms.add() against the EDGES bucket edges, and the
+    counts, totals and maxima through a pack_timing() record and line().
+    Returns the number of edges; raises AssertionError on the first
+    mismatch. """
+    prof = Histograms()
+    for us, bucket in EDGES:
+        prof.clear()
+        prof.add(LOOP, us)
+        got = list(prof.histogram(LOOP))
+        if got != [int(k == bucket) for k in range(BUCKETS)]:
+            raise AssertionError('add(%d) counted in bucket %s, expected %d'
+                                 % (us, [k for k in range(BUCKETS) if got[k]], bucket))
+    prof.clear()
+    for us in (3, 30, 300):
+        prof.add(SPI, us)
+    prof.add(FLUSH, 5000)
+    for stage, expected in ((SPI, (3, 333, 300)), (FLUSH, (1, 5000, 5000)), (LOOP, (0, 0, 0))):
+        if prof.stats(stage) != expected:
+            raise AssertionError('stats(%s) = %s, expected %s' % (STAGES[stage], prof.stats(stage), expected))
+    if binlog.percentile_us(prof.histogram(SPI), 0.5) != 32 or binlog.percentile_us(prof.histogram(LOOP), 0.99):
+        raise AssertionError('percentile_us')
+    record = bytearray(binlog.timing_size())
+    binlog.pack_timing(record, 2500000, prof)
+    got = line(record)
+    expected = '2500 ms | spi n3 avg111 p99<512 max300 | flush n1 avg5000 p99<8192 max5000'
+    if got != expected:
+        raise AssertionError('line() = %r, expected %r' % (got, expected))
+    return len(EDGES)
+
+
+if __name__ == '__main__':
+    print(selftest(), 'edges ok')
@@ -0,0 +1,135 @@
+""" Synchronous (lock-in) demodulation of the switched excitation current.
+
+The excitation switch (Pin 32, a channel spec's 'current') reverses the
+current through the sensor and the RTD. Offsets that do not follow the
+current (thermocouple EMFs at the wiring junctions, amplifier offset) then
+cancel in the difference of the two polarities:
+
+    difference = (mean forward - mean reverse) / 2   the excited signal
+    common     = (mean forward + mean reverse) / 2   the offset left over
+
+LockIn expands a channel list into a scan in which every channel is read
+in both phases, in the order
+
+    A+ B+ ... B+ A+   ->   A+ B+ B- A- A- B- B+ A+
+
+so the forward and reverse samples of each channel have the same mean
+time, and a linear drift cancels as well. The current switches twice per
+scan and the scan rate is unchanged. The plan restarts the conversion at
+each switch, even where the registers stay the same (B+ B-, or A+ A- with
+one channel), so no conversion straddles a reversal. The plan channel a sample comes from
+is its phase tag. LockIn keeps the per-phase sums in a moments.Moments, so
+the demodulation is exact integer arithmetic and costs nothing until the
+window is read.
+
+The ADS1261's own chop or AC-excitation mode (ScanPlan's chop, one of
+ADC1261.mode1register's 'chop', '2-wire ac-excitation' or '4-wire
+ac-excitation') can be used underneath. It cancels the ADC's offset within
+each conversion, at a lower conversion rate.
+
+lock = lockin.LockIn(datalogger.CHANNELS)
+plan = scanplan.ScanPlan(adc, lock.specs)
+lock.add(codes, ids, n)           # as the ring is drained, like a Moments
+lock.difference_mV(0), lock.common_mV(0)
+binlog.pack_lockin(record, sched.close_window(), lock)
+"""
+
+from array import array
+
+import binlog
+import codec
+import moments
+import scanplan
+
+FORWARD = 1  # level of the excitation switch for the forward phase
+REVERSE = 0
+
+
+class LockIn:
+    record_type = binlog.LOCKIN
+
+    def __init__(self, channels, reference=5000):
+        # only what the channels give: the plan fills in the rest, so that
+        # pulse.plan can still pick filter and delay
+        base = [c if isinstance(c, dict) else dict(zip(scanplan.KEYS, c)) for c in channels]
+        self.n = n = len(base)
+        self.specs = []
+        self.outputs = bytearray()  # physical channel of each plan channel
+        self.phases = bytearray()  # 1 forward, 0 reverse
+        order = [(k, FORWARD) for k in range(n)] + [(k, REVERSE) for k in reversed(range(n))]
+        for k, phase in order + order[::-1]:
+            s = dict(base[k])
+            s['current'] = phase
+            self.specs.append(s)
+            self.outputs.append(k)
+            self.phases.append(phase)
+        self.scales = array('f', [codec.scale(reference, scanplan.spec(s)['gain']) for s in base])
+        self.acc = moments.Moments(len(self.specs))
+
+    def add(self, codes, channels, n):
+        """ Add codes of plan channels, as moments.Moments.add. """
+        self.acc.add(codes, channels, n)
+
+    def clear(self):
+        self.acc.clear()
+
+    def phase(self, c, phase):
+        """ (count, sum, sum of squares) of channel c's codes in phase. """
+        acc = self.acc
+        count = total = squares = 0
+        for k in range(len(self.outputs)):
+            if self.outputs[k] == c and self.phases[k] == phase:
+                count += acc.count(k)
+                total += acc.total(k)
+                squares += acc.squares(k)
+        return count, total, squares
+
+    def count(self, c):
+        """ Samples behind channel c's output: the fewer of the two phases. """
+        return min(self.phase(c, FORWARD)[0], self.phase(c, REVERSE)[0])
+
+    def difference_mV(self, c):
+        """ Half the forward minus reverse mean of channel c in mV: the
+        signal the excitation current produces. """
+        return codec.demodulate(self.phase(c, FORWARD), self.phase(c, REVERSE), self.scales[c])[0]
+
+    def common_mV(self, c):
+        """ Mean of the forward and reverse means of channel c in mV: the
+        offset the reversal cancels. """
+        return codec.demodulate(self.phase(c, FORWARD), self.phase(c, REVERSE), self.scales[c])[1]
+
+
+# (spec, offset, excited signal) in codes per channel, for selftest()
+SIGNALS = (({'positive': 'AIN3', 'negative': 'AIN4'}, 123456, 4321),
+           ({'positive': 'AIN6', 'negative': 'AIN7', 'gain': 4}, -700000, -250000))
+
+
+def selftest(scans=100, drift=3):
+    """ Feed scans of the SIGNALS channels, each code its offset plus or
+    minus its signal by phase, on a ramp of drift codes per sample, and
+    check difference_mV() gives the signal alone and common_mV() the
+    offset at the ramp's midpoint. Returns the number of channels; raises
+    AssertionError on the first mismatch. """
+    lock = LockIn([s for s, _, _ in SIGNALS])
+    m = len(lock.specs)
+    codes = array('i', bytes(4 * m * scans))
+    ids = bytearray(m * scans)
+    for t in range(m * scans):
+        k = t % m
+        _, offset, signal = SIGNALS[lock.outputs[k]]
+        codes[t] = offset + (signal if lock.phases[k] == FORWARD else -signal) + drift * t
+        ids[t] = k
+    lock.add(codes, ids, m * scans)
+    for c, (_, offset, signal) in enumerate(SIGNALS):
+        scale = lock.scales[c]
+        for name, got, expected in (('count', lock.count(c), 2 * scans),
+                                    ('difference_mV', lock.difference_mV(c), signal * scale),
+                                    ('common_mV', lock.common_mV(c),
+                                     (offset + drift * (m * scans - 1) / 2) * scale)):
+            if abs(got - expected) > 1e-5 * abs(expected):  # float32 on the ESP32
+                raise AssertionError('%s(%d) = %f, expected %f' % (name, c, got, expected))
+    return len(SIGNALS)
+
+
+if __name__ == '__main__':
+    print(selftest(), 'channels ok')
@@ -0,0 +1,131 @@
+""" Persistent log file with a configurable flush/sync policy.
+
+datalogger.write() opens, appends and closes the file for every line, which
+repeats the FAT directory lookup and cluster-chain update each time (about
+60 ms per write). LogWriter keeps the file open and collects records in a
+RAM buffer. The buffer goes to the card in whole 512-byte blocks once any
+limit in the policy is reached. The blocks are those of the file, so when
+appending to a file whose length is not a multiple of 512 (a binlog header,
+say) the first flush only tops up its last block, and every write after
+it starts on a card sector:
+
+flush_bytes   - buffered bytes (rounded up to whole blocks)
+flush_records - write() calls since the last flush (0 = no limit)
+flush_ms      - time since the last flush (0 = no limit); this also pushes
+                out a trailing part block so nothing waits longer than this
+sync          - call f.flush() after each flush so the FAT and directory
+                entry are updated (survives the card being pulled)
+
+The presets in POLICIES go from 'durable' (every record reaches the card)
+to 'throughput' (8 KB at a time, synced every 10 s).
+
+log = logwriter.LogWriter('sd/data.bin', **logwriter.POLICIES['balanced'])
+log.write(record)
+log.close()
+"""
+
+import os
+import utime
+
+import instrument
+
+BLOCK = 512
+
+POLICIES = {
+    'durable': {'flush_bytes': BLOCK, 'flush_records': 1, 'flush_ms': 0, 'sync': True},
+    'balanced': {'flush_bytes': 4096, 'flush_records': 0, 'flush_ms': 1000, 'sync': True},
+    'throughput': {'flush_bytes': 8192, 'flush_records': 0, 'flush_ms': 10000, 'sync': False},
+}
+
+
+class LogWriter:
+    def __init__(self, filename, mode='ab', flush_bytes=4096, flush_records=0,
+                 flush_ms=1000, sync=True):
+        size = max(BLOCK, (flush_bytes + BLOCK - 1) // BLOCK * BLOCK)
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.fill = 0
+        self.flush_bytes = size
+        self.flush_records = flush_records
+        self.flush_ms = flush_ms
+        self.sync = sync
+        self.records = 0
+        self.last = utime.ticks_ms()
+        self.skew = 0  # file length modulo BLOCK
+        if 'a' in mode:
+            try:
+                self.skew = os.stat(filename)[6] % BLOCK
+            except OSError:  # a new file
+                pass
+        self.f = open(filename, mode)
+        # flush statistics (µs)
+        self.flushes = 0
+        self.bytes_written = 0
+        self.flush_us_last = 0
+        self.flush_us_max = 0
+        self.flush_us_total = 0
+        self.profile = None  # an instrument.Histograms to count flushes in
+
+    def write(self, data):
+        n = len(data)
+        if self.fill + n > len(self.buf):
+            self.flush()
+            if self.fill + n > len(self.buf):
+                self.flush(force=True)
+            if n > len(self.buf):  # bigger than the whole buffer: straight through
+                self._out(data, n)
+                return n
+        self.mv[self.fill:self.fill + n] = data
+        self.fill += n
+        self.records += 1
+        if self.fill >= self.flush_bytes:
+            self.flush()
+        elif self.flush_records and self.records >= self.flush_records:
+            self.flush(force=True)
+        elif self.flush_ms and utime.ticks_diff(utime.ticks_ms(), self.last) >= self.flush_ms:
+            self.flush(force=True)
+        return n
+
+    def poll(self):
+        """Apply the flush_ms limit when no records are arriving."""
+        if self.fill and self.flush_ms and utime.ticks_diff(utime.ticks_ms(), self.last) >= self.flush_ms:
+            self.flush(force=True)
+
+    def flush(self, force=False):
+        """Write out up to the last whole block of the file, or everything
+        if force."""
+        end = self.skew + self.fill
+        n = self.fill if force else end - end % BLOCK - self.skew
+        if n > 0:
+            self._out(self.mv[:n], n)
+            rest = self.fill - n
+            if rest:
+                self.mv[:rest] = self.mv[n:self.fill]
+            self.fill = rest
+        self.records = 0
+        self.last = utime.ticks_ms()
+
+    def _out(self, data, n):
+        start = utime.ticks_us()
+        self.f.write(data)
+        if self.sync:
+            self.f.flush()
+        us = utime.ticks_diff(utime.ticks_us(), start)
+        self.skew = (self.skew + n) % BLOCK
+        self.flushes += 1
+        self.bytes_written += n
+        self.flush_us_last = us
+        self.flush_us_total += us
+        if us > self.flush_us_max:
+            self.flush_us_max = us
+        if self.profile is not None:
+            self.profile.add(instrument.FLUSH, us)
+
+    def close(self):
+        self.flush(force=True)
+        self.f.close()
+
+    def stats(self):
+        """(flushes, bytes written, last, max and mean flush time in µs)"""
+        mean = self.flush_us_total // self.flushes if self.flushes else 0
+        return self.flushes, self.bytes_written, self.flush_us_last, self.flush_us_max, mean
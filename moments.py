@@ -0,0 +1,129 @@
+""" Exact per-channel window statistics of raw ADS1261 codes.
+
+Moments keeps, per channel, the sample count, the sum and sum of squares of
+the signed 24-bit codes, and their minimum, maximum and last value, in
+constant memory. All of it is integer arithmetic, so a window's mean, noise
+and extremes can be reproduced exactly from the raw data. Reference and
+gain scaling are applied once, when the window is read out. (A Welford
+update would need a float per sample, and floats are heap objects on the
+ESP32; with exact integer sums the variance has no cancellation error to
+guard against in the first place.)
+
+Python ints above 2**30 are heap objects on the ESP32, so adding a code to a
+growing total would allocate. Here every total is kept in 24-bit limbs
+(value = hi * 2**24 + lo, lo in [0, 2**24)) and updated in one viper loop
+in which no intermediate value exceeds 2**26. A square of up to 2**46 is
+built from the 12-bit halves of the code's magnitude:
+
+    a = ah * 2**12 + al
+    a * a = ah**2 * 2**24 + 2 * ah * al * 2**12 + al**2
+
+The sum has two limbs and the sum of squares three, which is enough for
+2**31 samples of any value per window.
+
+acc = moments.Moments(2)
+n = ring.drain(codes, None, ids)
+acc.add(codes, ids, n)
+acc.mean_mV(0, codec.scale(5000, 1)), acc.noise_mV(0, codec.scale(5000, 1))
+acc.minimum(0), acc.maximum(0), acc.last(0)  # raw codes
+acc.clear()
+"""
+
+from array import array
+import micropython
+from micropython import const
+
+import codec
+
+_WORDS = const(8)  # sum lo, sum hi, squares lo, mid, hi, min, max, last
+_EMPTY_MIN = const(8388607)
+_EMPTY_MAX = const(-8388608)
+
+
+class Moments:
+    def __init__(self, n):
+        self.n = n
+        self.counts = array('I', bytes(4 * n))
+        self.words = array('i', bytes(4 * _WORDS * n))
+        self.one = array('i', bytes(4))  # for add_one()
+        self.one_id = bytearray(1)
+        self.clear()
+
+    @micropython.viper
+    def add(self, codes, channels, n: int):
+        """ Add codes[0:n] (an array('i')) to the channels in channels[0:n]. """
+        counts = ptr32(self.counts)
+        words = ptr32(self.words)
+        src = ptr32(codes)
+        ids = ptr8(channels)
+        k = 0
+        while k < n:
+            c = ids[k]
+            v = src[k]
+            counts[c] += 1
+            w = c * 8
+            if v < words[w + 5]:
+                words[w + 5] = v
+            if v > words[w + 6]:
+                words[w + 6] = v
+            words[w + 7] = v
+            lo = words[w] + v
+            words[w + 1] += lo >> 24
+            words[w] = lo & 0xFFFFFF
+            if v < 0:
+                v = 0 - v
+            ah = v >> 12
+            al = v & 0xFFF
+            m = ah * al * 2
+            s0 = words[w + 2] + ((m & 0xFFF) << 12) + al * al
+            s1 = words[w + 3] + ah * ah + (m >> 12) + (s0 >> 24)
+            words[w + 2] = s0 & 0xFFFFFF
+            words[w + 3] = s1 & 0xFFFFFF
+            words[w + 4] += s1 >> 24
+            k += 1
+
+    def add_one(self, code, channel):
+        self.one[0] = code
+        self.one_id[0] = channel
+        self.add(self.one, self.one_id, 1)
+
+    def count(self, c):
+        return self.counts[c]
+
+    def total(self, c):
+        """ Sum of the codes on channel c. """
+        w = self.words
+        return (w[_WORDS * c + 1] << 24) + w[_WORDS * c]
+
+    def squares(self, c):
+        """ Sum of the squared codes on channel c. """
+        w = self.words
+        k = _WORDS * c
+        return (w[k + 4] << 48) + (w[k + 3] << 24) + w[k + 2]
+
+    def minimum(self, c):
+        return self.words[_WORDS * c + 5]
+
+    def maximum(self, c):
+        return self.words[_WORDS * c + 6]
+
+    def last(self, c):
+        return self.words[_WORDS * c + 7]
+
+    def mean_mV(self, c, mv_per_code):
+        """ Mean of channel c in mV, 0 if the window is empty. """
+        n = self.counts[c]
+        return codec.mean_mV(self.total(c), n, mv_per_code) if n else 0
+
+    def noise_mV(self, c, mv_per_code):
+        """ Sample standard deviation of channel c in mV. """
+        return codec.noise_mV(self.counts[c], self.total(c), self.squares(c), mv_per_code)
+
+    def clear(self):
+        w = self.words
+        for k in range(len(w)):
+            w[k] = 0
+        for c in range(self.n):
+            self.counts[c] = 0
+            w[_WORDS * c + 5] = _EMPTY_MIN
+            w[_WORDS * c + 6] = _EMPTY_MAX
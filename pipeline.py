@@ -0,0 +1,399 @@
+""" Acquisition, aggregation and storage as uasyncio stages.
+
+    acquire ──blocks──> aggregate ──records──> sink 'sd'
+                                         └───> sink 'serial' ...
+
+acquire   cycles a scanplan.Scanner (DRDY-driven, see ads1261evm.DrdyCapture)
+          and drains the sample ring into preallocated blocks.
+aggregate decimates each block (optional, see decimate), adds it to a
+          moments.Moments (or a lockin.LockIn) and packs one binlog STATS
+          (LOCKIN)
+          record per window (with raw=True, RAW records per block instead).
+          Windows close on exact window_ms boundaries from the start and
+          are stamped in µs (see scheduler).
+sinks     each get their own bounded queue of records and write them at
+          their own pace, e.g. an extentlog.ExtentLog (write_async) or a
+          logwriter.LogWriter, or a print to the serial console.
+
+Given a spectrum.Spectrum, aggregate also feeds it every block and packs a
+SPECTRUM record per window, which goes only to the sinks added with
+spectrum=True. Given an instrument.Histograms (profile), it is attached
+to the capture, the acquire loop and aggregate stage add to it, and a
+TIMING record per window goes to the sinks added with timing=True.
+
+Blocks and records are preallocated and handed along by index, so nothing
+is allocated per sample. A record shared by several sinks goes back to its
+pool when the last one is done with it.
+
+Backpressure: a full queue never stalls the stage before it for long. If the
+aggregator is behind, acquire leaves samples in the ring (the DRDY IRQ keeps
+filling it) and counts a stall. If a sink is behind, the aggregator drops
+the record for that sink only and counts it. A slow card therefore only
+slows the 'sd' sink. report() gives, per stage, the items handled, busy
+time, the latency from an item being made to it being done with, and for
+every queue the high-water mark, stalls and drops.
+
+pipe = pipeline.Pipeline(scanner, ring, acc, plan.scales, window_ms=1000)
+pipe.add_sink('sd', log.write_async, awaitable=True)
+pipe.add_sink('serial', print_window)
+uasyncio.run(pipe.run(duration_ms=60000))
+"""
+
+from array import array
+import struct
+import utime
+import uasyncio as asyncio
+
+import binlog
+import codec
+import instrument
+import scheduler
+
+
+class Queue:
+    """ Bounded FIFO of small ints (pool indices) between two stages. """
+
+    def __init__(self, depth):
+        self.size = depth + 1
+        self.items = array('H', bytes(2 * self.size))
+        self.head = 0
+        self.tail = 0
+        self.closed = False
+        self.event = asyncio.Event()  # set on every put and on close
+        self.high_water = 0
+        self.stalls = 0  # producer found no free buffer and held back
+        self.dropped = 0
+
+    def __len__(self):
+        n = self.head - self.tail
+        return n + self.size if n < 0 else n
+
+    def put_nowait(self, item):
+        """ Add item, or return False (counted as dropped) if full. """
+        nxt = self.head + 1
+        if nxt == self.size:
+            nxt = 0
+        if nxt == self.tail:
+            self.dropped += 1
+            return False
+        self.items[self.head] = item
+        self.head = nxt
+        n = len(self)
+        if n > self.high_water:
+            self.high_water = n
+        self.event.set()
+        return True
+
+    def get_nowait(self):
+        """ The oldest item, or -1 if empty. """
+        if self.head == self.tail:
+            return -1
+        item = self.items[self.tail]
+        self.tail += 1
+        if self.tail == self.size:
+            self.tail = 0
+        return item
+
+    async def get(self):
+        """ The oldest item, waiting for one; -1 once closed and empty. """
+        while self.head == self.tail:
+            if self.closed:
+                return -1
+            self.event.clear()
+            await self.event.wait()
+        return self.get_nowait()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    def stats(self):
+        """(waiting, high water, stalls, dropped)"""
+        return len(self), self.high_water, self.stalls, self.dropped
+
+
+class Pool:
+    """ Preallocated buffers handed between stages by index, with the
+    ticks_us they were filled, their used length and a share count. """
+
+    def __init__(self, buffers):
+        count = len(buffers)
+        self.buffers = buffers
+        self.lengths = array('I', bytes(4 * count))
+        self.made = array('I', bytes(4 * count))
+        self.refs = bytearray(count)
+        self.free = Queue(count)
+        for k in range(count):
+            self.free.put_nowait(k)
+
+    def take(self):
+        """ A free buffer index, or -1 if all are in use. """
+        return self.free.get_nowait()
+
+    def release(self, k):
+        self.refs[k] -= 1
+        if not self.refs[k]:
+            self.free.put_nowait(k)
+
+
+class Stage:
+    """ Per-stage counters; latencies and busy time in µs. """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_us = 0
+        self.latency_last = 0
+        self.latency_max = 0
+        self.latency_total = 0
+
+    def done(self, made, start):
+        now = utime.ticks_us()
+        self.items += 1
+        self.busy_us += utime.ticks_diff(now, start)
+        latency = utime.ticks_diff(now, made)
+        self.latency_last = latency
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+    def stats(self):
+        """(items, busy µs, last, max and mean latency in µs)"""
+        mean = self.latency_total // self.items if self.items else 0
+        return self.items, self.busy_us, self.latency_last, self.latency_max, mean
+
+
+class Sink:
+    def __init__(self, name, write, depth, awaitable, pool):
+        self.name = name
+        self.write = write
+        self.awaitable = awaitable
+        self.pool = pool  # the record stream it takes
+        self.queue = Queue(depth)
+        self.stage = Stage(name)
+
+
+class Pipeline:
+    def __init__(self, scanner, ring, acc, scales, window_ms=1000, raw=False,
+                 block=128, blocks=4, records=4, decimator=None, spectrum=None, profile=None):
+        self.scanner = scanner
+        self.ring = ring
+        self.acc = acc
+        self.scales = scales
+        self.window_ms = window_ms
+        self.raw = raw
+        self.block = block
+        self.decimator = decimator
+        self.blocks = Pool([(array('i', bytes(4 * block)),
+                             array('I', bytes(4 * block)) if raw else None,
+                             bytearray(block)) for _ in range(blocks)])
+        size = block * binlog.RAW_SIZE if raw else binlog.record_size(binlog.window_type(acc), acc.n)
+        self.records = Pool([bytearray(size) for _ in range(records)])
+        self.spectrum = spectrum
+        self.spectra = Pool([bytearray(binlog.spectrum_size(spectrum.nbins))
+                             for _ in range(records)]) if spectrum is not None else None
+        self.profile = profile
+        self.timings = Pool([bytearray(binlog.timing_size())
+                             for _ in range(records)]) if profile is not None else None
+        if profile is not None:
+            scanner.cap.profile = profile
+        self.filled = Queue(blocks)
+        self.sinks = []
+        self.acquire_stage = Stage('acquire')
+        self.aggregate_stage = Stage('aggregate')
+        self.lost_records = 0  # no free record buffer: every sink was behind
+        self.running = False
+        self.started_ms = 0
+        self.schedule = scheduler.Scheduler(window_ms=window_ms)
+
+    def add_sink(self, name, write, depth=4, awaitable=False, spectrum=False, timing=False):
+        """ write(memoryview) is called with each record; with awaitable
+        it returns a coroutine (e.g. ExtentLog.write_async). spectrum=True
+        takes the SPECTRUM records instead of the window or raw ones, and
+        timing=True the TIMING ones. """
+        if spectrum and self.spectra is None:
+            raise ValueError('pipeline has no spectrum')
+        if timing and self.timings is None:
+            raise ValueError('pipeline has no profile')
+        pool = self.spectra if spectrum else self.timings if timing else self.records
+        sink = Sink(name, write, depth, awaitable, pool)
+        self.sinks.append(sink)
+        return sink
+
+    def stop(self):
+        self.running = False
+
+    async def run(self, duration_ms=0):
+        """ Run all stages until stop() (or for duration_ms), then drain
+        what is in flight and return report(). """
+        self.running = True
+        self.started_ms = utime.ticks_ms()
+        self.schedule.start()
+        tasks = [asyncio.create_task(self._sink(s)) for s in self.sinks]
+        aggregate = asyncio.create_task(self.aggregate())
+        await self.acquire(duration_ms)
+        await aggregate
+        for sink in self.sinks:
+            sink.queue.close()
+        for task in tasks:
+            await task
+        return self.report()
+
+    # ---- stages
+
+    async def acquire(self, duration_ms=0):
+        scanner, ring, prof = self.scanner, self.ring, self.profile
+        scanner.start()
+        while self.running:
+            start = utime.ticks_us()
+            scanner.cycle()
+            if len(ring) >= self.block:
+                self._hand_over(start)
+            if prof is not None:
+                prof.since(instrument.LOOP, start)
+            if duration_ms and utime.ticks_diff(utime.ticks_ms(), self.started_ms) >= duration_ms:
+                self.running = False
+            await asyncio.sleep_ms(0)
+        scanner.stop()
+        while len(ring) and self._hand_over(utime.ticks_us()):
+            await asyncio.sleep_ms(0)
+        self.filled.close()
+
+    def _hand_over(self, start):
+        pool = self.blocks
+        k = pool.take()
+        if k < 0:
+            self.filled.stalls += 1  # aggregator behind; samples wait in the ring
+            return False
+        codes, stamps, ids = pool.buffers[k]
+        pool.lengths[k] = self.ring.drain(codes, stamps, ids)
+        pool.made[k] = start
+        pool.refs[k] = 1
+        self.filled.put_nowait(k)
+        self.acquire_stage.done(start, start)
+        return True
+
+    async def aggregate(self):
+        pool, acc = self.blocks, self.acc
+        while True:
+            k = await self.filled.get()
+            if k < 0:
+                break
+            start = utime.ticks_us()
+            codes, stamps, ids = pool.buffers[k]
+            n = pool.lengths[k]
+            if self.decimator is not None:
+                n = self.decimator.process(codes, stamps, ids, n)
+            acc.add(codes, ids, n)
+            if self.spectrum is not None:
+                self.spectrum.add(codes, ids, n)
+            if self.raw and n:
+                r = self.records.take()
+                if r < 0:
+                    self.lost_records += 1
+                else:
+                    self.records.lengths[r] = binlog.pack_raws(self.records.buffers[r], codes, stamps, ids, n)
+                    self._publish(self.records, r, start)
+            self.aggregate_stage.done(pool.made[k], start)
+            if self.profile is not None:
+                self.profile.since(instrument.AGGREGATE, start)
+            pool.release(k)
+            if self.schedule.window_due():
+                self._close_window(start)
+        self._close_window(utime.ticks_us())
+
+    def _close_window(self, start):
+        us = self.schedule.close_window()
+        if not self.raw:
+            r = self.records.take()
+            if r < 0:
+                self.lost_records += 1
+            else:
+                self.records.lengths[r] = binlog.pack_window_record(self.records.buffers[r], us, self.acc)
+                self._publish(self.records, r, start)
+        if self.spectrum is not None:
+            r = self.spectra.take()
+            if r < 0:
+                self.lost_records += 1
+            else:
+                self.spectra.lengths[r] = binlog.pack_spectrum(self.spectra.buffers[r], us, self.spectrum)
+                self._publish(self.spectra, r, start)
+            self.spectrum.clear()
+        if self.profile is not None:
+            r = self.timings.take()
+            if r < 0:
+                self.lost_records += 1
+            else:
+                self.timings.lengths[r] = binlog.pack_timing(self.timings.buffers[r], us, self.profile)
+                self._publish(self.timings, r, start)
+            self.profile.clear()
+        self.acc.clear()
+
+    def _publish(self, pool, r, made):
+        pool.made[r] = made
+        pool.refs[r] = 1  # held while fanning out
+        for sink in self.sinks:
+            if sink.pool is pool and sink.queue.put_nowait(r):
+                pool.refs[r] += 1
+        pool.release(r)
+
+    async def _sink(self, sink):
+        pool = sink.pool
+        while True:
+            r = await sink.queue.get()
+            if r < 0:
+                return
+            start = utime.ticks_us()
+            data = memoryview(pool.buffers[r])[:pool.lengths[r]]
+            if sink.awaitable:
+                await sink.write(data)
+            else:
+                sink.write(data)
+            sink.stage.done(pool.made[r], start)
+            pool.release(r)
+            await asyncio.sleep_ms(0)
+
+    def report(self):
+        """ {stage: (items, busy µs, last/max/mean latency µs)} plus
+        queues: {name: (waiting, high water, stalls, dropped)}, the
+        ring's (waiting, high water, overflows) and the capture's
+        (crc errors, alarms, alarm bits, command errors), and the window
+        schedule's (see scheduler.Scheduler.stats). """
+        out = {s.name: s.stats() for s in (self.acquire_stage, self.aggregate_stage)}
+        queues = {'blocks': self.filled.stats()}
+        for sink in self.sinks:
+            out[sink.name] = sink.stage.stats()
+            queues[sink.name] = sink.queue.stats()
+        out['queues'] = queues
+        out['ring'] = self.ring.stats()
+        out['capture'] = self.scanner.cap.errors()
+        out['lost_records'] = self.lost_records
+        out['schedule'] = self.schedule.stats()
+        return out
+
+
+def window_lockin(record, n, scales):
+    """ (ms, [(difference, common, noise mV), ...]) from a LOCKIN record. """
+    ms = struct.unpack_from(binlog.WINDOW_STAMP, record)[0] / 1000
+    out = []
+    for c in range(n):
+        values = struct.unpack_from(binlog.LOCKIN_CHANNEL, record, binlog.WINDOW_STAMP_SIZE + binlog.LOCKIN_CHANNEL_SIZE * c)
+        out.append(codec.demodulate(values[:3], values[3:], scales[c]))
+    return ms, out
+
+
+def window_stats(record, n, scales):
+    """ (ms, [(mean, noise, min, max mV), ...]) from a STATS record, for
+    sinks that show the window rather than store it. """
+    ms = struct.unpack_from(binlog.WINDOW_STAMP, record)[0] / 1000
+    out = []
+    for c in range(n):
+        count, total, squares, low, high, _ = struct.unpack_from(
+            binlog.STATS_CHANNEL, record, binlog.WINDOW_STAMP_SIZE + binlog.STATS_CHANNEL_SIZE * c)
+        if not count:
+            out.append((0, 0, 0, 0))
+            continue
+        s = scales[c]
+        out.append((codec.mean_mV(total, count, s), codec.noise_mV(count, total, squares, s),
+                    low * s, high * s))
+    return ms, out
@@ -0,0 +1,148 @@
+""" Pulse-mode (START-pin triggered) conversion sequencing for the ADS1261.
+
+In continuous mode the ADC keeps converting whatever the inputs are doing,
+so a reader that switches inputs has to throw conversions away until the
+filter has settled. In pulse mode (MODE1 CONVRT = 'pulse') the ADC is idle
+until the START pin rises, then waits the MODE1 DELAY, converts once with
+the digital filter started afresh, drops DRDY and stops. Each channel visit
+is therefore: switch the input, pulse START, wait for DRDY, read once, and
+every conversion read is a fully settled sample.
+
+How long that takes follows from the data sheet's conversion latency
+(section 9.4.1, Table 9): the DELAY, then the filter's settling time, which
+is a whole number of data periods (SETTLE_PERIODS), doubled in chop and
+AC-excitation modes. latency_us() gives it for a setting, and the channel
+settings are picked from it:
+
+    delay   the shortest MODE1 DELAY that covers the analog settle time
+            after an input switch (settle_us; source impedance, input
+            filter and excitation switching set it)
+    filter  the first of `filters` (most rejection first) whose latency
+            fits budget_us, the time allowed per conversion; sinc4 if
+            there is no budget. FIR is only offered up to 20 SPS.
+
+plan = pulse.plan(adc, datalogger.CHANNELS, rate=19200, settle_us=100, budget_us=400)
+seq = pulse.Sequencer(plan, ads1261evm.DrdyCapture(adc, plan.rdata, ring))
+seq.start()
+seq.cycle()  # one settled conversion per channel, pushed to the ring
+"""
+
+from array import array
+import micropython
+import utime
+
+import scanplan
+
+# data periods from START to DRDY for each filter, after the DELAY
+SETTLE_PERIODS = {'sinc1': 1, 'sinc2': 2, 'sinc3': 3, 'sinc4': 4, 'fir': 3}
+FILTERS = ('sinc4', 'sinc3', 'sinc2', 'sinc1')  # most rejection first
+FIR_MAX_RATE = 20  # SPS
+# MODE1 DELAY settings and their length in µs, shortest first
+DELAYS = (('0us', 0), ('50us', 50), ('59us', 59), ('67us', 67), ('85us', 85),
+          ('119us', 119), ('189us', 189), ('328us', 328), ('605us', 605),
+          ('1.16ms', 1160), ('2.27ms', 2270), ('4.49ms', 4490), ('8.93ms', 8930),
+          ('17.8ms', 17800))
+_DELAY_US = dict(DELAYS)
+MARGIN_US = 1000  # added to twice the latency for the DRDY timeout
+
+
+def latency_us(rate, filter, delay='50us', chop='normal'):
+    """ START to DRDY for one pulse-mode conversion, in µs. """
+    periods = SETTLE_PERIODS[filter.lower()] * (1 if chop == 'normal' else 2)
+    return _DELAY_US[delay.lower()] + periods * 1000000 / rate
+
+
+def pick_delay(settle_us):
+    """ The shortest MODE1 DELAY of at least settle_us. """
+    for name, us in DELAYS:
+        if us >= settle_us:
+            return name
+    raise ValueError('no MODE1 delay of %d us or more' % settle_us)
+
+
+def pick_filter(rate, delay='50us', budget_us=None, chop='normal', filters=FILTERS):
+    """ The first of filters whose conversion fits budget_us at rate. """
+    for name in filters:
+        if name.lower() == 'fir' and rate > FIR_MAX_RATE:
+            continue
+        if budget_us is None or latency_us(rate, name, delay, chop) <= budget_us:
+            return name
+    raise ValueError('no filter converts within %d us at %s SPS' % (budget_us, rate))
+
+
+def plan(adc, channels, rate=19200, settle_us=50, budget_us=None, filters=FILTERS,
+         chop='normal', reference=5000):
+    """ A pulse-mode scanplan.ScanPlan. A channel spec's delay and filter
+    may be given, or left to be picked: delay from the spec's 'settle'
+    (µs, default settle_us), filter from its 'budget' (default
+    budget_us). """
+    specs = []
+    for entry in channels:
+        s = scanplan.spec(entry, rate, 'auto', 'auto')
+        if s['delay'] == 'auto':
+            s['delay'] = pick_delay(s.get('settle', settle_us))
+        if s['filter'] == 'auto':
+            s['filter'] = pick_filter(s['rate'], s['delay'], s.get('budget', budget_us), chop, filters)
+        specs.append(s)
+    return scanplan.ScanPlan(adc, specs, rate, chop=chop, reference=reference, convert='pulse')
+
+
+class Sequencer(scanplan.Scanner):
+    """ scanplan.Scanner for a pulse-mode plan: every conversion is started
+    by a START pulse, and the last one of a visit still shares its transfer
+    with the switch to the next channel. Each wait() times out after twice
+    the channel's latency (plus MARGIN_US); a conversion that never came
+    counts in the capture's duplicates. """
+
+    def __init__(self, plan, capture, current_pin=None):
+        if plan.convert != 'pulse':
+            raise ValueError('sequencer needs a pulse-mode plan (see pulse.plan)')
+        super().__init__(plan, capture, current_pin)
+        self.start_pin = plan.adc.start
+        self.latency = array('I', [int(latency_us(s['rate'], s['filter'], s['delay'], plan.chop))
+                                   for s in plan.specs])
+        self.timeouts = array('I', [2 * t + MARGIN_US for t in self.latency])
+        self.pulses = 0
+
+    def start(self):
+        """ Stop continuous conversions, load the plan and switch to channel
+        0. A conversion the register writes restarted is let finish before
+        the capture is enabled. """
+        self.start_pin(0)
+        self.plan.apply(self.n - 1)
+        utime.sleep_us(self.timeouts[self.n - 1])
+        self.k = 0
+        self.cap.start()
+        self._switch(0)
+
+    @micropython.native
+    def step(self):
+        """ Pulse START for each of the current channel's dwell conversions
+        and wait for it; the last one is read together with the switch to
+        the next channel. """
+        k = self.k
+        cap = self.cap
+        pin = self.start_pin
+        timeout = self.timeouts[k]
+        for _ in range(self.dwell[k] - 1):
+            pin(1)
+            pin(0)
+            cap.wait(timeout)
+        nxt = k + 1
+        if nxt == self.n:
+            nxt = 0
+            self.cycles += 1
+        if self.n > 1:
+            cap.arm(self.chains[k], self.chain_r[k], nxt, self.current[nxt])
+            pin(1)
+            pin(0)
+            cap.wait(timeout)
+            if cap.disarm():  # timed out before the chain fired
+                self.fallbacks += 1
+                self._switch(nxt)
+        else:
+            pin(1)
+            pin(0)
+            cap.wait(timeout)
+        self.pulses += self.dwell[k]
+        self.k = nxt
@@ -0,0 +1,112 @@
+""" Preallocated ring buffer of raw ADS1261 samples.
+
+Holds 24-bit codes with a ticks_us timestamp and a channel ID each, in
+fixed arrays allocated once. Codes are stored as the three bytes the ADS1261
+sent, so the DRDY IRQ only copies them; drain() decodes a whole batch to
+signed codes at once with codec.decode(). One producer (the DRDY IRQ or the acquisition
+loop) calls put()/put_frame(), one consumer calls drain(). The producer only
+moves head and the consumer only moves tail, so neither side needs a lock.
+
+When the buffer is full new samples are dropped and counted in overflows;
+high_water is the most samples that have ever been waiting at once.
+
+ring = ringbuffer.SampleRing(512)
+ring.put_frame(rbuf, utime.ticks_us(), 0)  # rbuf = RDATA frame FF 12 MSB MID LSB
+n = ring.drain(codes, stamps, channels)     # copies up to len(codes) samples
+"""
+
+from array import array
+import micropython
+
+import codec
+
+
+class SampleRing:
+    def __init__(self, capacity=512):
+        size = capacity + 1  # one slot stays empty so full != empty
+        self.size = size
+        self.raw = bytearray(3 * size)  # MSB, MID, LSB per slot
+        self.scratch = bytearray(3)
+        self.stamps = array('I', (0 for _ in range(size)))
+        self.channels = bytearray(size)
+        self.head = 0  # next slot to write, producer only
+        self.tail = 0  # next slot to read, consumer only
+        self.overflows = 0
+        self.high_water = 0
+
+    @property
+    def capacity(self):
+        return self.size - 1
+
+    def __len__(self):
+        n = self.head - self.tail
+        return n + self.size if n < 0 else n
+
+    def put(self, code, stamp, channel):
+        """Store one sample. Returns False (and counts it) if full."""
+        scratch = self.scratch
+        scratch[0] = (code >> 16) & 0xFF
+        scratch[1] = (code >> 8) & 0xFF
+        scratch[2] = code & 0xFF
+        return self.put_frame(scratch, stamp, channel, 0)
+
+    @micropython.native
+    def put_frame(self, frame, stamp, channel, offset=2):
+        """Store the 24-bit code at frame[offset:offset + 3] (MSB first).
+        Returns False (and counts it) if full."""
+        head = self.head
+        nxt = head + 1
+        if nxt == self.size:
+            nxt = 0
+        if nxt == self.tail:
+            self.overflows += 1
+            return False
+        raw = self.raw
+        p = 3 * head
+        raw[p] = frame[offset]
+        raw[p + 1] = frame[offset + 1]
+        raw[p + 2] = frame[offset + 2]
+        self.stamps[head] = stamp
+        self.channels[head] = channel
+        self.head = nxt
+        n = nxt - self.tail
+        if n < 0:
+            n += self.size
+        if n > self.high_water:
+            self.high_water = n
+        return True
+
+    @micropython.native
+    def drain(self, codes, stamps=None, channels=None):
+        """Copy out up to len(codes) samples, oldest first, and free them.
+        stamps/channels may be None if not wanted. Returns the count.
+        A drain stops at the end of the storage; the samples past the wrap
+        come with the next call."""
+        tail = self.tail
+        head = self.head
+        end = head if head >= tail else self.size
+        n = end - tail
+        if n > len(codes):
+            n = len(codes)
+        if not n:
+            return 0
+        codec.decode(self.raw, codes, 3 * tail, n)
+        if stamps is not None:
+            src = self.stamps
+            for k in range(n):
+                stamps[k] = src[tail + k]
+        if channels is not None:
+            src = self.channels
+            for k in range(n):
+                channels[k] = src[tail + k]
+        tail += n
+        if tail == self.size:
+            tail = 0
+        self.tail = tail
+        return n
+
+    def clear(self):
+        self.tail = self.head
+
+    def stats(self):
+        return len(self), self.high_water, self.overflows
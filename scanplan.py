@@ -0,0 +1,226 @@
+""" Multi-channel scan plans for the ADS1261.
+
+A plan is built once from a list of channel specs. For every channel it
+works out the MODE0, MODE1, PGA and INPMUX values, then compiles the WREG
+frames that switch to that channel from the one before it in the cycle.
+Registers that do not change between neighbours get no frame. All switch
+frames and the RDATA frame live in one buffer; each channel gets a
+memoryview of its part, so scanning allocates nothing. The buffer also
+holds, per channel, the chain RDATA + switch-to-next. The Scanner arms it
+on the capture, so the last read of a visit and the switch share one SPI
+transfer.
+
+A channel spec is a dict (or a tuple in the same key order):
+    positive, negative  INPMUXregister names, e.g. 'AIN3', 'AIN4'
+    gain                PGA gain (default 1)
+    rate, filter        data rate (SPS) and digital filter (plan defaults)
+    delay               conversion start delay, the settle time after a
+                        switch, e.g. '50us' (plan default)
+    current             level for the excitation switch pin before this
+                        channel (None leaves it alone). Setting a new level
+                        restarts the conversion, even between channels
+                        whose registers are the same
+    dwell               conversions taken per visit (default 1). After the
+                        first, settled conversion the rest arrive at the
+                        full data rate, so dwell > 1 trades scan rate for
+                        samples per second.
+    decimate            decimation filter and ratio applied after capture,
+                        e.g. ('cic', 16, 3) (see decimate; default None)
+
+plan = scanplan.ScanPlan(adc, [
+    {'positive': 'AIN3', 'negative': 'AIN4', 'current': 1},
+    {'positive': 'AIN6', 'negative': 'AIN7', 'gain': 4, 'current': 0},
+])
+scanner = scanplan.Scanner(plan, ads1261evm.DrdyCapture(adc, plan.rdata, ring))
+scanner.start()
+scanner.cycle()  # one conversion per channel, pushed to the ring
+"""
+
+from array import array
+import micropython
+
+import codec
+
+KEYS = ('positive', 'negative', 'gain', 'rate', 'filter', 'delay', 'current', 'dwell', 'decimate')
+RDATA = b'\x12\x00\x00\x00\x00'  # with STATUS and CRC off
+_MODE0, _MODE1, _PGA, _INPMUX = 0x2, 0x3, 0x10, 0x11
+_ORDER = (_MODE0, _MODE1, _PGA, _INPMUX)  # INPMUX last: its write starts the new conversion
+
+
+def spec(entry, rate=19200, filter='sinc4', delay='50us'):
+    """ Normalise a channel spec to a dict with every key filled in. """
+    if not isinstance(entry, dict):
+        entry = dict(zip(KEYS, entry))
+    out = {'negative': 'AINCOM', 'gain': 1, 'rate': rate, 'filter': filter,
+           'delay': delay, 'current': None, 'dwell': 1, 'decimate': None}
+    out.update(entry)
+    if 'positive' not in entry:
+        raise ValueError('channel spec needs a positive input')
+    return out
+
+
+class ScanPlan:
+    def __init__(self, adc, channels, rate=19200, filter='sinc4', delay='50us',
+                 chop='normal', reference=5000, convert='continuous'):
+        if not channels:
+            raise ValueError('scan plan needs at least one channel')
+        self.adc = adc
+        self.specs = [spec(c, rate, filter, delay) for c in channels]
+        self.n = n = len(self.specs)
+        self.chop = chop
+        self.convert = convert  # 'pulse' for pulse.Sequencer
+        mux = adc.INPMUXregister
+        self.registers = []
+        for s in self.specs:
+            self.registers.append({
+                _MODE0: adc.available_data_rates[float(s['rate'])] << 3
+                | adc.available_digital_filters[s['filter'].lower()],
+                _MODE1: adc.mode1register[chop] | adc.mode1register[convert]
+                | adc.mode1register[s['delay'].lower()],
+                _PGA: adc.available_gain[s['gain']],
+                _INPMUX: mux[s['positive']] << 4 | mux[s['negative']],
+            })
+        self.gains = array('B', [s['gain'] for s in self.specs])
+        self.scales = array('f', [codec.scale(reference, s['gain']) for s in self.specs])
+        self.current = array('b', [-1 if s['current'] is None else s['current'] for s in self.specs])
+        self.dwell = array('H', [max(1, s['dwell']) for s in self.specs])
+
+        # switch frames for channel k, from channel k - 1, then one RDATA.
+        # A change of current alone gets INPMUX rewritten all the same: the
+        # restart keeps conversions from straddling the reversal
+        switch = []
+        for k in range(n):
+            before, after = self.registers[k - 1], self.registers[k]
+            reversal = 0 <= self.current[k] != self.current[k - 1]
+            switch.append([a for a in _ORDER
+                           if n > 1 and (before[a] != after[a] or reversal and a == _INPMUX)])
+        # and per channel the chain [RDATA of k][switch to k + 1], in the
+        # adc's current frame format (CRC and STATUS, see ADC1261.integrity)
+        rdata = adc.rdata_bytes()
+        switch_size = len(adc.wreg_bytes(_INPMUX, 0)) * sum(len(s) for s in switch)
+        size = 2 * switch_size + len(rdata) * (n + 1)
+        self.frames = bytearray(size)
+        self.rframes = bytearray(size)
+        mv, rmv = memoryview(self.frames), memoryview(self.rframes)
+        self.views, self.rviews = [], []
+        offset = 0
+        for k in range(n):
+            start = offset
+            offset = self._compile(offset, k, switch[k])
+            self.views.append(mv[start:offset])
+            self.rviews.append(rmv[start:offset])
+        self.frames[offset:offset + len(rdata)] = rdata
+        self.rdata = mv[offset:offset + len(rdata)]
+        offset += len(rdata)
+        self.chains = []
+        for k in range(n):
+            start = offset
+            self.frames[offset:offset + len(rdata)] = rdata
+            offset = self._compile(offset + len(rdata), (k + 1) % n, switch[(k + 1) % n])
+            self.chains.append(mv[start:offset])
+
+    def _compile(self, offset, k, addresses):
+        for address in addresses:
+            frame = self.adc.wreg_bytes(address, self.registers[k][address])
+            self.frames[offset:offset + len(frame)] = frame
+            offset += len(frame)
+        return offset
+
+    def channels(self):
+        """ (positive, negative, gain) per channel, as binlog.header wants. """
+        mux = self.adc.INPMUXregister
+        return [(mux[s['positive']], mux[s['negative']], s['gain']) for s in self.specs]
+
+    def apply(self, k):
+        """ Put channel k's registers on the ADS1261 through the register
+        shadow (only the ones that differ are written). """
+        adc = self.adc
+        for address in _ORDER:
+            adc.set_register(address, self.registers[k][address])
+        return adc.commit()
+
+    def settle_shadow(self, k):
+        """ Record channel k's registers in the shadow after a scan, since
+        the raw frames bypass it. """
+        shadow = self.adc.shadow
+        for address in _ORDER:
+            shadow[address] = self.registers[k][address]
+
+
+class Scanner:
+    """ Round-robin engine over a ScanPlan with a DrdyCapture. Every
+    conversion is pushed to the capture's ring. The engine only switches
+    inputs; accumulation happens where the ring is drained.
+
+    The last conversion of each visit is read by an armed chain, which also
+    switches to the next channel, so a visit costs one transfer per
+    conversion. If the chain has not fired when wait() times out, the
+    engine switches with a plain write instead. """
+
+    def __init__(self, plan, capture, current_pin=None):
+        self.plan = plan
+        self.cap = capture
+        self.n = plan.n
+        self.views = plan.views
+        self.rviews = plan.rviews
+        self.chains = plan.chains
+        # one reserve() for the longest chain, as rbuf cannot grow after it
+        rview = capture.reserve(max(len(c) for c in plan.chains))
+        self.chain_r = [rview[:len(c)] for c in plan.chains]
+        # without a pin there is nothing to set, whatever the specs say
+        self.current = plan.current if current_pin is not None else array('b', [-1] * plan.n)
+        self.dwell = plan.dwell
+        self.pin = current_pin
+        capture.current_pin = current_pin
+        self.k = 0
+        self.cycles = 0
+        self.fallbacks = 0
+
+    def start(self):
+        """ Load the last channel's registers, then switch to channel 0 so
+        the compiled frames match the state they were built against. START
+        is raised, as continuous mode converts while it is high. """
+        self.plan.adc.start.on()
+        self.plan.apply(self.n - 1)
+        self.k = 0
+        self.cap.start()
+        self._switch(0)
+
+    def stop(self):
+        self.cap.disarm()
+        self.cap.stop()
+        self.plan.settle_shadow(self.k)
+
+    def _switch(self, k):
+        level = self.current[k]
+        if level >= 0:
+            self.pin(level)
+        self.cap.switch(self.views[k], k, self.rviews[k])
+
+    @micropython.native
+    def step(self):
+        """ Take the current channel's dwell conversions, the last one
+        together with the switch to the next channel. """
+        k = self.k
+        cap = self.cap
+        for _ in range(self.dwell[k] - 1):
+            cap.wait()
+        nxt = k + 1
+        if nxt == self.n:
+            nxt = 0
+            self.cycles += 1
+        if self.n > 1:
+            cap.arm(self.chains[k], self.chain_r[k], nxt, self.current[nxt])
+            cap.wait()
+            if cap.disarm():  # timed out before the chain fired
+                self.fallbacks += 1
+                self._switch(nxt)
+        else:
+            cap.wait()
+        self.k = nxt
+
+    def cycle(self):
+        """ One visit to every channel. """
+        for _ in range(self.n):
+            self.step()
+
@@ -0,0 +1,210 @@
+""" Sample and window timing on ticks_us deadlines (or a machine.Timer).
+
+time.time() counts whole seconds and utime.sleep_us() after each sample
+adds the loop's own run time to every period, so neither gives an exact
+rate. Here every deadline is computed from the start, not from when the
+last sample happened to finish:
+
+    slot k     at start + k * 1e6 / rate µs. The period is split into whole
+               µs plus a carried remainder, so the average rate is exact
+               with small ints only.
+    window w   closes at start + w * window_ms, whatever the samples and
+               the SD writes in between took.
+
+A slot whose deadline has already passed by a whole period is skipped, so
+the schedule keeps its phase instead of bunching up samples to catch up.
+It counts as an overrun. So does a window boundary passed without being
+closed. wait() also records how late it started a slot, and how long it
+slept in total. That sleep is the time the loop did not need.
+
+ticks_us wraps (every 2**30 µs, about 18 minutes, on the ESP32) and
+ticks_diff is only right within half of that. Deadlines are therefore kept
+as ticks and compared with ticks_diff. The window stamps come from a Clock,
+which adds up ticks_diff steps and keeps counting across the wrap. It only
+needs reading at least every 2**29 µs, and close_window() reads it once per
+window.
+
+With timer given, a machine.Timer of that id fires at the rate and wait()
+takes its ticks instead of computing deadlines. Missed ticks count as
+overruns the same way.
+
+sched = scheduler.Scheduler(2000, window_ms=1000)
+sched.start()
+while True:
+    while not sched.window_due():
+        sched.wait()
+        ...                                  # take a sample
+    binlog.pack_stats(record, sched.close_window(), acc)
+"""
+
+import machine
+import utime
+
+_TICKS_HALF = 1 << 29  # largest step ticks_add/ticks_diff take
+_COUNT_MASK = 0x3FFFFFFF  # timer tick count kept a small int
+
+
+class Clock:
+    """ µs since start(), across the ticks_us wrap. """
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.last = utime.ticks_us()
+        self.us = 0
+
+    def now(self):
+        return self.update(utime.ticks_us())
+
+    def update(self, t):
+        """ Count up to ticks t, no more than 2**29 µs after the last. """
+        self.us += utime.ticks_diff(t, self.last)
+        self.last = t
+        return self.us
+
+
+class Scheduler:
+    def __init__(self, rate=0, window_ms=1000, timer=None):
+        """ rate: samples per second (whole Hz), 0 for windows only.
+        window_ms: window length. timer: id of a machine.Timer to pace
+        samples with, else ticks_us deadlines. """
+        self.window_us = 1000 * window_ms
+        if not 0 < self.window_us < _TICKS_HALF:
+            raise ValueError('window of 1 to %d ms' % (_TICKS_HALF // 1000 - 1))
+        self.rate = rate
+        self.period_us, self.remainder = divmod(1000000, rate) if rate else (0, 0)
+        self.timer_id = timer
+        self.timer = None
+        self._tick_cb = self._tick  # bound once, not per IRQ
+        self.clock = Clock()
+        self.start()
+
+    def start(self):
+        """ Slot 0 and the start of window 0 are now. """
+        self.stop()
+        self.clock.start()
+        self.deadline = self.clock.last
+        self.boundary = utime.ticks_add(self.clock.last, self.window_us)
+        self.error = 0
+        self.fired = self.taken = 0
+        self.slots = 0
+        self.overruns = 0  # sample slots skipped
+        self.late_max = 0  # µs a slot was started after its deadline
+        self.idle_us = 0  # slept in wait()
+        self.windows = 0
+        self.window_overruns = 0  # boundaries passed before the window was closed
+        if self.timer_id is not None and self.rate:
+            self.timer = machine.Timer(self.timer_id)
+            self.timer.init(freq=self.rate, mode=machine.Timer.PERIODIC, callback=self._tick_cb)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+
+    def _tick(self, timer):
+        self.fired = (self.fired + 1) & _COUNT_MASK
+
+    def _next(self):
+        step = self.period_us
+        self.error += self.remainder
+        if self.error >= self.rate:
+            self.error -= self.rate
+            step += 1
+        self.deadline = utime.ticks_add(self.deadline, step)
+
+    def wait(self):
+        """ Sleep until the next sample slot. Returns how late (µs) it
+        starts, 0 with a timer. """
+        if self.timer is not None:
+            pending = (self.fired - self.taken) & _COUNT_MASK
+            if not pending:
+                start = utime.ticks_us()
+                while self.fired == self.taken:
+                    machine.idle()
+                self.idle_us += utime.ticks_diff(utime.ticks_us(), start)
+                pending = 1
+            self.overruns += pending - 1
+            self.taken = self.fired
+            self.slots += 1
+            return 0
+        late = utime.ticks_diff(utime.ticks_us(), self.deadline)
+        if late < 0:
+            utime.sleep_us(-late)
+            self.idle_us -= late
+            late = 0
+        return self._take(late)
+
+    def _take(self, late):
+        while late >= self.period_us:  # a whole period behind: skip the slot
+            self.overruns += 1
+            late -= self.period_us
+            self._next()
+        if late > self.late_max:
+            self.late_max = late
+        self._next()
+        self.slots += 1
+        return late
+
+    def window_due(self):
+        return utime.ticks_diff(utime.ticks_us(), self.boundary) >= 0
+
+    def close_window(self):
+        """ Move on to the next window, exactly window_ms after this one
+        began. Returns the µs since start() (see Clock) to stamp the
+        window with. """
+        return self._close(utime.ticks_us())
+
+    def _close(self, now):
+        self.boundary = utime.ticks_add(self.boundary, self.window_us)
+        while utime.ticks_diff(now, self.boundary) >= 0:
+            self.window_overruns += 1
+            self.boundary = utime.ticks_add(self.boundary, self.window_us)
+        self.windows += 1
+        return self.clock.update(now)
+
+    def stats(self):
+        """(slots, overruns, max late µs, idle µs, windows, window overruns)"""
+        return (self.slots, self.overruns, self.late_max, self.idle_us, self.windows,
+                self.window_overruns)
+
+
+RATES = (1, 3, 7, 60, 1000, 3001, 19200)  # SPS, for selftest()
+
+
+def selftest():
+    """ Check the slot deadlines at every RATES over one second against
+    k * 1e6 // rate, and window stamps, late slots and missed windows, all
+    on synthetic ticks that cross the ticks_us wrap. Returns the number of
+    rates; raises AssertionError on the first mismatch. """
+    t0 = utime.ticks_add(0, -250000)  # 250 ms before the wrap
+    for rate in RATES:
+        s = Scheduler(rate)
+        s.deadline = t0
+        for k in range(1, rate + 1):
+            s._next()
+            got = utime.ticks_diff(s.deadline, t0)
+            if got != k * 1000000 // rate:
+                raise AssertionError('slot %d at %d SPS: %d us, expected %d'
+                                     % (k, rate, got, k * 1000000 // rate))
+    s = Scheduler(1000)
+    s.deadline = t0
+    if s._take(2500) != 500 or s.overruns != 2 or utime.ticks_diff(s.deadline, t0) != 3000:
+        raise AssertionError('late slot: overruns %d, deadline %d'
+                             % (s.overruns, utime.ticks_diff(s.deadline, t0)))
+    s = Scheduler(window_ms=100)
+    s.clock.last, s.clock.us = t0, 0
+    s.boundary = utime.ticks_add(t0, s.window_us)
+    for w, at, expected in ((1, 100037, 0), (2, 200001, 0), (3, 300000, 0), (4, 650000, 2)):
+        stamp = s._close(utime.ticks_add(t0, at))
+        if (stamp, s.windows, s.window_overruns) != (at, w, expected):
+            raise AssertionError('window %d closed at %d: stamp %d, %d windows, %d overruns'
+                                 % (w, at, stamp, s.windows, s.window_overruns))
+        if utime.ticks_diff(s.boundary, t0) != 100000 * (w + 1 + expected):
+            raise AssertionError('window %d: next boundary %d' % (w, utime.ticks_diff(s.boundary, t0)))
+    return len(RATES)
+
+
+if __name__ == '__main__':
+    print(selftest(), 'rates ok')
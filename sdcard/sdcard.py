@@ -18,6 +18,18 @@ Example usage on ESP8266:
     os.mount(sd, '/sd')
     os.listdir('/')
 
+From a uasyncio task, writeblocks_async / write_stream_async wait for the
+card to finish programming by polling between yields to the event loop,
+so other tasks keep running for the milliseconds a block can take.
+busy_timeout_ms bounds every busy wait (OSError ETIMEDOUT).
+
+With a hardware SPI host, negotiate() raises the data clock step by step.
+Each step is checked by reading a block twice and verifying its CRC16, and
+the last clock that passed is kept:
+
+    sd = sdcard.SDCard(machine.SPI(2, sck=Pin(26), mosi=Pin(25), miso=Pin(27)), Pin(33))
+    baudrate, mbps = sd.negotiate()
+
 """
 
 from micropython import const
@@ -37,18 +49,54 @@ _TOKEN_CMD25 = const(0xfc)
 _TOKEN_STOP_TRAN = const(0xfd)
 _TOKEN_DATA = const(0xfe)
 
+# data clocks tried by negotiate(), slowest first
+CLOCKS = (1320000, 4000000, 8000000, 10000000, 13333333, 16000000, 20000000,
+          26666666, 40000000)
+
+_crc16_table = None
+
+
+def crc16(buf):
+    # CRC-16/XMODEM (poly 0x1021, init 0) as used for SD data blocks
+    global _crc16_table
+    if _crc16_table is None:
+        from array import array
+        _crc16_table = array('H', bytes(512))
+        for i in range(256):
+            crc = i << 8
+            for _ in range(8):
+                crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+            _crc16_table[i] = crc & 0xffff
+    table = _crc16_table
+    crc = 0
+    for b in buf:
+        crc = ((crc << 8) & 0xff00) ^ table[(crc >> 8) ^ b]
+    return crc
+
 
 class SDCard:
-    def __init__(self, spi, cs):
+    def __init__(self, spi, cs, baudrate=1320000):
         self.spi = spi
         self.cs = cs
+        self.baudrate = baudrate
+        self.read_mbps = 0
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.crcbuf = bytearray(2)
         for i in range(512):
             self.dummybuf[i] = 0xff
         self.dummybuf_memoryview = memoryview(self.dummybuf)
+        self.crcdummy = self.dummybuf_memoryview[:2]
+
+        # open streaming write session (see begin_stream)
+        self.streaming = False
+        self.stream_block = 0
+
+        # give up on a card that stays busy longer than this
+        self.busy_timeout_ms = 500
+        self.busy_yields = 0
 
         # initialise the card
         self.init_card()
@@ -111,7 +159,7 @@ class SDCard:
             raise OSError("can't set 512 block size")
 
         # set to high data rate now that it's initialised
-        self.init_spi(1320000)
+        self.init_spi(self.baudrate)
 
     def init_card_v1(self):
         for i in range(_CMD_TIMEOUT):
@@ -140,10 +188,10 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = (arg >> 24) & 0xff
+        buf[2] = (arg >> 16) & 0xff
+        buf[3] = (arg >> 8) & 0xff
+        buf[4] = arg & 0xff
         buf[5] = crc
         self.spi.write(buf)
 
@@ -187,46 +235,96 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b'\xff')
-        self.spi.write(b'\xff')
+        self.spi.write_readinto(self.crcdummy, self.crcbuf)
 
         self.cs(1)
         self.spi.write(b'\xff')
 
-    def write(self, token, buf):
+    def send(self, token, buf):
+        # send: start of block, data, checksum; leaves the card selected
+        # and returns True if it accepted the block
         self.cs(0)
-
-        # send: start of block, data, checksum
-        self.spi.read(1, token)
+        self.tokenbuf[0] = token
+        self.spi.write(self.tokenbuf)
         self.spi.write(buf)
         self.spi.write(b'\xff')
         self.spi.write(b'\xff')
 
         # check the response
-        if (self.spi.read(1, 0xff)[0] & 0x1f) != 0x05:
+        self.spi.readinto(self.tokenbuf, 0xff)
+        if (self.tokenbuf[0] & 0x1f) != 0x05:
             self.cs(1)
             self.spi.write(b'\xff')
-            return
-
-        # wait for write to finish
-        while self.spi.read(1, 0xff)[0] == 0:
-            pass
+            return False
+        return True
+
+    def wait_ready(self):
+        # the card holds DO low while programming; poll into tokenbuf so
+        # a long busy period does not allocate
+        tokenbuf = self.tokenbuf
+        start = time.ticks_ms()
+        while True:
+            self.spi.readinto(tokenbuf, 0xff)
+            if tokenbuf[0]:
+                break
+            if time.ticks_diff(time.ticks_ms(), start) > self.busy_timeout_ms:
+                self.cs(1)
+                self.spi.write(b'\xff')
+                raise OSError(110) # ETIMEDOUT
+        self.cs(1)
+        self.spi.write(b'\xff')
 
+    async def wait_ready_async(self, poll_ms=0):
+        # as wait_ready, but yields to the event loop between polls so other
+        # tasks run while the card programs. The card stays selected, so
+        # nothing else may use this card until the write completes.
+        import uasyncio
+        tokenbuf = self.tokenbuf
+        start = time.ticks_ms()
+        while True:
+            self.spi.readinto(tokenbuf, 0xff)
+            if tokenbuf[0]:
+                break
+            if time.ticks_diff(time.ticks_ms(), start) > self.busy_timeout_ms:
+                self.cs(1)
+                self.spi.write(b'\xff')
+                raise OSError(110) # ETIMEDOUT
+            self.busy_yields += 1
+            await uasyncio.sleep_ms(poll_ms)
         self.cs(1)
         self.spi.write(b'\xff')
 
-    def write_token(self, token):
+    def write(self, token, buf):
+        if not self.send(token, buf):
+            return False
+        # wait for write to finish
+        self.wait_ready()
+        return True
+
+    async def write_async(self, token, buf):
+        if not self.send(token, buf):
+            return False
+        await self.wait_ready_async()
+        return True
+
+    def send_token(self, token):
         self.cs(0)
-        self.spi.read(1, token)
+        self.tokenbuf[0] = token
+        self.spi.write(self.tokenbuf)
         self.spi.write(b'\xff')
+
+    def write_token(self, token):
+        self.send_token(token)
         # wait for write to finish
-        while self.spi.read(1, 0xff)[0] == 0x00:
-            pass
+        self.wait_ready()
 
-        self.cs(1)
-        self.spi.write(b'\xff')
+    async def write_token_async(self, token):
+        self.send_token(token)
+        await self.wait_ready_async()
 
     def readblocks(self, block_num, buf):
+        if self.streaming:
+            self.end_stream()
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, 'Buffer length is invalid'
         if nblocks == 1:
@@ -254,6 +352,8 @@ class SDCard:
                 raise OSError(5) # EIO
 
     def writeblocks(self, block_num, buf):
+        if self.streaming:
+            self.end_stream()
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, 'Buffer length is invalid'
         if nblocks == 1:
@@ -276,6 +376,138 @@ class SDCard:
                 nblocks -= 1
             self.write_token(_TOKEN_STOP_TRAN)
 
+    def begin_stream(self, block_num, expected_blocks=0):
+        # Open one CMD25 session for a sequential log. With expected_blocks,
+        # ACMD23 first tells the card how many blocks are coming so it can
+        # pre-erase them, which shortens the busy time after each block.
+        # Blocks then go out with write_stream() until end_stream(); any
+        # readblocks/writeblocks call ends the session first.
+        if self.streaming:
+            self.end_stream()
+        if expected_blocks:
+            # ACMD23: SET_WR_BLK_ERASE_COUNT; only a hint, so a card that
+            # rejects it still gets the plain CMD25
+            self.cmd(55, 0, 0)
+            self.cmd(23, expected_blocks & 0x7fffff, 0)
+        # CMD25: set write address for first block
+        if self.cmd(25, block_num * self.cdv, 0) != 0:
+            raise OSError(5) # EIO
+        self.streaming = True
+        self.stream_block = block_num
+
+    def write_stream(self, buf):
+        # send whole blocks into the open session; stream_block tracks the
+        # block the next one will land on
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, 'Buffer length is invalid'
+        assert self.streaming, 'No stream open'
+        offset = 0
+        mv = memoryview(buf)
+        while nblocks:
+            if not self.write(_TOKEN_CMD25, mv[offset : offset + 512]):
+                self.end_stream()
+                raise OSError(5) # EIO
+            offset += 512
+            nblocks -= 1
+            self.stream_block += 1
+
+    async def write_stream_async(self, buf):
+        # write_stream that yields while each block programs
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, 'Buffer length is invalid'
+        assert self.streaming, 'No stream open'
+        offset = 0
+        mv = memoryview(buf)
+        while nblocks:
+            if not await self.write_async(_TOKEN_CMD25, mv[offset : offset + 512]):
+                self.end_stream()
+                raise OSError(5) # EIO
+            offset += 512
+            nblocks -= 1
+            self.stream_block += 1
+
+    def end_stream(self):
+        if self.streaming:
+            self.streaming = False
+            self.write_token(_TOKEN_STOP_TRAN)
+
+    async def end_stream_async(self):
+        if self.streaming:
+            self.streaming = False
+            await self.write_token_async(_TOKEN_STOP_TRAN)
+
+    async def writeblocks_async(self, block_num, buf):
+        # writeblocks that yields to the event loop while the card programs
+        if self.streaming:
+            await self.end_stream_async()
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, 'Buffer length is invalid'
+        if nblocks == 1:
+            # CMD24: set write address for single block
+            if self.cmd(24, block_num * self.cdv, 0) != 0:
+                raise OSError(5) # EIO
+            if not await self.write_async(_TOKEN_DATA, buf):
+                raise OSError(5) # EIO
+        else:
+            # CMD25: set write address for first block
+            if self.cmd(25, block_num * self.cdv, 0) != 0:
+                raise OSError(5) # EIO
+            offset = 0
+            mv = memoryview(buf)
+            while nblocks:
+                if not await self.write_async(_TOKEN_CMD25, mv[offset : offset + 512]):
+                    await self.write_token_async(_TOKEN_STOP_TRAN)
+                    raise OSError(5) # EIO
+                offset += 512
+                nblocks -= 1
+            await self.write_token_async(_TOKEN_STOP_TRAN)
+
+    def verify_read(self, block_num, buf):
+        # readblocks for a single block, checked against the data CRC
+        self.readblocks(block_num, buf)
+        return crc16(buf) == (self.crcbuf[0] << 8 | self.crcbuf[1])
+
+    def negotiate(self, clocks=CLOCKS, block_num=0, repeats=2):
+        # Step the data clock up through `clocks`. At each step read
+        # `block_num` `repeats` times; every copy must pass its CRC and match
+        # the copy read at the starting clock. Stop at the first failure
+        # and fall back to the last clock that passed. The chosen clock is
+        # kept in self.baudrate. Returns (baudrate, read MB/s).
+        ref = bytearray(512)
+        buf = bytearray(512)
+        good = 0
+        for rate in clocks:
+            self.init_spi(rate)
+            try:
+                ok = True
+                for i in range(repeats):
+                    if not good and not i:
+                        ok = self.verify_read(block_num, ref)
+                    else:
+                        ok = self.verify_read(block_num, buf) and buf == ref
+                    if not ok:
+                        break
+            except OSError:
+                ok = False
+            if not ok:
+                break
+            good = rate
+        if not good:
+            self.init_spi(self.baudrate)
+            raise OSError("no stable SD clock")
+        self.baudrate = good
+        self.init_spi(good)
+        self.read_mbps = self.measure_read(block_num)
+        return good, self.read_mbps
+
+    def measure_read(self, block_num=0, nblocks=16):
+        # sequential read throughput at the current clock, in MB/s
+        buf = bytearray(512 * nblocks)
+        start = time.ticks_us()
+        self.readblocks(block_num, buf)
+        us = time.ticks_diff(time.ticks_us(), start)
+        return len(buf) / us if us > 0 else 0
+
     def ioctl(self, op, arg):
         if op == 4: # get number of blocks
             return self.sectors
@@ -0,0 +1,391 @@
+"""Simulated TI ADS1261 for running the acquisition code on the host.
+
+The model sits on a machine.SPI bus and watches the START/RST/PWDN pins. It
+keeps the 19-register file, decodes command frames, runs conversions on the
+virtual utime clock and drives DRDY low when each one completes.
+
+Frame model (per ADS1261 data sheet, section 9.5): each write_readinto() is
+one chip-select frame, and several commands may follow each other inside it.
+The first two DOUT bytes are FFh and an echo of the command byte. With
+CRCENB set the host sends a CRC-2 byte after byte 2 plus one pad byte (both
+echoed back a byte late), RDATA/RREG data is followed by a CRC byte, and
+with STATENB set RDATA data is preceded by the STATUS byte. Any bytes left
+over at the end of a transfer that do not make a whole frame are ignored,
+which is how the 5-byte WREG frames used by ads1261evm behave in practice.
+
+Conversion timing model: after a restart (START, or a write to MODE0, MODE1,
+PGA, REF, INPMUX or INPBIAS) the first result takes the MODE1 DELAY plus
+SETTLE_PERIODS[filter] data periods; later results in continuous mode
+follow every period. Chop mode doubles the period. Override SETTLE_PERIODS
+or pass first_conversion_us to try other assumptions.
+
+By default a result is the input at the moment it completes. With
+settling=True it is the input weighted over the filter's span instead:
+SETTLE_PERIODS data periods, under the sinc-N impulse response (N boxes of
+one period convolved; FIR is taken as sinc3). A result whose span reaches
+back past a change of input, like a reversal of the excitation current
+without a restart, then mixes the two levels, as on the real part.
+
+Input voltages are in mV, either constants or callables of time in seconds:
+
+    sim = ADS1261Sim(inputs={'AIN3': 12.5, 'AIN4': 0, 'AIN6': lambda t: t})
+"""
+
+import math
+import random
+
+import utime
+from machine import Pin, SPI
+
+# Register addresses, Table 29.
+ID, STATUS, MODE0, MODE1, MODE2, MODE3, REF = range(7)
+PGA, INPMUX, INPBIAS = 0x10, 0x11, 0x12
+
+RESET_REGISTERS = bytes([
+    0x80,              # ID: ADS1261, revision 0
+    0x01,              # STATUS: RESET
+    0x24, 0x01, 0x00, 0x00,  # MODE0 (20 SPS, FIR), MODE1 (50 µs delay), MODE2, MODE3
+    0x05,              # REF: AVDD/AVSS, internal reference off
+    0x00, 0x00, 0x00,  # OFCAL
+    0x00, 0x00, 0x40,  # FSCAL = 400000h
+    0xFF, 0x00, 0x00,  # IMUX, IMAG, reserved
+    0x00,              # PGA: gain 1
+    0xFF,              # INPMUX: VCOM/VCOM
+    0x00,              # INPBIAS
+])
+
+# STATUS bits
+_LOCK, _CRCERR, _PGAL_ALM, _PGAH_ALM = 0x80, 0x40, 0x20, 0x10
+_DRDY, _RESET = 0x04, 0x01
+
+DATA_RATES = (2.5, 5, 10, 16.6, 20, 50, 60, 100, 400, 1200, 2400, 4800,
+              7200, 14400, 19200, 25600, 40000)
+FILTERS = ('sinc1', 'sinc2', 'sinc3', 'sinc4', 'fir')
+DELAYS_US = (0, 50, 59, 67, 85, 119, 189, 328, 605, 1160, 2270, 4490, 8930, 17800)
+SETTLE_PERIODS = {'sinc1': 1, 'sinc2': 2, 'sinc3': 3, 'sinc4': 4, 'fir': 3}
+
+_RESTART_REGISTERS = (MODE0, MODE1, REF, PGA, INPMUX, INPBIAS)
+_INPUT_NAMES = ('AINCOM', 'AIN0', 'AIN1', 'AIN2', 'AIN3', 'AIN4', 'AIN5', 'AIN6',
+                'AIN7', 'AIN8', 'AIN9', 'INTEMPSENSE', 'INTAV4', 'INTDV4',
+                'ALLOPEN', 'VCOM')
+
+
+def _crc_table():
+    # CRC-8 ATM polynomial x^8 + x^2 + x + 1, section 9.5.2.2
+    table = bytearray(256)
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = ((c << 1) ^ 0x07) & 0xFF if c & 0x80 else (c << 1) & 0xFF
+        table[i] = c
+    return bytes(table)
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc8(data, crc=0xFF):
+    for b in data:
+        crc = CRC_TABLE[crc ^ b]
+    return crc
+
+
+class ADS1261Sim:
+    def __init__(self, bus=1, rst=19, pwdn=21, drdy=23, start=18, inputs=None,
+                 avdd=5000.0, internal_ref=2500.0, dvdd=3300.0, noise_uV=0.0,
+                 seed=1, first_conversion_us=None, settling=False):
+        self.pins = {'rst': rst, 'pwdn': pwdn, 'drdy': drdy, 'start': start}
+        self.inputs = dict(inputs or {})
+        self.avdd = avdd
+        self.internal_ref = internal_ref
+        self.dvdd = dvdd
+        self.noise_uV = noise_uV
+        self.random = random.Random(seed)
+        self.first_conversion_us = first_conversion_us
+        self.settling = settling
+        self._weights = {}
+
+        self.regs = bytearray(RESET_REGISTERS)
+        self.data = bytes(3)
+        self.code = 0
+        self.fresh = False
+        self.converting = False
+        self.due = None
+
+        self.reset_counters()
+
+        Pin.drive(drdy, 1)
+        Pin.watch(start, self._on_start_pin)
+        Pin.watch(rst, self._on_rst_pin)
+        Pin.watch(pwdn, self._on_pwdn_pin)
+        self.powered = True
+        SPI.attach(bus, self)
+        utime.add_listener(self)
+
+    def reset_counters(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.frames = {}
+        self.conversions = 0
+        self.reads = 0
+        self.stale_reads = 0
+        self.overwritten = 0
+        self.crc_errors = 0
+
+    def counters(self):
+        return {
+            'transfers': self.transfers,
+            'bytes': self.bytes,
+            'frames': dict(self.frames),
+            'conversions': self.conversions,
+            'reads': self.reads,
+            'stale_reads': self.stale_reads,
+            'overwritten': self.overwritten,
+            'crc_errors': self.crc_errors,
+        }
+
+    # ---- configuration decoded from the register file
+
+    def data_rate(self):
+        return DATA_RATES[min(self.regs[MODE0] >> 3, len(DATA_RATES) - 1)]
+
+    def digital_filter(self):
+        return FILTERS[min(self.regs[MODE0] & 0x07, len(FILTERS) - 1)]
+
+    def gain(self):
+        return 1 << (self.regs[PGA] & 0x07)
+
+    def period_us(self):
+        period = 1000000.0 / self.data_rate()
+        if (self.regs[MODE1] >> 5) & 0x03:  # chop and AC excitation double it
+            period *= 2
+        return period
+
+    def settle_us(self):
+        if self.first_conversion_us is not None:
+            return self.first_conversion_us(self)
+        delay = DELAYS_US[min(self.regs[MODE1] & 0x0F, len(DELAYS_US) - 1)]
+        return delay + SETTLE_PERIODS[self.digital_filter()] * self.period_us()
+
+    def reference_mV(self):
+        ref = self.regs[REF]
+        positive = {0: self.internal_ref, 1: self.avdd}.get((ref >> 2) & 0x03)
+        negative = {0: 0.0, 1: 0.0}.get(ref & 0x03)
+        if positive is None:
+            positive = self.voltage(('AIN0', 'AIN2')[((ref >> 2) & 0x03) - 2])
+        if negative is None:
+            negative = self.voltage(('AIN1', 'AIN3')[(ref & 0x03) - 2])
+        return positive - negative
+
+    def voltage(self, name, t=None):
+        if name == 'INTAV4':
+            return self.avdd / 4
+        if name == 'INTDV4':
+            return self.dvdd / 4
+        if name == 'VCOM':
+            return self.avdd / 2
+        if name == 'INTEMPSENSE':
+            return 122.4  # about 25 °C
+        value = self.inputs.get(name, 0.0)
+        if callable(value):
+            value = value(utime.now_us() / 1e6 if t is None else t)
+        return value
+
+    # ---- pins
+
+    def _on_start_pin(self, level):
+        if level:
+            self._restart()
+        elif (self.regs[MODE1] >> 4) & 1 == 0:
+            self.converting = False  # continuous mode stops after this one
+
+    def _on_rst_pin(self, level):
+        if not level:
+            self._reset()
+
+    def _on_pwdn_pin(self, level):
+        self.powered = bool(level)
+        if not level:
+            self.converting, self.due = False, None
+
+    def _reset(self):
+        self.regs[:] = RESET_REGISTERS
+        self.fresh = False
+        self.converting, self.due = False, None
+        Pin.drive(self.pins['drdy'], 1)
+        if Pin._levels.get(self.pins['start'], 0):
+            self._restart()
+
+    def _restart(self):
+        if not self.powered:
+            return
+        self.converting = True
+        self.due = utime.now_us() + self.settle_us()
+
+    # ---- utime listener
+
+    def next_event(self):
+        return None if self.due is None else int(math.ceil(self.due))
+
+    def on_event(self, now):
+        due = self.due
+        self._complete(now)
+        if self.due != due:
+            return  # restarted from inside the DRDY handler
+        if self.converting and (self.regs[MODE1] >> 4) & 1 == 0:
+            self.due += self.period_us()
+        else:
+            self.converting, self.due = False, None
+
+    def _complete(self, now):
+        p = _INPUT_NAMES[self.regs[INPMUX] >> 4]
+        n = _INPUT_NAMES[self.regs[INPMUX] & 0x0F]
+        t = now / 1e6
+        ref = self.reference_mV() or 1.0
+        scale = self.gain() * 8388608.0 / ref
+        if self.settling:
+            value = self._filtered(p, n, now) * scale
+        else:
+            value = (self.voltage(p, t) - self.voltage(n, t)) * scale
+        if self.noise_uV:
+            value += self.random.gauss(0.0, self.noise_uV / 1000.0 * scale)
+        code = int(round(value))
+        status = self.regs[STATUS] & ~(_PGAL_ALM | _PGAH_ALM)
+        if code > 0x7FFFFF:
+            code, status = 0x7FFFFF, status | _PGAH_ALM
+        elif code < -0x800000:
+            code, status = -0x800000, status | _PGAL_ALM
+        self.regs[STATUS] = status | _DRDY
+        self.code = code
+        self.data = (code & 0xFFFFFF).to_bytes(3, 'big')
+        self.conversions += 1
+        if self.fresh:
+            self.overwritten += 1
+            Pin.drive(self.pins['drdy'], 1)  # DRDY pulses high before falling again
+        self.fresh = True
+        Pin.drive(self.pins['drdy'], 0)
+
+    def _filtered(self, p, n, now, per_period=8):
+        """p - n weighted over the filter's span ending at now (µs)."""
+        periods = SETTLE_PERIODS[self.digital_filter()]
+        weights = self._weights.get(periods)
+        if weights is None:
+            weights = [1.0]
+            for _ in range(periods):
+                out = [0.0] * (len(weights) + per_period - 1)
+                for i, w in enumerate(weights):
+                    for j in range(per_period):
+                        out[i + j] += w
+                weights = out
+            self._weights[periods] = weights
+        step = self.period_us() / per_period
+        start = now - step * (len(weights) - 1)
+        total = 0.0
+        for i, w in enumerate(weights):
+            t = (start + i * step) / 1e6
+            total += w * (self.voltage(p, t) - self.voltage(n, t))
+        return total / sum(weights)
+
+    # ---- SPI
+
+    def exchange(self, wbuf):
+        self.transfers += 1
+        self.bytes += len(wbuf)
+        out = bytearray(b'\xff' * len(wbuf))
+        i, n = 0, len(wbuf)
+        while i < n:
+            used = self._frame(wbuf, out, i)
+            if not used:
+                break
+            i += used
+        return out
+
+    def _frame(self, w, out, i):
+        """Decode one frame at w[i:], fill out[] and return its length (0 if
+        what is left is too short to be a whole frame)."""
+        crc_on = self.regs[MODE3] & 0x20
+        status_on = self.regs[MODE3] & 0x40
+        header = 4 if crc_on else 2
+        cmd = w[i]
+        if cmd == 0x12:
+            payload = (1 if status_on else 0) + 3 + (1 if crc_on else 0)
+        elif 0x20 <= cmd < 0x40:
+            payload = 1 + (1 if crc_on else 0)
+        else:
+            payload = 0
+        size = header + payload
+        if i + size > len(w):
+            return 0
+
+        for k in range(1, header):
+            out[i + k] = w[i + k - 1]
+        if crc_on and crc8(w[i:i + 2]) != w[i + 2]:
+            self.crc_errors += 1
+            self.regs[STATUS] |= _CRCERR
+            self._count('CRCERR')
+            return size
+
+        p = i + header
+        arg = w[i + 1]
+        if cmd == 0x12:
+            self._count('RDATA')
+            self.reads += 1
+            if not self.fresh:
+                self.stale_reads += 1
+            start = p
+            if status_on:
+                out[p] = self.regs[STATUS]
+                p += 1
+            out[p:p + 3] = self.data
+            p += 3
+            if crc_on:
+                out[p] = crc8(out[start:p])
+            self.fresh = False
+            self.regs[STATUS] &= ~_DRDY
+            Pin.drive(self.pins['drdy'], 1)
+        elif 0x20 <= cmd < 0x40:
+            self._count('RREG')
+            address = cmd & 0x1F
+            out[p] = self.regs[address] if address < len(self.regs) else 0
+            if crc_on:
+                out[p + 1] = crc8(out[p:p + 1])
+        elif 0x40 <= cmd < 0x60:
+            self._count('WREG')
+            self._write_register(cmd & 0x1F, arg)
+        elif cmd == 0x06:
+            self._count('RESET')
+            self._reset()
+        elif cmd == 0x08:
+            self._count('START')
+            self._restart()
+        elif cmd == 0x0A:
+            self._count('STOP')
+            if (self.regs[MODE1] >> 4) & 1 == 0:
+                self.converting = False
+        elif cmd == 0xF2:
+            self._count('LOCK')
+            self.regs[STATUS] |= _LOCK
+        elif cmd == 0xF5:
+            self._count('UNLOCK')
+            self.regs[STATUS] &= ~_LOCK
+        elif cmd in (0x16, 0x17, 0x19):
+            self._count('CAL')
+        else:
+            self._count('NOP')
+        return size
+
+    def _count(self, name):
+        self.frames[name] = self.frames.get(name, 0) + 1
+
+    def _write_register(self, address, value):
+        if address == ID or address >= len(self.regs):
+            return
+        if self.regs[STATUS] & _LOCK:
+            return
+        if address == STATUS:
+            # only CRCERR and RESET are writable, and writing 0 clears them
+            self.regs[STATUS] &= ~((_CRCERR | _RESET) & ~value)
+            return
+        self.regs[address] = value
+        if address in _RESTART_REGISTERS and self.converting:
+            self._restart()
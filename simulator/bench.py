@@ -0,0 +1,641 @@
+"""Acquisition benchmarks against the simulated ADS1261.
+
+    python simulator/bench.py                      # run everything, print a table
+    python simulator/bench.py get_measurement -n 2000
+    python simulator/bench.py --json now.json --baseline before.json
+
+Times are virtual: SPI transfers, pin reads and sleeps are charged using the
+cost model in machine.py, so the figures compare code paths rather than host
+CPUs. Heap figures are the net bytes still allocated per sample once a run
+finishes (tracemalloc), which is what fills the ESP32 heap between
+collections. With --baseline, exits 1 if samples/s drops or heap/sample grows
+by more than --tolerance.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import hostsim
+
+hostsim.install()
+
+import utime  # noqa: E402
+
+SCENARIOS = {}
+
+# Two differential pairs as wired in datalogger.measure
+INPUTS = {'AIN3': 25.0, 'AIN4': 0.0, 'AIN6': 210.0, 'AIN7': 200.0}
+
+
+def scenario(name):
+    def register(f):
+        SCENARIOS[name] = f
+        return f
+    return register
+
+
+def configure(adc):
+    """The register setup datalogger.measure does before its loop."""
+    adc.reset()
+    adc.setup_measurements()
+    adc.set_frequency(19200, 'sinc4')
+    adc.PGA(GAIN=1)
+    adc.mode1()
+    adc.reference_config(reference_enable=1, RMUXP="AVDD", RMUXN="AVSS")
+
+
+class Run:
+    """Counts samples and measures virtual time, SPI traffic and heap."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.samples = 0
+
+    def __enter__(self):
+        self.sim.reset_counters()
+        tracemalloc.start()
+        self.heap0 = tracemalloc.get_traced_memory()[0]
+        self.t0 = utime.now_us()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = utime.now_us() - self.t0
+        self.heap = tracemalloc.get_traced_memory()[0] - self.heap0
+        tracemalloc.stop()
+        return exc[0] is utime.SimulationEnd
+
+    def result(self):
+        n = max(self.samples, 1)
+        c = self.sim.counters()
+        return {
+            'samples': self.samples,
+            'virtual_us': self.elapsed,
+            'samples_per_s': round(self.samples * 1e6 / max(self.elapsed, 1), 1),
+            'us_per_sample': round(self.elapsed / n, 1),
+            'transfers_per_sample': round(c.get('transfers', 0) / n, 2),
+            'bytes_per_sample': round(c.get('bytes', 0) / n, 1),
+            'stale_reads_per_sample': round(c.get('stale_reads', 0) / n, 2),
+            'conversions_per_sample': round(c.get('conversions', 0) / n, 2),
+            'heap_bytes_per_sample': round(max(self.heap, 0) / n, 2),
+        }
+
+
+@scenario('get_measurement')
+def bench_get_measurement(samples):
+    sim = hostsim.fresh(inputs=INPUTS)
+    datalogger = hostsim.load('datalogger')
+    adc = datalogger.init_adc()
+    configure(adc)
+    wri = adc.spi.write_readinto
+    i1 = memoryview(datalogger.input_bytes(adc, 'AIN3', 'AIN4'))
+    i2 = memoryview(datalogger.input_bytes(adc, 'AIN6', 'AIN7'))
+    wmv = memoryview(bytes(b'\x12\x00\x00\x00\x00'))
+    r1mv, r2mv = memoryview(bytearray(5)), memoryview(bytearray(5))
+    imv = memoryview(bytearray(5))
+    get = datalogger.get_measurement
+    with Run(sim) as run:
+        v0 = v1 = 0
+        for _ in range(samples // 2):
+            v0 += get(_i=i1, wri=wri, wmv=wmv, rmv=r1mv, imv=imv)
+            wri(i2, imv)
+            wri(i2, imv)
+            v1 += get(_i=i2, wri=wri, wmv=wmv, rmv=r2mv, imv=imv)
+            wri(i1, imv)
+            wri(i1, imv)
+            run.samples += 2
+    return run.result()
+
+
+@scenario('drdy_capture')
+def bench_drdy_capture(samples):
+    sim = hostsim.fresh(inputs=INPUTS)
+    datalogger = hostsim.load('datalogger')
+    ads1261evm = hostsim.load('ads1261evm')
+    adc = datalogger.init_adc()
+    configure(adc)
+    i1 = memoryview(datalogger.input_bytes(adc, 'AIN3', 'AIN4'))
+    i2 = memoryview(datalogger.input_bytes(adc, 'AIN6', 'AIN7'))
+    cap = ads1261evm.DrdyCapture(adc)
+    cap.start()
+    get = datalogger.capture_measurement
+    with Run(sim) as run:
+        v0 = v1 = 0
+        for _ in range(samples // 2):
+            v0 += get(i1, cap)
+            v1 += get(i2, cap)
+            run.samples += 2
+    cap.stop()
+    result = run.result()
+    result['missed'] = cap.missed
+    result['duplicates'] = cap.duplicates
+    return result
+
+
+def scan(samples, channels, verified=False, pulsed=False, inputs=INPUTS):
+    """Cycle a scan plan over channels and check every channel's mean
+    against its differential input: a sample filed under the wrong
+    channel shows up here and nowhere else."""
+    sim = hostsim.fresh(inputs=inputs)
+    datalogger = hostsim.load('datalogger')
+    ads1261evm = hostsim.load('ads1261evm')
+    scanplan = hostsim.load('scanplan')
+    ringbuffer = hostsim.load('ringbuffer')
+    adc = datalogger.init_adc()
+    configure(adc)
+    if verified:
+        adc.integrity()
+    if pulsed:
+        pulse = hostsim.load('pulse')
+        plan = pulse.plan(adc, channels)
+    else:
+        plan = scanplan.ScanPlan(adc, channels)
+    ring = ringbuffer.SampleRing(512)
+    codes, ids = ringbuffer.array('i', bytes(4 * 256)), bytearray(256)
+    acc = hostsim.load('moments').Moments(plan.n)
+    engine = pulse.Sequencer if pulsed else scanplan.Scanner
+    scanner = engine(plan, ads1261evm.DrdyCapture(adc, plan.rdata, ring))
+    scanner.start()
+    with Run(sim) as run:
+        while run.samples < samples:
+            scanner.cycle()
+            run.samples += plan.n
+            if len(ring) > 256:
+                datalogger.accumulate(ring, codes, None, ids, acc)
+    scanner.stop()
+    while len(ring):
+        datalogger.accumulate(ring, codes, None, ids, acc)
+    for c, spec in enumerate(plan.specs):
+        expected = inputs.get(spec['positive'], 0.0) - inputs.get(spec['negative'], 0.0)
+        got = acc.mean_mV(c, plan.scales[c])
+        if abs(got - expected) > 0.01:
+            raise AssertionError('channel %d (%s-%s, gain %d) reads %.3f mV, expected %.3f'
+                                 % (c, spec['positive'], spec['negative'], spec['gain'],
+                                    got, expected))
+    return run.result()
+
+
+@scenario('scan2')
+def bench_scan2(samples):
+    """The two datalogger channels through a compiled scan plan."""
+    return scan(samples, [('AIN3', 'AIN4'), ('AIN6', 'AIN7')])
+
+
+@scenario('scan2_verified')
+def bench_scan2_verified(samples):
+    """scan2 with STATUS and CRC on, every frame checked in the IRQ."""
+    return scan(samples, [('AIN3', 'AIN4'), ('AIN6', 'AIN7')], verified=True)
+
+
+@scenario('pulse2')
+def bench_pulse2(samples):
+    """scan2 in pulse mode: a START pulse per conversion (see pulse)."""
+    return scan(samples, [('AIN3', 'AIN4'), ('AIN6', 'AIN7')], pulsed=True)
+
+
+@scenario('scan8')
+def bench_scan8(samples):
+    """Eight single-ended channels with mixed gains."""
+    return scan(samples, [('AIN%d' % k, 'AINCOM', 1 << (k % 3)) for k in range(8)])
+
+
+@scenario('scan3_mixed')
+def bench_scan3_mixed(samples):
+    """Three channels whose switch chains differ in length (gain 1, 1, 4),
+    so the capture's read buffer is sized by the longest."""
+    return scan(samples, [('AIN1', 'AINCOM', 1), ('AIN2', 'AINCOM', 1), ('AIN3', 'AINCOM', 4)],
+                inputs={'AIN1': 100.0, 'AIN2': 200.0, 'AIN3': 300.0})
+
+
+def lockin_scan(samples, pairs):
+    """Lock-in over pairs of (positive, negative, offset mV, signal mV) on
+    the settling ADC model. The positive input is offset plus the signal
+    while the excitation pin (32) is high and minus it while low, so a
+    conversion that straddles a reversal pulls the difference towards 0.
+    Checks the demodulated difference and common terms of every pair."""
+    from machine import Pin
+    levels = [(0, 0)]  # (µs, level) of pin 32
+
+    def excited(offset, signal):
+        def mV(t):
+            us = t * 1e6
+            k = len(levels) - 1
+            while k and levels[k][0] > us:
+                k -= 1
+            return offset + (signal if levels[k][1] else -signal)
+        return mV
+
+    inputs = {}
+    for positive, negative, offset, signal in pairs:
+        inputs[positive], inputs[negative] = excited(offset, signal), 0.0
+    sim = hostsim.fresh(inputs=inputs, settling=True)
+
+    def reversed_at(level):
+        levels.append((utime.now_us(), level))
+        if len(levels) > 64:  # far older than any filter span
+            del levels[:32]
+    Pin.watch(32, reversed_at)
+    datalogger = hostsim.load('datalogger')
+    ads1261evm = hostsim.load('ads1261evm')
+    scanplan = hostsim.load('scanplan')
+    ringbuffer = hostsim.load('ringbuffer')
+    lock = hostsim.load('lockin').LockIn([(p, n) for p, n, _, _ in pairs])
+    adc = datalogger.init_adc()
+    configure(adc)
+    plan = scanplan.ScanPlan(adc, lock.specs)
+    ring = ringbuffer.SampleRing(512)
+    codes, ids = ringbuffer.array('i', bytes(4 * 256)), bytearray(256)
+    scanner = scanplan.Scanner(plan, ads1261evm.DrdyCapture(adc, plan.rdata, ring),
+                               current_pin=Pin(32, Pin.OUT))
+    scanner.start()
+    with Run(sim) as run:
+        while run.samples < samples:
+            scanner.cycle()
+            run.samples += plan.n
+            if len(ring) > 256:
+                datalogger.accumulate(ring, codes, None, ids, lock)
+    scanner.stop()
+    while len(ring):
+        datalogger.accumulate(ring, codes, None, ids, lock)
+    for c, (positive, negative, offset, signal) in enumerate(pairs):
+        for name, got, expected in (('difference', lock.difference_mV(c), signal),
+                                    ('common', lock.common_mV(c), offset)):
+            if abs(got - expected) > 0.01:
+                raise AssertionError('%s of %s-%s is %.3f mV, expected %.3f'
+                                     % (name, positive, negative, got, expected))
+    return run.result()
+
+
+@scenario('lockin1')
+def bench_lockin1(samples):
+    """One channel in both current directions (A+ A- A- A+): only the
+    excitation pin changes, so the plan must restart conversions itself."""
+    return lockin_scan(samples, [('AIN3', 'AIN4', 10.0, 50.0)])
+
+
+@scenario('lockin2')
+def bench_lockin2(samples):
+    """The two datalogger channels as a lock-in scan (A+ B+ B- A- ...)."""
+    return lockin_scan(samples, [('AIN3', 'AIN4', 10.0, 50.0), ('AIN6', 'AIN7', -3.0, 20.0)])
+
+
+@scenario('collect_measurement')
+def bench_collect_measurement(samples):
+    sim = hostsim.fresh(inputs=INPUTS)
+    ads1261evm = hostsim.load('ads1261evm')
+    adc = ads1261evm.ADC1261()
+    configure(adc)
+    adc.choose_inputs('AIN3', 'AIN4')
+    with Run(sim) as run:
+        for _ in range(samples):
+            adc.collect_measurement(method='hardware')
+            run.samples += 1
+    return run.result()
+
+
+@scenario('reconfigure')
+def bench_reconfigure(samples):
+    """Channel + gain changes through the register shadow, plus the
+    check_* readbacks datalogger prints. Samples are reconfigurations."""
+    sim = hostsim.fresh(inputs=INPUTS)
+    ads1261evm = hostsim.load('ads1261evm')
+    adc = ads1261evm.ADC1261()
+    configure(adc)
+    setups = (('AIN3', 'AIN4', 1), ('AIN6', 'AIN7', 4))
+    with Run(sim) as run:
+        for k in range(samples):
+            positive, negative, gain = setups[k & 1]
+            adc.choose_inputs(positive, negative)
+            adc.PGA(GAIN=gain)
+            adc.check_frequency(print_freq=False)
+            adc.check_mode1()
+            run.samples += 1
+    return run.result()
+
+
+@scenario('measure')
+def bench_measure(samples):
+    """datalogger.measure end to end, including its per-second file write.
+    Runs for samples / 1000 virtual seconds (at least three windows).
+    Samples here are conversions actually read, not stale re-reads."""
+    sim = hostsim.fresh(inputs=INPUTS)
+    datalogger = hostsim.load('datalogger')
+    binlog = hostsim.load('binlog')
+    adc = datalogger.init_adc()
+    seconds = max(3, samples // 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'data.bin')
+        with Run(sim) as run:
+            utime.stop_at(utime.now_us() + seconds * 1000000)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    datalogger.measure(filename, adc=adc)
+            finally:
+                utime.stop_at(None)
+        windows = sum(1 for _ in binlog.rows(filename))
+    c = sim.counters()
+    run.samples = c['reads'] - c['stale_reads']
+    result = run.result()
+    result['windows'] = windows
+    return result
+
+
+def sd_card(hardware=False):
+    """Simulated card on the pins datalogger.init_sd uses: bit-banged at
+    1.32 MHz, or on hardware SPI 2 at the negotiated clock. Returns the
+    card, the driver and the world's simulated ADS1261."""
+    from machine import Pin, SoftSPI, SPI
+    from sdsim import SDCardSim
+
+    sim = hostsim.fresh(inputs=INPUTS)
+    card = SDCardSim(bus=2 if hardware else 26, cs=33, store=False)
+    sdcard = hostsim.load('sdcard')
+    if hardware:
+        sd = sdcard.SDCard(SPI(2, sck=Pin(26), mosi=Pin(25), miso=Pin(27)), Pin(33))
+        sd.negotiate()
+    else:
+        sd = sdcard.SDCard(SoftSPI(sck=Pin(26), mosi=Pin(25), miso=Pin(27)), Pin(33))
+    return card, sd, sim
+
+
+def sd_result(run, card):
+    if card.violations:
+        raise AssertionError('SD protocol violations: %r' % card.violations[:5])
+    result = run.result()
+    result['MB_per_s'] = round(run.samples * 512 / max(run.elapsed, 1), 3)
+    result['busy_polls_per_block'] = round(card.busy_polls / max(run.samples, 1), 2)
+    return result
+
+
+@scenario('sd_writeblocks')
+def bench_sd_writeblocks(samples):
+    """4 KB buffers with one CMD25 + stop token each. Samples are blocks."""
+    card, sd, _ = sd_card()
+    buf = bytearray(4096)
+    with Run(card) as run:
+        for k in range(max(1, samples // 8)):
+            sd.writeblocks(4096 + k * 8, buf)
+            run.samples += 8
+    return sd_result(run, card)
+
+
+def sd_stream(samples, hardware):
+    card, sd, _ = sd_card(hardware)
+    buf = bytearray(4096)
+    n = max(1, samples // 8)
+    with Run(card) as run:
+        sd.begin_stream(4096, n * 8)
+        for k in range(n):
+            sd.write_stream(buf)
+            run.samples += 8
+        sd.end_stream()
+    result = sd_result(run, card)
+    result['clock_hz'] = sd.baudrate
+    return result
+
+
+@scenario('sd_stream')
+def bench_sd_stream(samples):
+    """The same buffers through one pre-erased streaming session."""
+    return sd_stream(samples, False)
+
+
+@scenario('sd_stream_hw')
+def bench_sd_stream_hw(samples):
+    """Streaming on hardware SPI after clock negotiation."""
+    return sd_stream(samples, True)
+
+
+def sd_overlap(samples, yielding):
+    """An ADC task and an SD task sharing one uasyncio loop. Samples are
+    conversions read while 32 KB are streamed to the card."""
+    import uasyncio
+
+    card, sd, sim = sd_card()
+    datalogger = hostsim.load('datalogger')
+    ads1261evm = hostsim.load('ads1261evm')
+    adc = datalogger.init_adc()
+    configure(adc)
+    i1 = memoryview(datalogger.input_bytes(adc, 'AIN3', 'AIN4'))
+    cap = ads1261evm.DrdyCapture(adc)
+    cap.start()
+    buf = bytearray(4096)
+    state = {'writing': True}
+
+    async def acquire(run):
+        while state['writing']:
+            cap.measure(i1)
+            run.samples += 1
+            await uasyncio.sleep_ms(0)
+
+    async def store():
+        sd.begin_stream(4096, 64)
+        for _ in range(8):
+            if yielding:
+                await sd.write_stream_async(buf)
+            else:
+                sd.write_stream(buf)
+            await uasyncio.sleep_ms(0)
+        sd.end_stream()
+        state['writing'] = False
+
+    async def both(run):
+        await uasyncio.gather(acquire(run), store())
+
+    with Run(sim) as run:
+        uasyncio.run(both(run))
+    cap.stop()
+    result = run.result()
+    result['MB_per_s'] = round(64 * 512 / max(run.elapsed, 1), 3)
+    result['busy_yields'] = sd.busy_yields
+    if card.violations:
+        raise AssertionError('SD protocol violations: %r' % card.violations[:5])
+    return result
+
+
+@scenario('sd_blocking_acq')
+def bench_sd_blocking_acq(samples):
+    return sd_overlap(samples, False)
+
+
+@scenario('sd_async_acq')
+def bench_sd_async_acq(samples):
+    return sd_overlap(samples, True)
+
+
+def pipelined(samples, yielding):
+    """The datalogger channels through pipeline.Pipeline in raw mode, with
+    every RAW record streamed to the card by the SD sink. Samples are the
+    conversions kept, i.e. not lost to ring overflows."""
+    import uasyncio
+
+    card, sd, sim = sd_card()
+    datalogger = hostsim.load('datalogger')
+    ads1261evm = hostsim.load('ads1261evm')
+    scanplan = hostsim.load('scanplan')
+    ringbuffer = hostsim.load('ringbuffer')
+    moments = hostsim.load('moments')
+    pipeline = hostsim.load('pipeline')
+    adc = datalogger.init_adc()
+    configure(adc)
+    plan = scanplan.ScanPlan(adc, datalogger.CHANNELS)
+    ring = ringbuffer.SampleRing(512)
+    cap = ads1261evm.DrdyCapture(adc, plan.rdata, ring)
+    pipe = pipeline.Pipeline(scanplan.Scanner(plan, cap), ring, moments.Moments(plan.n),
+                             plan.scales, raw=True)
+    block = bytearray(512)
+    state = {'fill': 0, 'blocks': 0}
+
+    async def store(data):
+        offset = 0
+        while offset < len(data):
+            n = min(len(data) - offset, 512 - state['fill'])
+            block[state['fill']:state['fill'] + n] = data[offset:offset + n]
+            state['fill'] += n
+            offset += n
+            if state['fill'] == 512:
+                if yielding:
+                    await sd.write_stream_async(block)
+                else:
+                    sd.write_stream(block)
+                state['fill'] = 0
+                state['blocks'] += 1
+        if cap.conversions - ring.overflows >= samples:
+            pipe.stop()
+
+    pipe.add_sink('sd', store, awaitable=True)
+    sd.begin_stream(4096)
+    with Run(sim) as run:
+        report = uasyncio.run(pipe.run())
+        run.samples = cap.conversions - ring.overflows
+    sd.end_stream()
+    result = sd_result(run, card)
+    result['MB_per_s'] = round(state['blocks'] * 512 / max(run.elapsed, 1), 3)
+    result['ring_overflows'] = report['ring'][2]
+    result['sd_dropped'] = report['queues']['sd'][3]
+    result['sd_latency_max_us'] = report['sd'][3]
+    return result
+
+
+@scenario('pipeline_blocking_sd')
+def bench_pipeline_blocking_sd(samples):
+    return pipelined(samples, False)
+
+
+@scenario('pipeline_async_sd')
+def bench_pipeline_async_sd(samples):
+    return pipelined(samples, True)
+
+
+def two_threads(samples, threaded):
+    """The datalogger channels through dualcore.run in raw mode, the worker
+    streaming every RAW record to the card (bit-banged SPI) on a second
+    thread or, single, between scan cycles. Runs samples / 4 virtual ms.
+    Samples are the conversions kept, i.e. not lost to ring overflows;
+    max_stall_us is the longest gap between scan cycles. Under the GIL
+    (see simthread) the worker's turns fall inside scan cycles rather than
+    between them, so compare ring_overflows too."""
+    card, sd, sim = sd_card()
+    datalogger = hostsim.load('datalogger')
+    ads1261evm = hostsim.load('ads1261evm')
+    scanplan = hostsim.load('scanplan')
+    ringbuffer = hostsim.load('ringbuffer')
+    moments = hostsim.load('moments')
+    dualcore = hostsim.load('dualcore')
+    adc = datalogger.init_adc()
+    configure(adc)
+    plan = scanplan.ScanPlan(adc, datalogger.CHANNELS)
+    ring = ringbuffer.SampleRing(512)
+    cap = ads1261evm.DrdyCapture(adc, plan.rdata, ring)
+    block = bytearray(512)
+    state = {'fill': 0}
+
+    class Stream:
+        def write(self, data):
+            offset = 0
+            while offset < len(data):
+                n = min(len(data) - offset, 512 - state['fill'])
+                block[state['fill']:state['fill'] + n] = data[offset:offset + n]
+                state['fill'] += n
+                offset += n
+                if state['fill'] == 512:
+                    sd.write_stream(block)
+                    state['fill'] = 0
+
+    worker = dualcore.Worker(ring, moments.Moments(plan.n), Stream(), plan.n, raw=True)
+    sd.begin_stream(4096)
+    with Run(sim) as run:
+        report = dualcore.run(scanplan.Scanner(plan, cap), worker, max(250, samples // 4), threaded)
+        run.samples = cap.conversions - ring.overflows
+    sd.end_stream()
+    if card.violations:
+        raise AssertionError('SD protocol violations: %r' % card.violations[:5])
+    result = run.result()
+    result['threaded'] = report['threaded']
+    result['max_stall_us'] = report['acquire'][3]
+    result['ring_overflows'] = report['ring'][2]
+    result['ring_high_water'] = report['ring'][1]
+    return result
+
+
+@scenario('dualcore_single')
+def bench_dualcore_single(samples):
+    return two_threads(samples, False)
+
+
+@scenario('dualcore_threaded')
+def bench_dualcore_threaded(samples):
+    return two_threads(samples, True)
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if now['samples_per_s'] < before['samples_per_s'] * (1 - tolerance):
+            failures.append('%s: samples/s %s -> %s' % (name, before['samples_per_s'], now['samples_per_s']))
+        limit = before['heap_bytes_per_sample'] * (1 + tolerance) + 1
+        if now['heap_bytes_per_sample'] > limit:
+            failures.append('%s: heap bytes/sample %s -> %s' % (
+                name, before['heap_bytes_per_sample'], now['heap_bytes_per_sample']))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', help='default: all of %s' % ', '.join(SCENARIOS))
+    parser.add_argument('-n', '--samples', type=int, default=1000)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.scenarios or list(SCENARIOS):
+        results[name] = SCENARIOS[name](args.samples)
+        r = results[name]
+        print('%-22s %9.1f samples/s %8.1f us/sample %6.2f xfers/sample %8.2f heap B/sample' % (
+            name, r['samples_per_s'], r['us_per_sample'], r['transfers_per_sample'],
+            r['heap_bytes_per_sample']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print('REGRESSION', failure)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
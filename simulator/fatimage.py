@@ -0,0 +1,281 @@
+"""FAT16/FAT32 card images for checking extentlog's raw FAT rewrite.
+
+extentlog.recover() runs on every *.bin at boot and, like fix_length(),
+edits the FAT and the root directory with raw block writes. selftest()
+runs both against images built here, independently of extentlog.Volume:
+
+- FAT16 (8150 clusters of 4 blocks), FAT32 with a root directory chained
+  over two clusters, and FAT32 behind an MBR partition table
+- the extent between two other files, after a long-name and a deleted
+  entry, and on FAT32 past cluster 65535, where the entry's high word
+  counts
+- a fragmented file, which must be refused with nothing written
+
+and checks the size in the directory entry, the trimmed chain in both FAT
+copies, the freed clusters and that nothing else on the card changed.
+
+    python simulator/fatimage.py
+"""
+
+import struct
+
+import hostsim
+
+hostsim.install()
+
+import extentlog  # noqa: E402
+
+BLOCK = 512
+EOC16, EOC32 = 0xFFFF, 0x0FFFFFFF
+
+
+class Card:
+    """A block device with readblocks/writeblocks over sparse 512-byte
+    blocks, counting the blocks written."""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.data = {}
+        self.written = set()
+
+    def readblocks(self, block, buf):
+        for k in range(len(buf) // BLOCK):
+            buf[k * BLOCK:(k + 1) * BLOCK] = self.data.get(block + k, bytes(BLOCK))
+
+    def writeblocks(self, block, buf):
+        for k in range(len(buf) // BLOCK):
+            if not 0 <= block + k < self.blocks:
+                raise OSError('block %d beyond the card' % (block + k))
+            self.data[block + k] = bytes(buf[k * BLOCK:(k + 1) * BLOCK])
+            self.written.add(block + k)
+
+    def snapshot(self):
+        return dict(self.data)
+
+
+class Image:
+    """A freshly formatted volume on a Card, with files added one by one,
+    each as a chain of clusters given explicitly."""
+
+    def __init__(self, fat32, total, spc, start=0, root_clusters=2):
+        self.fat32 = fat32
+        self.spc = spc
+        self.start = start
+        self.card = Card(start + total)
+        self.reserved = 32 if fat32 else 1
+        self.nfats = 2
+        root_entries = 0 if fat32 else 512
+        self.root_blocks = root_entries * 32 // BLOCK
+        size = 4 if fat32 else 2
+        self.fat_size = 1
+        while True:  # the FAT must cover the clusters left beside it
+            clusters = (total - self.reserved - self.nfats * self.fat_size - self.root_blocks) // spc
+            need = ((clusters + 2) * size + BLOCK - 1) // BLOCK
+            if need <= self.fat_size:
+                break
+            self.fat_size = need
+        self.clusters = clusters
+        b = bytearray(BLOCK)
+        b[0:3] = b'\xEB\x58\x90'
+        b[3:11] = b'MSWIN4.1'
+        struct.pack_into('<HBHBHHBH', b, 0x0B, BLOCK, spc, self.reserved, self.nfats,
+                         root_entries, total if total < 0x10000 and not fat32 else 0, 0xF8,
+                         0 if fat32 else self.fat_size)
+        struct.pack_into('<I', b, 0x20, total if total >= 0x10000 or fat32 else 0)
+        if fat32:
+            struct.pack_into('<I', b, 0x24, self.fat_size)
+            struct.pack_into('<I', b, 0x2C, 2)
+        b[510], b[511] = 0x55, 0xAA
+        self.card.writeblocks(start, b)
+        if start:  # an MBR whose first partition holds the volume
+            mbr = bytearray(BLOCK)
+            mbr[0x1C2] = 0x0C if fat32 else 0x06
+            struct.pack_into('<II', mbr, 0x1C6, start, total)
+            mbr[510], mbr[511] = 0x55, 0xAA
+            self.card.writeblocks(0, mbr)
+        self.fat = start + self.reserved
+        self.root = self.fat + self.nfats * self.fat_size
+        self.data = self.root + self.root_blocks
+        self.set_fat(0, 0x0FFFFFF8 if fat32 else 0xFFF8)
+        self.set_fat(1, EOC32 if fat32 else EOC16)
+        self.next_cluster = 2
+        self.root_chain = []
+        if fat32:
+            self.root_chain = self.allocate(root_clusters)
+        self.entries = 0
+
+    # ---- raw access, independent of extentlog.Volume
+
+    def block(self, n):
+        buf = bytearray(BLOCK)
+        self.card.readblocks(n, buf)
+        return buf
+
+    def get_fat(self, cluster, copy=0):
+        size = 4 if self.fat32 else 2
+        n, offset = divmod(cluster * size, BLOCK)
+        b = self.block(self.fat + copy * self.fat_size + n)
+        return struct.unpack_from('<I' if self.fat32 else '<H', b, offset)[0]
+
+    def set_fat(self, cluster, value):
+        size = 4 if self.fat32 else 2
+        n, offset = divmod(cluster * size, BLOCK)
+        for copy in range(self.nfats):
+            b = self.block(self.fat + copy * self.fat_size + n)
+            struct.pack_into('<I' if self.fat32 else '<H', b, offset, value)
+            self.card.writeblocks(self.fat + copy * self.fat_size + n, b)
+
+    def cluster_block(self, cluster):
+        return self.data + (cluster - 2) * self.spc
+
+    def chain(self, first, copy=0):
+        eoc = 0x0FFFFFF8 if self.fat32 else 0xFFF8
+        out = [first]
+        while True:
+            nxt = self.get_fat(out[-1], copy)
+            if self.fat32:
+                nxt &= 0x0FFFFFFF
+            if nxt >= eoc:
+                return out
+            out.append(nxt)
+
+    def allocate(self, count, gap=0):
+        """ count clusters, contiguous, after skipping gap free ones. """
+        self.next_cluster += gap
+        clusters = list(range(self.next_cluster, self.next_cluster + count))
+        self.next_cluster += count
+        for a, b in zip(clusters, clusters[1:]):
+            self.set_fat(a, b)
+        self.set_fat(clusters[-1], EOC32 if self.fat32 else EOC16)
+        return clusters
+
+    def _entry_slot(self):
+        per_block = BLOCK // 32
+        k = self.entries
+        self.entries += 1
+        if not self.fat32:
+            return self.root + k // per_block, (k % per_block) * 32
+        per_cluster = per_block * self.spc
+        cluster = self.root_chain[k // per_cluster]
+        k %= per_cluster
+        return self.cluster_block(cluster) + k // per_block, (k % per_block) * 32
+
+    def add_entry(self, raw):
+        n, offset = self._entry_slot()
+        b = self.block(n)
+        b[offset:offset + 32] = raw
+        self.card.writeblocks(n, b)
+        return n, offset
+
+    def add_file(self, name, clusters, size):
+        raw = bytearray(32)
+        raw[0:11] = extentlog.short_name(name)
+        raw[11] = 0x20
+        first = clusters[0]
+        struct.pack_into('<H', raw, 20, first >> 16 if self.fat32 else 0)
+        struct.pack_into('<H', raw, 26, first & 0xFFFF)
+        struct.pack_into('<I', raw, 28, size)
+        return self.add_entry(raw)
+
+    def filler(self, count):
+        """ Long-name and deleted entries that find() must skip. """
+        for k in range(count):
+            raw = bytearray(32)
+            if k & 1:
+                raw[0] = 0xE5
+                raw[1:11] = b'ELETED BIN'
+                raw[11] = 0x20
+            else:
+                raw[0] = 0x41
+                raw[11] = 0x0F
+            self.add_entry(raw)
+
+    def size(self, slot):
+        return struct.unpack_from('<I', self.block(slot[0]), slot[1] + 28)[0]
+
+
+def _check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def _extent_case(fat32, total, spc, start=0, filler=0, used=12345, at=0):
+    """ An unclosed extent between two files: recover() must cut it to used
+    bytes and leave everything else as it was. at: first cluster of the
+    extent, past the other file, if given. """
+    img = Image(fat32, total, spc, start)
+    name = 'FAT32' if fat32 else 'FAT16'
+    img.filler(filler)
+    before_clusters = img.allocate(3)
+    before = img.add_file('before.txt', before_clusters, 3 * spc * BLOCK - 7)
+    extent = img.allocate(64, gap=max(at - img.next_cluster, 0))
+    slot = img.add_file('data7.bin', extent, 64 * spc * BLOCK)
+    after_clusters = img.allocate(5)
+    img.add_file('after.bin', after_clusters, 5 * spc * BLOCK)
+    mark = bytearray(BLOCK)
+    struct.pack_into('<4sII', mark, 0, extentlog.MARK, used, used // BLOCK)
+    img.card.writeblocks(img.cluster_block(extent[-1]) + spc - 1, mark)
+    others = (img.chain(before_clusters[0]), img.chain(after_clusters[0]), img.size(before))
+    img.card.written.clear()
+
+    got = extentlog.recover(img.card, 'data7.bin')
+    _check(got == used, '%s: recover() returned %r, expected %d' % (name, got, used))
+    keep = (used + spc * BLOCK - 1) // (spc * BLOCK)
+    _check(img.size(slot) == used, '%s: size %d, expected %d' % (name, img.size(slot), used))
+    for copy in range(img.nfats):
+        _check(img.chain(extent[0], copy) == extent[:keep],
+               '%s: FAT copy %d keeps %r' % (name, copy, img.chain(extent[0], copy)))
+        freed = [c for c in extent[keep:] if img.get_fat(c, copy) & 0x0FFFFFFF]
+        _check(not freed, '%s: FAT copy %d did not free %r' % (name, copy, freed[:4]))
+    _check((img.chain(before_clusters[0]), img.chain(after_clusters[0]), img.size(before)) == others,
+           '%s: another file changed' % name)
+    fat_blocks = set(range(img.fat, img.fat + img.nfats * img.fat_size))
+    stray = img.card.written - fat_blocks - {slot[0]}
+    _check(not stray, '%s: wrote outside the FATs and the entry: %r' % (name, sorted(stray)[:4]))
+
+    # closed now: the block after the kept clusters is no longer a mark
+    snapshot = img.card.snapshot()
+    _check(extentlog.recover(img.card, 'data7.bin') is None, '%s: recovered twice' % name)
+    _check(img.card.snapshot() == snapshot, '%s: second recover() wrote' % name)
+
+    # and close() on an empty log keeps one cluster
+    extentlog.fix_length(img.card, 'data7.bin', 0)
+    _check(img.size(slot) == 0 and img.chain(extent[0]) == extent[:1],
+           '%s: fix_length(0) left %r' % (name, img.chain(extent[0])))
+
+
+def _fragmented_case():
+    img = Image(False, 32768, 4)
+    first = img.allocate(4)
+    second = img.allocate(4, gap=2)
+    img.set_fat(first[-1], second[0])
+    img.add_file('frag.bin', first, 8 * 4 * BLOCK)
+    snapshot = img.card.snapshot()
+    try:
+        extentlog.recover(img.card, 'frag.bin')
+    except OSError:
+        pass
+    else:
+        raise AssertionError('fragmented file: recover() did not refuse it')
+    _check(img.card.snapshot() == snapshot, 'fragmented file: recover() wrote')
+
+
+def selftest():
+    """ Returns the number of images checked; raises AssertionError on the
+    first mismatch. """
+    _extent_case(False, 32768, 4, filler=5)
+    # the entry in the second root cluster, the extent past cluster 65535
+    _extent_case(True, 70000, 1, filler=20, at=65600)
+    _extent_case(True, 70000, 1, start=2048, used=64 * BLOCK - 1)
+    _fragmented_case()
+    try:
+        extentlog.Volume(Image(False, 8000, 4).card)
+    except OSError:
+        pass
+    else:
+        raise AssertionError('FAT12 volume accepted')
+    return 5
+
+
+if __name__ == '__main__':
+    print(selftest(), 'images ok')
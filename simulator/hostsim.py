@@ -0,0 +1,78 @@
+"""Glue for running the device code under CPython.
+
+    import hostsim
+    hostsim.install()
+    sim = hostsim.fresh()           # new virtual clock, pins and ADS1261
+    datalogger = hostsim.load('datalogger')
+
+install() puts the repo modules on sys.path next to the stand-in machine,
+utime, micropython and uasyncio modules in this directory, and provides the
+viper casts (ptr8, ptr16, ptr32) as builtins that return the buffer itself. load() imports a
+repo module and points its `time` at the virtual utime clock, since on the
+device `time` and `utime` are the same module, and its `_thread` at
+simthread, which runs threads one at a time as under the ESP32's GIL.
+"""
+
+import builtins
+import gc
+import importlib
+import os
+import sys
+import time as _host_time
+import tracemalloc
+
+import machine
+import simthread
+import utime
+from ads1261sim import ADS1261Sim
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+HEAP_BYTES = 110000  # usable heap of a stock ESP32 (no SPIRAM) build
+
+
+def _mem_alloc():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+def _mem_free():
+    return HEAP_BYTES - _mem_alloc()
+
+
+def _ptr(buf):
+    return buf
+
+
+def install():
+    for name in ('ptr8', 'ptr16', 'ptr32'):
+        if not hasattr(builtins, name):
+            setattr(builtins, name, _ptr)
+    for sub in ('sdcard', 'ads1261evm', ''):
+        path = os.path.join(ROOT, sub) if sub else ROOT
+        if path not in sys.path:
+            sys.path.insert(1, path)
+    if not hasattr(gc, 'mem_free'):
+        gc.mem_free = _mem_free
+        gc.mem_alloc = _mem_alloc
+
+
+def fresh(start_ticks_us=0, **sim_kwargs):
+    """Start a new simulated world and return its ADS1261."""
+    utime.reset(start_ticks_us)
+    simthread.reset()
+    machine.reset_sim()
+    return ADS1261Sim(**sim_kwargs)
+
+
+def load(name):
+    """Import a repo module, then repoint `time` (and `_thread`, see
+    simthread) in it and in every repo module it pulled in."""
+    module = importlib.import_module(name)
+    for m in list(sys.modules.values()):
+        path = getattr(m, '__file__', None) or ''
+        if (path.startswith(ROOT) and not path.startswith(HERE)
+                and getattr(m, 'time', None) is _host_time):
+            m.time = utime
+        if path.startswith(ROOT) and not path.startswith(HERE) and hasattr(m, '_thread'):
+            m._thread = simthread
+    return module
@@ -0,0 +1,249 @@
+"""Host stand-in for the parts of MicroPython's machine module this repo uses.
+
+Pins keep their level in a table keyed by GPIO number, so a simulated device
+and the firmware see the same wire. SPI transfers are handed to whatever
+device is attached to the bus and cost modelled time on the utime clock:
+
+    cost = SPI_CALL_US + bits / baudrate
+
+SPI_CALL_US stands in for the driver and interpreter overhead of one
+write_readinto() call. 20 µs reproduces the "average time per iteration:
+601 µs" note in datalogger.measure (22 transfers plus two 50 µs sleeps).
+"""
+
+import utime
+
+SPI_CALL_US = 20
+PIN_COST_US = 2
+SOFT_SPI_MAX_HZ = 1000000  # bit-banged clock tops out well below the request
+
+_freq = 160000000
+
+
+def freq(hz=None):
+    global _freq
+    if hz is None:
+        return _freq
+    _freq = hz
+
+
+def idle():
+    utime.advance(1)
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
+
+
+def reset_sim():
+    """Forget all pin levels, IRQ handlers and bus attachments."""
+    Pin._levels.clear()
+    Pin._irqs.clear()
+    Pin._watchers.clear()
+    SPI._devices.clear()
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_DOWN = 1
+    PULL_UP = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    _levels = {}    # gpio -> 0/1
+    _irqs = {}      # gpio -> (handler, trigger, Pin)
+    _watchers = {}  # gpio -> [callback(level)] for devices listening to the MCU
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = None
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self.mode = mode
+        if pull == Pin.PULL_UP and self.id not in Pin._levels:
+            Pin._levels[self.id] = 1
+        if value is not None:
+            self.value(value)
+
+    def value(self, x=None):
+        if x is None:
+            utime.advance(PIN_COST_US)
+            return Pin._levels.get(self.id, 0)
+        Pin._set(self.id, 1 if x else 0)
+        for callback in Pin._watchers.get(self.id, ()):
+            callback(Pin._levels[self.id])
+
+    __call__ = value
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        if handler is None:
+            Pin._irqs.pop(self.id, None)
+        else:
+            Pin._irqs[self.id] = (handler, trigger, self)
+
+    @classmethod
+    def _set(cls, gpio, level):
+        old = cls._levels.get(gpio, 0)
+        cls._levels[gpio] = level
+        if old == level or gpio not in cls._irqs:
+            return
+        handler, trigger, pin = cls._irqs[gpio]
+        if (level and trigger & cls.IRQ_RISING) or (not level and trigger & cls.IRQ_FALLING):
+            handler(pin)
+
+    @classmethod
+    def drive(cls, gpio, level):
+        """Called by simulated devices to drive a line the MCU reads."""
+        cls._set(gpio, 1 if level else 0)
+
+    @classmethod
+    def watch(cls, gpio, callback):
+        """Called by simulated devices to see the MCU driving a line."""
+        cls._watchers.setdefault(gpio, []).append(callback)
+
+
+class SPI:
+    MSB = 0
+    LSB = 1
+
+    _devices = {}  # bus key -> [device]; device.exchange(bytes) -> bytes
+    clock_hz = 0   # clock of the transfer in progress, for devices that care
+
+    def __init__(self, id, baudrate=1000000, polarity=0, phase=0, bits=8,
+                 firstbit=MSB, sck=None, mosi=None, miso=None):
+        self.key = id
+        self.baudrate = baudrate
+        self.init(baudrate=baudrate, polarity=polarity, phase=phase)
+
+    def init(self, baudrate=None, polarity=0, phase=0, **kwargs):
+        if baudrate is not None:
+            self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    @classmethod
+    def attach(cls, key, device):
+        cls._devices.setdefault(key, []).append(device)
+
+    @classmethod
+    def detach(cls, key, device):
+        devices = cls._devices.get(key, [])
+        if device in devices:
+            devices.remove(device)
+
+    def _rate(self):
+        return self.baudrate
+
+    def _exchange(self, wbuf):
+        SPI.clock_hz = self._rate()
+        out = None
+        for device in SPI._devices.get(self.key, ()):
+            r = device.exchange(wbuf)
+            if r is not None and out is None:
+                out = r
+        if out is None:
+            out = b'\xff' * len(wbuf)
+        utime.advance(SPI_CALL_US + len(wbuf) * 8000000 // self._rate())
+        return out
+
+    def write_readinto(self, write_buf, read_buf):
+        out = self._exchange(bytes(write_buf))
+        read_buf[:len(out)] = out
+
+    def write(self, buf):
+        self._exchange(bytes(buf))
+
+    def read(self, nbytes, write=0x00):
+        return bytes(self._exchange(bytes([write]) * nbytes))
+
+    def readinto(self, buf, write=0x00):
+        out = self._exchange(bytes([write]) * len(buf))
+        buf[:len(out)] = out
+
+
+class SoftSPI(SPI):
+    """Bit-banged bus. Devices attach with the SCK pin number as key."""
+
+    def __init__(self, baudrate=500000, polarity=0, phase=0, bits=8,
+                 firstbit=SPI.MSB, sck=None, mosi=None, miso=None):
+        SPI.__init__(self, getattr(sck, 'id', sck), baudrate, polarity, phase,
+                     bits, firstbit, sck, mosi, miso)
+
+    def _rate(self):
+        return min(self.baudrate, SOFT_SPI_MAX_HZ)
+
+
+class PWM:
+    def __init__(self, pin, freq=0, duty=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+
+    def deinit(self):
+        pass
+
+
+class Timer:
+    """Periodic or one-shot callback on the virtual clock. period is in ms
+    as on the ESP32, or give freq in Hz; ticks fall on start + k * period,
+    rounded to the µs, so a fractional period does not drift."""
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        self._due = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=None, period=None, callback=None):
+        self.deinit()
+        self._mode = mode
+        self._period_us = 1000000 / freq if freq else 1000 * period
+        self._callback = callback
+        self._start = utime.now_us()
+        self._ticks = 1
+        self._due = self._start + round(self._period_us)
+        utime.add_listener(self)
+
+    def deinit(self):
+        self._due = None
+        utime.remove_listener(self)
+
+    def next_event(self):
+        return self._due
+
+    def on_event(self, now):
+        if self._mode == Timer.PERIODIC:
+            self._ticks += 1
+            self._due = self._start + round(self._ticks * self._period_us)
+        else:
+            self.deinit()
+        if self._callback is not None:
+            self._callback(self)
@@ -0,0 +1,44 @@
+"""Host stand-in for the micropython module.
+
+The code emitters are no-ops under CPython, so native/viper functions run as
+plain Python. That is fine for checking behaviour but says nothing about the
+speed-up the emitters give on the ESP32.
+"""
+
+
+def const(expr):
+    return expr
+
+
+def native(f):
+    return f
+
+
+def viper(f):
+    return f
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def opt_level(level=None):
+    return 0 if level is None else None
+
+
+def schedule(func, arg):
+    # Soft IRQs run between bytecodes on the device; straight away is the
+    # closest CPython equivalent.
+    func(arg)
+
+
+def heap_lock():
+    return 0
+
+
+def heap_unlock():
+    return 0
+
+
+def mem_info(verbose=None):
+    pass
@@ -0,0 +1,328 @@
+"""Simulated SD card (SPI mode) for exercising sdcard.SDCard on the host.
+
+The card decodes the byte stream sent while its CS pin is low: CMD0/8/9/12/
+16/17/18/24/25/55/58, ACMD23 and ACMD41, the data tokens FEh/FCh/FDh and
+512-byte data blocks. It answers with R1/R3/R7 responses, CSD and block data.
+After each written block, and after the stop token, it reports busy (00h) for
+a modelled programming time on the utime clock.
+
+Anything the SD spec does not allow is recorded in `violations` instead of
+being silently accepted. Examples: a command sent mid multi-block write, the
+wrong start token, a stop token outside CMD25, ACMD23 not followed by
+CMD25, a command while busy, or a write past the end of the card. Blocks
+written inside the range pre-erased with ACMD23 program faster, as they do
+on real cards.
+
+Data blocks carry a real CRC16. Above max_hz the MISO line is marginal: a
+bit flips in a fixed share of the bytes read, so data blocks fail their CRC
+while short command responses usually survive, which is what clock
+negotiation has to detect.
+
+    card = SDCardSim(bus=26, cs=33)  # SoftSPI sck=26, CS on GPIO 33
+    sd = sdcard.SDCard(SoftSPI(sck=Pin(26), mosi=Pin(25), miso=Pin(27)), Pin(33))
+    assert not card.violations
+"""
+
+from collections import deque
+
+import utime
+from machine import Pin, SPI
+
+_IDLE, _WRITE_SINGLE, _WRITE_MULTI, _DATA_IN, _READ_MULTI = range(5)
+
+_TOKEN_DATA = 0xFE
+_TOKEN_CMD25 = 0xFC
+_TOKEN_STOP_TRAN = 0xFD
+
+_R1_IDLE = 0x01
+_R1_ILLEGAL = 0x04
+_R1_ADDRESS = 0x20
+_DATA_ACCEPTED = 0x05
+_DATA_WRITE_ERROR = 0x0D
+
+
+def crc16(data):
+    crc = 0
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
+class SDCardSim:
+    def __init__(self, bus=26, cs=33, blocks=2 * 1024 * 1024, sdhc=True,
+                 program_us=700, erased_program_us=250, single_program_us=1500,
+                 stop_busy_us=300, init_polls=2, store=True,
+                 max_hz=20000000, error_every=97):
+        self.cs = cs
+        self.capacity = blocks
+        self.sdhc = sdhc
+        self.program_us = program_us
+        self.erased_program_us = erased_program_us
+        self.single_program_us = single_program_us
+        self.stop_busy_us = stop_busy_us
+        self.init_polls = init_polls
+        self.store = store  # False: accept writes without keeping the data
+        self.max_hz = max_hz
+        self.error_every = error_every
+        self.clocked = 0
+
+        self.data = {}  # block -> bytes; unwritten blocks read as zeros
+        self.out = deque()
+        self.cmd = bytearray(6)
+        self.cmd_len = 0
+        self.mode = _IDLE
+        self.app = False
+        self.idle = True
+        self.acmd41 = 0
+        self.busy_until = 0
+        self.block = 0       # next block for CMD18/CMD25
+        self.incoming = bytearray(514)
+        self.incoming_len = 0
+        self.erase_pending = 0
+        self.erased = (0, 0)  # [start, end) pre-erased by ACMD23
+        self.violations = []
+        self.reset_counters()
+
+        Pin.watch(cs, self._on_cs)
+        SPI.attach(bus, self)
+
+    def reset_counters(self):
+        self.commands = {}
+        self.blocks_written = 0
+        self.blocks_read = 0
+        self.multi_writes = 0
+        self.pre_erased_blocks = 0
+        self.busy_polls = 0
+        self.bit_errors = 0
+
+    def counters(self):
+        return {
+            'commands': dict(self.commands),
+            'blocks_written': self.blocks_written,
+            'blocks_read': self.blocks_read,
+            'multi_writes': self.multi_writes,
+            'pre_erased_blocks': self.pre_erased_blocks,
+            'busy_polls': self.busy_polls,
+            'bit_errors': self.bit_errors,
+            'violations': len(self.violations),
+        }
+
+    def _violation(self, message):
+        self.violations.append((utime.now_us(), message))
+
+    def _on_cs(self, level):
+        if level:
+            self.out.clear()
+            self.cmd_len = 0
+
+    # ---- SPI
+
+    def exchange(self, wbuf):
+        if Pin._levels.get(self.cs, 1):
+            return None
+        out = bytearray(len(wbuf))
+        for k in range(len(wbuf)):
+            out[k] = self._byte(wbuf[k])
+        if SPI.clock_hz > self.max_hz:
+            for k in range(len(out)):
+                self.clocked += 1
+                if self.clocked % self.error_every == 0:
+                    out[k] ^= 0x10
+                    self.bit_errors += 1
+        return out
+
+    def _byte(self, b):
+        if self.mode == _DATA_IN:
+            self.incoming[self.incoming_len] = b
+            self.incoming_len += 1
+            if self.incoming_len == 514:
+                self._block_received()
+            return 0xFF
+
+        if self.mode == _READ_MULTI:
+            if self.cmd_len or (b & 0xC0) == 0x40:
+                return self._command_byte(b)
+            if not self.out:
+                self._queue_block(self.block)
+                self.block += 1
+            return self.out.popleft()
+
+        if self.out:
+            if (b & 0xC0) == 0x40:  # host moved on to a new command
+                self.out.clear()
+                return self._command_byte(b)
+            return self.out.popleft()
+
+        if utime.now_us() < self.busy_until:
+            self.busy_polls += 1
+            if b != 0xFF:
+                self._violation('byte %02Xh sent while card busy' % b)
+            return 0x00
+
+        if self.mode in (_WRITE_SINGLE, _WRITE_MULTI):
+            if b == 0xFF:
+                return 0xFF
+            multi = self.mode == _WRITE_MULTI
+            if b == (_TOKEN_CMD25 if multi else _TOKEN_DATA):
+                self.mode = _DATA_IN
+                self.multi = multi
+                self.incoming_len = 0
+            elif b == _TOKEN_STOP_TRAN and multi:
+                self.mode = _IDLE
+                self.busy_until = utime.now_us() + self.stop_busy_us
+            elif (b & 0xC0) == 0x40:
+                self._violation('command byte %02Xh during %s write' % (b, 'multi-block' if multi else 'single-block'))
+                self.mode = _IDLE
+                return self._command_byte(b)
+            else:
+                self._violation('unexpected token %02Xh during %s write' % (b, 'multi-block' if multi else 'single-block'))
+            return 0xFF
+
+        if b == _TOKEN_STOP_TRAN:
+            self._violation('stop token outside a multi-block write')
+            return 0xFF
+        return self._command_byte(b)
+
+    def _command_byte(self, b):
+        if not self.cmd_len and (b & 0xC0) != 0x40:
+            return 0xFF
+        self.cmd[self.cmd_len] = b
+        self.cmd_len += 1
+        if self.cmd_len == 6:
+            self.cmd_len = 0
+            self._command()
+        return 0xFF
+
+    def _queue_data(self, data):
+        crc = crc16(data)
+        self.out.extend((0xFF, _TOKEN_DATA))
+        self.out.extend(data)
+        self.out.extend((crc >> 8, crc & 0xFF))
+
+    def _queue_block(self, block):
+        self._queue_data(self.data.get(block, bytes(512)))
+        self.blocks_read += 1
+
+    def _address(self, arg):
+        if self.sdhc:
+            return arg
+        if arg % 512:
+            self._violation('unaligned byte address %d' % arg)
+        return arg // 512
+
+    def _command(self):
+        index = self.cmd[0] & 0x3F
+        arg = int.from_bytes(self.cmd[1:5], 'big')
+        app, self.app = self.app, False
+        name = ('ACMD%d' if app else 'CMD%d') % index
+        self.commands[name] = self.commands.get(name, 0) + 1
+
+        if self.erase_pending and name != 'CMD25':
+            self._violation('ACMD23 not followed by CMD25 (got %s)' % name)
+            self.erase_pending = 0
+        if self.mode == _READ_MULTI and index != 12:
+            self._violation('%s during multi-block read' % name)
+
+        r1 = _R1_IDLE if self.idle else 0
+        extra = ()
+        data = None
+        if index == 0:
+            self.idle = True
+            self.mode = _IDLE
+            r1 = _R1_IDLE
+        elif index == 8:
+            extra = (0x00, 0x00, 0x01, arg & 0xFF)
+        elif index == 55:
+            self.app = True
+        elif index == 41 and app:
+            self.acmd41 += 1
+            if self.acmd41 >= self.init_polls:
+                self.idle = False
+            r1 = _R1_IDLE if self.idle else 0
+        elif index == 58:
+            extra = (0xC0 if self.sdhc and not self.idle else 0x80, 0xFF, 0x80, 0x00)
+        elif index == 9:
+            data = self._csd()
+        elif index == 16:
+            if arg != 512:
+                self._violation('CMD16 block length %d' % arg)
+        elif index == 17:
+            block = self._address(arg)
+            data = self.data.get(block, bytes(512))
+            self.blocks_read += 1
+        elif index == 18:
+            self.block = self._address(arg)
+            self.mode = _READ_MULTI
+        elif index == 12:
+            self.mode = _IDLE
+            self.out.clear()
+            self.out.append(0xFF)  # stuff byte
+        elif index == 24:
+            self.block = self._address(arg)
+            self.mode = _WRITE_SINGLE
+        elif index == 25:
+            self.block = self._address(arg)
+            self.mode = _WRITE_MULTI
+            self.multi_writes += 1
+            if self.erase_pending:
+                self.erased = (self.block, self.block + self.erase_pending)
+                self.erase_pending = 0
+            else:
+                self.erased = (0, 0)
+        elif index == 23 and app:
+            self.erase_pending = arg & 0x7FFFFF
+            if not self.erase_pending:
+                self._violation('ACMD23 with a zero block count')
+        else:
+            r1 |= _R1_ILLEGAL
+
+        self.out.append(0xFF)  # NCR
+        self.out.append(r1)
+        self.out.extend(extra)
+        if data is not None:
+            self._queue_data(data)
+
+    def _csd(self):
+        csd = bytearray(16)
+        if self.sdhc:
+            c_size = self.capacity // 1024 - 1
+            csd[0] = 0x40
+            csd[7] = (c_size >> 16) & 0x3F
+            csd[8] = (c_size >> 8) & 0xFF
+            csd[9] = c_size & 0xFF
+        else:
+            # CSD 1.0 with READ_BL_LEN 9 and C_SIZE_MULT 7 (512 blocks per unit)
+            c_size = self.capacity // 512 - 1
+            csd[5] = 0x09
+            csd[6] = (c_size >> 10) & 0x03
+            csd[7] = (c_size >> 2) & 0xFF
+            csd[8] = (c_size & 0x03) << 6
+            csd[9] = 0x03
+            csd[10] = 0x80
+        return bytes(csd)
+
+    def _block_received(self):
+        block = self.block
+        now = utime.now_us()
+        if block >= self.capacity:
+            self._violation('write to block %d past the end of the card' % block)
+            self.out.append(_DATA_WRITE_ERROR)
+        else:
+            if self.store:
+                self.data[block] = bytes(self.incoming[:512])
+            self.blocks_written += 1
+            self.out.append(_DATA_ACCEPTED)
+        if not self.multi:
+            program = self.single_program_us
+            self.mode = _IDLE
+        elif self.erased[0] <= block < self.erased[1]:
+            program = self.erased_program_us
+            self.pre_erased_blocks += 1
+            self.mode = _WRITE_MULTI
+        else:
+            program = self.program_us
+            self.mode = _WRITE_MULTI
+        self.block += 1
+        self.busy_until = now + program
@@ -0,0 +1,48 @@
+"""Run the selftest() of every repo module that has one, under hostsim,
+and of the host-only checks here (fatimage: extentlog against FAT images).
+
+    python simulator/selftest.py
+    python simulator/selftest.py spectrum lockin
+
+Exits with 1 if any of them raises, so it can run as a CI step next to
+bench.py.
+"""
+
+import os
+import sys
+import traceback
+
+import hostsim
+
+
+def modules():
+    """Top-level repo modules that define selftest(), then the ones in
+    this directory."""
+    names = []
+    for folder in (hostsim.ROOT, hostsim.HERE):
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.py') and name != 'selftest.py':
+                with open(os.path.join(folder, name), encoding='utf-8') as f:
+                    if '\ndef selftest(' in f.read():
+                        names.append(name[:-3])
+    return names
+
+
+def main(names):
+    hostsim.install()
+    failed = 0
+    for name in names or modules():
+        hostsim.fresh()
+        try:
+            result = hostsim.load(name).selftest()
+        except Exception:
+            failed += 1
+            print('%-12s FAILED' % name)
+            traceback.print_exc()
+        else:
+            print('%-12s ok (%s)' % (name, result))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,152 @@
+"""Host stand-in for MicroPython's _thread on the virtual clock.
+
+The stock ESP32 build runs Python threads under a GIL, so only one of them
+runs at a time. Real CPython threads sharing the virtual clock would race
+on it instead. Here the threads are real, but they pass a baton:
+
+- only the holder runs, and time it spends (its utime.advance calls) is
+  time the others wait, as under the GIL
+- the holder hands over after every SWITCH_US of virtual time, standing in
+  for the GIL being released every few bytecodes
+- a sleep hands over until the sleeper's wake time; if every thread is
+  asleep, the clock jumps to the earliest wake
+
+DRDY and other device events fire in whichever thread moves the clock,
+like an IRQ interrupting whatever runs. hostsim.load() points `_thread`
+in the repo modules here, the way it points `time` at utime.
+"""
+
+import sys
+import threading
+
+import utime
+
+SWITCH_US = 50
+
+_cond = threading.Condition()
+_local = threading.local()
+_wakes = {}  # thread token -> wake time (virtual µs) or None if runnable
+_order = []  # tokens, round robin
+_state = {'current': None, 'next_token': 1, 'last_switch': 0}
+
+
+def _me():
+    return getattr(_local, 'token', 0)
+
+
+def reset():
+    """Forget all threads (hostsim.fresh); the caller becomes thread 0."""
+    with _cond:
+        utime._threads = None
+        _wakes.clear()
+        del _order[:]
+        _state['current'] = None
+        _state['last_switch'] = 0
+    _local.token = 0
+
+
+def _runnable_other(me):
+    now = utime.now_us()
+    k = _order.index(me) if me in _order else -1
+    for j in range(1, len(_order) + 1):
+        t = _order[(k + j) % len(_order)]
+        if t != me and (_wakes[t] is None or _wakes[t] <= now):
+            return t
+    return None
+
+
+def _hand_to(token):
+    _state['current'] = token
+    _state['last_switch'] = utime.now_us()
+    _cond.notify_all()
+
+
+def _wait_turn(me):
+    """Block until thread me holds the baton and its wake time has come.
+    Called with _cond held."""
+    while True:
+        if _state['current'] == me:
+            wake = _wakes[me]
+            if wake is None or wake <= utime.now_us():
+                _wakes[me] = None
+                return
+            other = _runnable_other(me)
+            if other is not None:
+                _hand_to(other)
+            else:  # everyone is asleep: move the clock to the first wake
+                first = min(w for w in _wakes.values() if w is not None)
+                utime.advance_raw(first - utime.now_us())
+                due = [t for t in _order if _wakes[t] is not None and _wakes[t] <= utime.now_us()]
+                if me not in due:
+                    _hand_to(due[0])
+                continue
+        _cond.wait()
+
+
+def sleep_us(us):
+    """utime's sleeps while threads run: give up the baton until due."""
+    me = _me()
+    with _cond:
+        _wakes[me] = utime.now_us() + max(int(us), 0)
+        _wait_turn(me)
+
+
+def tick():
+    """Called by utime after the clock moved: hand over once the holder
+    has had its SWITCH_US."""
+    me = _me()
+    if _state['current'] != me or utime.now_us() - _state['last_switch'] < SWITCH_US:
+        return
+    with _cond:
+        other = _runnable_other(me)
+        if other is None:
+            _state['last_switch'] = utime.now_us()
+            return
+        _hand_to(other)
+        _wait_turn(me)
+
+
+def _run(token, function, args):
+    _local.token = token
+    with _cond:
+        _wait_turn(token)
+    try:
+        function(*args)
+    finally:
+        with _cond:
+            _order.remove(token)
+            del _wakes[token]
+            if _order == [0]:  # back to one thread
+                utime._threads = None
+            rest = [t for t in _order if _wakes[t] is None] or _order
+            if rest:
+                _hand_to(rest[0])
+
+
+def start_new_thread(function, args):
+    with _cond:
+        if not _order:
+            _order.append(0)
+            _wakes[0] = None
+            _state['current'] = 0
+            _state['last_switch'] = utime.now_us()
+        utime._threads = sys.modules[__name__]
+        token = _state['next_token']
+        _state['next_token'] += 1
+        _order.append(token)
+        _wakes[token] = None
+    thread = threading.Thread(target=_run, args=(token, function, args), daemon=True)
+    thread.start()
+    return token
+
+
+def stack_size(size=0):
+    return 0
+
+
+def get_ident():
+    return _me()
+
+
+def allocate_lock():
+    return threading.Lock()
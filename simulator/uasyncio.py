@@ -0,0 +1,42 @@
+"""Host stand-in for uasyncio on top of CPython's asyncio.
+
+Sleeps advance the virtual utime clock and then yield once, so coroutines
+interleave in virtual time rather than waiting on the wall clock.
+"""
+
+from asyncio import (  # noqa: F401
+    CancelledError, Event, Lock, TimeoutError, create_task, gather,
+    get_event_loop, new_event_loop, run, wait_for,
+)
+import asyncio as _asyncio
+
+import utime
+
+
+async def sleep(t):
+    utime.sleep(t)
+    await _asyncio.sleep(0)
+
+
+async def sleep_ms(t):
+    utime.sleep_ms(t)
+    await _asyncio.sleep(0)
+
+
+class ThreadSafeFlag:
+    """Same contract as uasyncio.ThreadSafeFlag: set() from an IRQ, one waiter."""
+
+    def __init__(self):
+        self._flag = False
+
+    def set(self):
+        self._flag = True
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        while not self._flag:
+            utime.advance(utime.TICKS_COST_US)
+            await _asyncio.sleep(0)
+        self._flag = False
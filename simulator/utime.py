@@ -0,0 +1,156 @@
+"""Host stand-in for MicroPython's utime, driven by a virtual microsecond clock.
+
+Nothing in here really sleeps. Sleeps, modelled SPI transfers and pin reads
+advance the clock, and every simulated device registered with add_listener()
+is given the chance to fire its events (e.g. DRDY falling) at the exact
+virtual instant they are due. This keeps benchmark figures deterministic and
+independent of how fast the host happens to run CPython.
+
+Ticks wrap at 2**30 like the ESP32 port so ticks_diff() handling gets tested.
+
+While a second thread runs (see simthread), sleeps hand the GIL over and
+every clock move gives the scheduler a chance to switch threads.
+"""
+
+_TICKS_PERIOD = 1 << 30
+_TICKS_MAX = _TICKS_PERIOD - 1
+_TICKS_HALFPERIOD = _TICKS_PERIOD >> 1
+
+# Modelled cost of calling into the clock itself (µs). Without it, busy loops
+# polling ticks_us() would never see time move.
+TICKS_COST_US = 1
+
+
+class SimulationEnd(BaseException):
+    """Raised from the clock once the deadline set by stop_at() has passed.
+
+    Derived from BaseException so the blanket `except Exception` handlers in
+    the acquisition loops do not swallow it."""
+
+
+_now = 0           # µs since reset()
+_ticks_offset = 0  # lets a run start close to the wrap point
+_deadline = None
+_listeners = []
+_dispatching = False
+_threads = None  # simthread, while a second thread runs
+
+
+def reset(start_ticks_us=0):
+    """Back to t = 0 with no devices attached. start_ticks_us shifts what
+    ticks_us() reports, e.g. to start a run just before the 2**30 wrap."""
+    global _now, _ticks_offset, _deadline, _dispatching, _threads
+    _threads = None
+    _now = 0
+    _ticks_offset = start_ticks_us
+    _deadline = None
+    _dispatching = False
+    del _listeners[:]
+
+
+def add_listener(device):
+    """device must provide next_event() -> µs or None, and on_event(now)."""
+    _listeners.append(device)
+
+
+def remove_listener(device):
+    if device in _listeners:
+        _listeners.remove(device)
+
+
+def stop_at(us):
+    """Raise SimulationEnd once the virtual clock passes `us` (None clears it)."""
+    global _deadline
+    _deadline = us
+
+
+def now_us():
+    """Virtual time since reset() without any modelled cost."""
+    return _now
+
+
+def advance(us):
+    """Move the clock forward by `us`, firing device events on the way."""
+    nested = _dispatching
+    advance_raw(us)
+    if _threads is not None and not nested:
+        _threads.tick()
+
+
+def advance_raw(us):
+    """advance() without giving other threads a turn."""
+    global _now, _dispatching
+    end = _now + us
+    if _dispatching:
+        # Called from an event handler (e.g. an IRQ doing an SPI read). The
+        # outer loop below picks up whatever is now due.
+        _now = end
+        return
+    _dispatching = True
+    try:
+        while True:
+            due, device = None, None
+            for d in _listeners:
+                t = d.next_event()
+                if t is not None and t <= end and (due is None or t < due):
+                    due, device = t, d
+            if device is None:
+                break
+            if due > _now:
+                _now = due
+            device.on_event(_now)
+            if _now > end:
+                end = _now
+        _now = end
+    finally:
+        _dispatching = False
+    if _deadline is not None and _now >= _deadline:
+        raise SimulationEnd(_now)
+
+
+def ticks_us():
+    advance(TICKS_COST_US)
+    return (_now + _ticks_offset) & _TICKS_MAX
+
+
+def ticks_ms():
+    advance(TICKS_COST_US)
+    return ((_now + _ticks_offset) // 1000) & _TICKS_MAX
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & _TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    diff = (ticks1 - ticks2) & _TICKS_MAX
+    return ((diff + _TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+
+def sleep_us(us):
+    if us > 0:
+        if _threads is not None:
+            _threads.sleep_us(int(us))
+        else:
+            advance(int(us))
+
+
+def sleep_ms(ms):
+    sleep_us(int(ms * 1000))
+
+
+def sleep(s):
+    sleep_us(int(s * 1000000))
+
+
+def time():
+    """Whole seconds, like time.time() on ports without float RTC support."""
+    return _now // 1000000
+
+
+def time_ns():
+    return _now * 1000
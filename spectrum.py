@@ -0,0 +1,228 @@
+""" Amplitude and phase at a few chosen frequencies, computed as codes stream
+in, in place of an FFT over stored raw data.
+
+Each bin is a (channel, Hz) pair, e.g. the PWM excitation fundamental, mains
+50/60 Hz and their harmonics. Per window every bin correlates its channel's
+codes with a unit phasor:
+
+    X = sum(x[k] * exp(-i * theta[k])),  theta[k + 1] = theta[k] + 2 pi f / fs
+
+which is the single DFT bin a Goertzel filter produces at the end of the
+window. The correlation form is used here because it stays in exact
+integer arithmetic. The phasor comes from a 1024-entry Q14 sine table
+indexed by a 24-bit phase accumulator, and the products go into 24-bit
+limbs (see moments), so a window costs no allocation and nothing leaves
+the small-int range. A Goertzel recursion needs
+floats, or wider multiplies than viper has, to stay stable.
+
+The channel's own mean is taken out when the window is read, so a large
+DC level does not leak into the bins. Each channel's sample rate is
+measured over every window and used for the next. The phase accumulator
+wraps, so a frequency above half the channel rate (a 1 kHz PWM on a
+scanned channel, say) is analysed where it aliases to. Only the results go
+to storage: one binlog SPECTRUM record per window, with count, the
+frequency actually analysed, peak amplitude in codes and phase per bin.
+Windows are limited to 131072 samples per channel.
+
+spec = spectrum.Spectrum([(0, 1000), (0, 50), (0, 150), (1, 50)], plan.n)
+spec.add(codes, ids, n)                # as the ring is drained
+binlog.pack_spectrum(record, us, spec)
+spec.clear()                           # next window, at the measured rates
+"""
+
+from array import array
+import math
+import micropython
+import utime
+
+# Q14 sine, stored as unsigned 16-bit words since ptr16 loads are unsigned
+SINE = array('H', [int(round(16384 * math.sin(2 * math.pi * k / 1024))) & 0xFFFF for k in range(1024)])
+ONE = 16384  # Q14
+PHASE = 1 << 24
+_WORDS = 8  # per bin: in-phase and quadrature sums (3 limbs each), sum of cos, sum of sin
+
+
+def limbs(lo, mid, hi):
+    """ The signed 72-bit value in three 24-bit limbs. """
+    value = (hi << 48) + (mid << 24) + lo
+    return value - (1 << 72) if hi & 0x800000 else value
+
+
+class Spectrum:
+    def __init__(self, bins, n, rates=None):
+        """ bins: (channel, Hz) pairs. n: number of channels. rates: sample
+        rate per channel (SPS) to use for the first window; without one,
+        the first window only measures it and the bins report no samples. """
+        self.bins = [(c, float(f)) for c, f in bins]
+        self.nbins = len(self.bins)
+        self.n = n
+        self.channels = bytearray(c for c, _ in self.bins)
+        self.steps = array('i', bytes(4 * self.nbins))
+        self.phases = array('i', bytes(4 * self.nbins))
+        self.words = array('i', bytes(4 * _WORDS * self.nbins))
+        self.counts = array('I', bytes(4 * n))
+        self.sums = array('i', bytes(8 * n))  # two limbs per channel
+        self.rates = array('f', bytes(4 * n))  # used this window, 0 if unknown
+        self.table = SINE
+        if rates is not None:
+            for c in range(n):
+                self.set_rate(c, rates[c] if isinstance(rates, (list, tuple, array)) else rates)
+        self.started = utime.ticks_us()
+
+    def set_rate(self, c, sps):
+        """ Analyse channel c as sampled at sps from now on. """
+        self.rates[c] = sps
+        for j in range(self.nbins):
+            if self.channels[j] == c:
+                self.steps[j] = int(self.bins[j][1] / sps * PHASE) % PHASE if sps else 0
+
+    @micropython.viper
+    def add(self, codes, channels, n: int):
+        """ Add codes[0:n] (an array('i')) of the channels in channels[0:n]. """
+        src = ptr32(codes)
+        ids = ptr8(channels)
+        counts = ptr32(self.counts)
+        sums = ptr32(self.sums)
+        chans = ptr8(self.channels)
+        steps = ptr32(self.steps)
+        phases = ptr32(self.phases)
+        acc = ptr32(self.words)
+        table = ptr16(self.table)
+        nb = int(self.nbins)
+        k = 0
+        while k < n:
+            c = ids[k]
+            v = src[k]
+            counts[c] += 1
+            lo = sums[2 * c] + v
+            sums[2 * c + 1] += lo >> 24
+            sums[2 * c] = lo & 0xFFFFFF
+            vh = v >> 12
+            vl = v & 0xFFF
+            j = 0
+            while j < nb:
+                if chans[j] == c:
+                    ph = phases[j]
+                    i = ph >> 14
+                    cs = table[(i + 256) & 1023]
+                    sn = table[i]
+                    if cs & 0x8000:
+                        cs -= 0x10000
+                    if sn & 0x8000:
+                        sn -= 0x10000
+                    w = j * 8
+                    # v * cos, as (vh * cos) << 12 + vl * cos, into 3 limbs
+                    p = vh * cs
+                    a0 = acc[w] + vl * cs + ((p & 0xFFF) << 12)
+                    a1 = acc[w + 1] + (p >> 12) + (a0 >> 24)
+                    acc[w] = a0 & 0xFFFFFF
+                    acc[w + 1] = a1 & 0xFFFFFF
+                    acc[w + 2] = (acc[w + 2] + (a1 >> 24)) & 0xFFFFFF
+                    # and v * sin
+                    p = vh * sn
+                    a0 = acc[w + 3] + vl * sn + ((p & 0xFFF) << 12)
+                    a1 = acc[w + 4] + (p >> 12) + (a0 >> 24)
+                    acc[w + 3] = a0 & 0xFFFFFF
+                    acc[w + 4] = a1 & 0xFFFFFF
+                    acc[w + 5] = (acc[w + 5] + (a1 >> 24)) & 0xFFFFFF
+                    acc[w + 6] += cs
+                    acc[w + 7] += sn
+                    phases[j] = (ph + steps[j]) & 0xFFFFFF
+                j += 1
+            k += 1
+
+    # ---- read-out, once per window
+
+    def count(self, j):
+        """ Samples behind bin j this window, 0 while its rate is unknown. """
+        c = self.channels[j]
+        return self.counts[c] if self.rates[c] else 0
+
+    def measured(self, c):
+        """ Channel c's sample rate over the window so far (SPS). """
+        elapsed = utime.ticks_diff(utime.ticks_us(), self.started)
+        return self.counts[c] * 1000000 / elapsed if elapsed > 0 else 0.0
+
+    def frequency(self, j):
+        """ The frequency bin j actually analysed this window: its nominal
+        frequency, corrected for the rate measured over the window. """
+        c = self.channels[j]
+        rate = self.rates[c]
+        return self.bins[j][1] * (self.measured(c) or rate) / rate if rate else 0.0
+
+    def phasor(self, j):
+        """ (re, im) of the window's DFT at bin j with the mean removed,
+        in codes. The mean is taken out in exact integers, since floats are
+        single precision on the ESP32. """
+        c = self.channels[j]
+        n = self.counts[c]
+        if not n:
+            return 0.0, 0.0
+        w = self.words
+        k = _WORDS * j
+        total = (self.sums[2 * c + 1] << 24) + self.sums[2 * c]
+        re = (n * limbs(w[k], w[k + 1], w[k + 2]) - total * w[k + 6]) / (n * ONE)
+        im = (n * limbs(w[k + 3], w[k + 4], w[k + 5]) - total * w[k + 7]) / (n * ONE)
+        return re, -im
+
+    def amplitude(self, j):
+        """ Peak amplitude in codes of the tone at bin j. """
+        n = self.count(j)
+        if not n:
+            return 0.0
+        re, im = self.phasor(j)
+        return 2 * math.sqrt(re * re + im * im) / n
+
+    def phase(self, j):
+        """ Phase in radians of the tone at bin j, relative to the start of
+        the first window (the phasor is not reset between windows). """
+        re, im = self.phasor(j)
+        return math.atan2(im, re)
+
+    def clear(self):
+        """ Start the next window at the rates measured over this one. """
+        for c in range(self.n):
+            if self.counts[c]:
+                self.set_rate(c, self.measured(c))
+        self.started = utime.ticks_us()
+        for c in range(self.n):
+            self.counts[c] = 0
+            self.sums[2 * c] = self.sums[2 * c + 1] = 0
+        w = self.words
+        for k in range(len(w)):
+            w[k] = 0
+
+
+# (channel, Hz, peak codes, phase rad) of the tones selftest() synthesises,
+# on a 2000000 code offset, and the bins it reads back (0 codes: no tone)
+TONES = ((0, 50, 100000, 0.5), (0, 120, 30000, -1.0), (0, 300, 0, 0.0), (1, 50, 2000, 2.5))
+
+
+def selftest(rate=1000, n=1000):
+    """ Synthesise TONES on two channels sampled in turn at rate SPS each,
+    n samples per channel, and check the amplitude (to 1 % of the largest
+    tone on the channel) and phase (to 0.01 rad) every bin recovers.
+    Returns the number of bins; raises AssertionError on the first
+    mismatch. """
+    spec = Spectrum([(c, f) for c, f, _, _ in TONES], 2, rate)
+    codes = array('i', bytes(8 * n))
+    ids = bytearray(2 * n)
+    for k in range(2 * n):
+        c, t = k & 1, (k >> 1) / rate
+        ids[k] = c
+        codes[k] = 2000000 + int(round(sum(a * math.cos(2 * math.pi * f * t + p)
+                                              for ch, f, a, p in TONES if ch == c)))
+    spec.add(codes, ids, 2 * n)
+    for j, (c, f, a, p) in enumerate(TONES):
+        scale = max(b for ch, _, b, _ in TONES if ch == c)
+        got = spec.amplitude(j)
+        if spec.count(j) != n or abs(got - a) > 0.01 * scale:
+            raise AssertionError('bin %d (%d Hz): amplitude %.1f, expected %d' % (j, f, got, a))
+        error = (spec.phase(j) - p + math.pi) % (2 * math.pi) - math.pi
+        if a and abs(error) > 0.01:
+            raise AssertionError('bin %d (%d Hz): phase %.4f, expected %.4f' % (j, f, spec.phase(j), p))
+    return len(TONES)
+
+
+if __name__ == '__main__':
+    print(selftest(), 'bins ok')
@@ -0,0 +1,207 @@
+""" Throughput/noise auto-tuning of data rate, digital filter and delay.
+
+Every (rate, filter, delay) setting is run on the scan plan's channels for a
+short while, measuring two things:
+
+    sps     samples per second actually delivered over the whole scan,
+            SPI and switching included
+    noise   RMS noise in µV, input-referred: the standard deviation of
+            the codes (see moments), the worst over the channels
+
+Run it on shorted inputs (SHORTED, the ADC's own VCOM/VCOM) or on a quiet
+reference, so what varies is the ADC noise. Only the Pareto-optimal
+settings are kept: those no other setting beats on both counts. They are
+saved as CSV, fastest first. Picking the fastest setting within a noise
+budget is then one call, and configure() puts it into channel specs for
+datalogger.measure_pipeline and the rest:
+
+front = tune.pareto(tune.sweep(adc, datalogger.CHANNELS))
+tune.save(front)
+channels = tune.configure(datalogger.CHANNELS, tune.fastest(2.0))
+
+Each setting runs until samples per channel or max_ms, stretched for slow
+settings to the time MIN_SAMPLES per channel take at one conversion
+latency (pulse.latency_us) each, so the noise of a slow rate is not a
+guess from a handful of samples. Settings are skipped, and listed in
+skipped if sweep() is given one, whose stretched time is over limit_ms,
+FIR above pulse.FIR_MAX_RATE, and in continuous mode data periods shorter
+than MIN_PERIOD_US: conversions would then come faster than the DRDY IRQ
+reads them, and nothing else would run. In pulse mode none comes before
+the last was read.
+
+The MODE1 delay only comes before the first conversion after a restart,
+so a continuous scan of one channel, never switched, runs the same at
+every delay: sweep() then tries only the default, 50us. On one channel
+and with the defaults, the sweep of 17 rates and 5 filters measures 59
+settings in under 2 minutes. The ones skipped as slow are 2.5 SPS, 5 SPS
+with anything but sinc1 and 10 SPS sinc4. With more channels, or in
+pulse mode, where every conversion starts after the delay, all 14
+delays are swept, about 14 times as many settings. A smaller limit_ms
+gives a quicker sweep that stops higher up.
+"""
+
+from array import array
+import gc
+import utime
+
+import ads1261evm
+import moments
+import pulse
+import ringbuffer
+import scanplan
+
+SHORTED = ({'positive': 'VCOM', 'negative': 'VCOM'},)
+FILTERS = ('sinc1', 'sinc2', 'sinc3', 'sinc4', 'fir')
+FILENAME = 'tune.csv'
+COLUMNS = 'rate,filter,delay,sps,noise_uV\n'
+RATE, FILTER, DELAY, SPS, NOISE = range(5)  # fields of a result
+ONE_DELAY = '50us'  # the only one swept where no conversion restarts
+MIN_SAMPLES = 32  # per channel, for a noise estimate
+MIN_PERIOD_US = 30  # about one DRDY IRQ: RDATA transfer and ring push
+_BLOCK = 256
+
+
+def measure(adc, channels, rate, filter, delay, samples=128, max_ms=250, chop='normal',
+            pulsed=False):
+    """ (sps, noise µV) of channels with every channel at rate, filter and
+    delay: until samples per channel or max_ms, after one scan cycle to
+    start up. """
+    specs = []
+    for entry in channels:
+        s = scanplan.spec(entry)
+        s.update({'rate': rate, 'filter': filter, 'delay': delay})
+        specs.append(s)
+    plan = scanplan.ScanPlan(adc, specs, rate, filter, delay, chop=chop,
+                             convert='pulse' if pulsed else 'continuous')
+    ring = ringbuffer.SampleRing(_BLOCK)
+    codes, ids = array('i', bytes(4 * _BLOCK)), bytearray(_BLOCK)
+    acc = moments.Moments(plan.n)
+    capture = ads1261evm.DrdyCapture(adc, plan.rdata, ring)
+    scanner = (pulse.Sequencer if pulsed else scanplan.Scanner)(plan, capture)
+    scanner.start()
+    try:
+        scanner.cycle()
+        ring.drain(codes, None, ids)
+        started = utime.ticks_us()
+        got = 0
+        while got < samples * plan.n and utime.ticks_diff(utime.ticks_us(), started) < 1000 * max_ms:
+            scanner.cycle()
+            n = ring.drain(codes, None, ids)
+            acc.add(codes, ids, n)
+            got += n
+        elapsed = utime.ticks_diff(utime.ticks_us(), started)
+    finally:
+        scanner.stop()
+    noise = max(acc.noise_mV(c, plan.scales[c]) for c in range(plan.n))
+    return got * 1000000 / elapsed, 1000 * noise
+
+
+def budget_ms(rate, filter, delay, n, max_ms=250, chop='normal'):
+    """ How long to measure a setting on n channels: max_ms, or the time
+    MIN_SAMPLES per channel take at one conversion latency each if that is
+    longer. """
+    return max(max_ms, MIN_SAMPLES * n * pulse.latency_us(rate, filter, delay, chop) / 1000)
+
+
+def why_skipped(rate, filter, delay, n, max_ms=250, limit_ms=10000, chop='normal',
+                pulsed=False):
+    """ None if sweep() measures a setting, else why not: 'fir' above
+    pulse.FIR_MAX_RATE, 'period' if the capture would not keep up, 'slow'
+    if its budget_ms is over limit_ms. """
+    if filter == 'fir' and rate > pulse.FIR_MAX_RATE:
+        return 'fir'
+    if not pulsed and 1000000 / rate * (1 if chop == 'normal' else 2) < MIN_PERIOD_US:
+        return 'period'
+    if budget_ms(rate, filter, delay, n, max_ms, chop) > limit_ms:
+        return 'slow'
+    return None
+
+
+def sweep(adc, channels=SHORTED, rates=None, filters=FILTERS, delays=None, samples=128,
+          max_ms=250, limit_ms=10000, chop='normal', pulsed=False, show=None, skipped=None):
+    """ measure() every setting of rates (default all of the ADC's),
+    filters and delays (default all of pulse.DELAYS for more than one
+    channel or pulsed, else just ONE_DELAY) that why_skipped() lets
+    through, each for its budget_ms. Returns a list of (rate, filter,
+    delay, sps, noise µV); show, if given, is called with each as it comes.
+    skipped, if a list, gets (rate, filter, delay, why) for the others, why
+    'none' if no conversions came. """
+    if rates is None:
+        rates = sorted(adc.available_data_rates)
+    n = len(channels)
+    if delays is None:
+        delays = [name for name, _ in pulse.DELAYS] if n > 1 or pulsed else [ONE_DELAY]
+    results = []
+    for rate in rates:
+        for filter in filters:
+            for delay in delays:
+                why = why_skipped(rate, filter, delay, n, max_ms, limit_ms, chop, pulsed)
+                if why is None:
+                    gc.collect()
+                    sps, noise = measure(adc, channels, rate, filter, delay, samples,
+                                         budget_ms(rate, filter, delay, n, max_ms, chop),
+                                         chop, pulsed)
+                    if not sps:
+                        why = 'none'
+                if why is not None:
+                    if skipped is not None:
+                        skipped.append((rate, filter, delay, why))
+                    continue
+                result = (rate, filter, delay, sps, noise)
+                results.append(result)
+                if show is not None:
+                    show(result)
+    return results
+
+
+def pareto(results):
+    """ The results that no other is both faster than and at most as noisy
+    as (or as fast and quieter), fastest first. """
+    front = []
+    for r in sorted(results, key=lambda r: (-r[SPS], r[NOISE])):
+        if not front or r[NOISE] < front[-1][NOISE]:
+            front.append(r)
+    return front
+
+
+def save(results, filename=FILENAME):
+    with open(filename, 'w') as f:
+        f.write(COLUMNS)
+        for r in results:
+            f.write('%s,%s,%s,%.1f,%.4f\n' % r)
+
+
+def load(filename=FILENAME):
+    results = []
+    with open(filename) as f:
+        f.readline()
+        for line in f:
+            rate, filter, delay, sps, noise = line.strip().split(',')
+            rate = float(rate)
+            results.append((int(rate) if rate == int(rate) else rate, filter, delay,
+                            float(sps), float(noise)))
+    return results
+
+
+def fastest(noise_uV, results=None, filename=FILENAME):
+    """ {'rate', 'filter', 'delay'} of the fastest result (default: the
+    saved ones) whose noise is at most noise_uV. """
+    if results is None:
+        results = load(filename)
+    best = None
+    for r in results:
+        if r[NOISE] <= noise_uV and (best is None or r[SPS] > best[SPS]):
+            best = r
+    if best is None:
+        raise ValueError('no setting within %s uV' % noise_uV)
+    return {'rate': best[RATE], 'filter': best[FILTER], 'delay': best[DELAY]}
+
+
+def configure(channels, setting):
+    """ Channel specs with setting (see fastest) applied to each. """
+    specs = []
+    for entry in channels:
+        s = scanplan.spec(entry)
+        s.update(setting)
+        specs.append(s)
+    return specs